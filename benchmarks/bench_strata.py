@@ -0,0 +1,179 @@
+"""
+Benchmarks each stage of the strata method on synthetic data, reporting rows per second
+and peak RSS, and optionally comparing the results with a saved baseline.
+
+    python -m benchmarks.bench_strata --rows 100000 1000000 --save-baseline base.json
+    python -m benchmarks.bench_strata --rows 100000 1000000 --baseline base.json
+"""
+import argparse
+import gc
+import json
+import sys
+import time
+
+import strata_io
+import strata_period_method
+from strata_metrics import peak_rss_mb, reset_peak_rss
+from benchmarks.synthetic_data import generate_strata_data
+
+
+def time_stage(stage_function, rows):
+    """
+    Runs a stage once, measuring its time and peak RSS.
+    :param stage_function: Function running the stage, returning its output.
+    :param rows: Number of rows the stage processes.
+    :return: Tuple of the stage output and a dict of its measurements.
+    """
+    gc.collect()
+    reset_peak_rss()
+    start = time.perf_counter()
+    output = stage_function()
+    seconds = time.perf_counter() - start
+
+    return output, {"seconds": seconds,
+                    "rows_per_second": rows / seconds if seconds > 0 else float("inf"),
+                    "peak_rss_mb": peak_rss_mb()}
+
+
+def run_benchmark(rows, period_count, anomaly_rate, survey_mix, row_wise=False):
+    """
+    Runs each stage of the method over generated data.
+    :param rows: Number of rows to generate.
+    :param period_count: Number of periods in the data.
+    :param anomaly_rate: Proportion of rows whose strata changes between periods.
+    :param survey_mix: Dict of survey code to the proportion of references in it.
+    :param row_wise: Whether to also time the row-wise calculate_strata.
+    :return: Dict of stage name to its measurements.
+    """
+    data = generate_strata_data(rows, period_count=period_count,
+                                anomaly_rate=anomaly_rate, survey_mix=survey_mix)
+    rows = len(data)
+    data_json = data.to_json(orient="records")
+    del data
+
+    results = {}
+    input_data, results["read_json"] = time_stage(
+        lambda: strata_io.compact_dataframe(strata_io.decode_dataframe(data_json),
+                                            ["period", "region"], ["responder_id"]),
+        rows)
+    data_json = None
+
+    strata_arguments = {"strata_column": "strata", "value_column": "Q608_total",
+                        "survey_column": "survey", "region_column": "region"}
+
+    if row_wise:
+        _, results["strata_row_wise"] = time_stage(
+            lambda: input_data.apply(strata_period_method.calculate_strata, axis=1,
+                                     **strata_arguments), rows)
+
+    post_strata, results["strata"] = time_stage(
+        lambda: strata_period_method.assign_strata(input_data, **strata_arguments), rows)
+
+    (strata_check, anomalies), results["mismatch_detection"] = time_stage(
+        lambda: strata_period_method.strata_mismatch_detector(
+            post_strata, "201809", "period", "responder_id", "strata", "good_strata",
+            "current_period", "previous_period", "current_strata", "previous_strata"),
+        rows)
+
+    _, results["to_json"] = time_stage(
+        lambda: (strata_check.to_json(orient="records"),
+                 anomalies.to_json(orient="records")), rows)
+
+    return results
+
+
+def compare_with_baseline(results, baseline, tolerance):
+    """
+    Finds stages which are slower or use more memory than the baseline, beyond the
+    tolerance.
+    :param results: Dict of row count to stage measurements, from this run.
+    :param baseline: Dict of row count to stage measurements, from the baseline.
+    :param tolerance: Proportion either side of the baseline that is allowed.
+    :return: List of strings describing the regressions.
+    """
+    regressions = []
+    for rows, stages in results.items():
+        for stage, measurements in stages.items():
+            expected = baseline.get(rows, {}).get(stage)
+            if expected is None:
+                continue
+            if measurements["rows_per_second"] < \
+                    expected["rows_per_second"] * (1 - tolerance):
+                regressions.append(
+                    f"{stage} at {rows} rows: {measurements['rows_per_second']:.0f} "
+                    f"rows/s against {expected['rows_per_second']:.0f} rows/s")
+            if measurements["peak_rss_mb"] > expected["peak_rss_mb"] * (1 + tolerance):
+                regressions.append(
+                    f"{stage} at {rows} rows: {measurements['peak_rss_mb']:.0f} MB "
+                    f"peak RSS against {expected['peak_rss_mb']:.0f} MB")
+
+    return regressions
+
+
+def parse_arguments(argv=None):
+    """
+    Parses the command line arguments.
+    :param argv: List of the arguments, defaults to sys.argv.
+    :return: Namespace of the parsed arguments.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rows", type=int, nargs="+", default=[100000])
+    parser.add_argument("--periods", type=int, default=2)
+    parser.add_argument("--anomaly-rate", type=float, default=0.05)
+    parser.add_argument("--survey-mix", type=json.loads,
+                        default={"066": 0.8, "076": 0.2},
+                        help='JSON of survey proportions, e.g. {"066": 0.8, "076": 0.2}')
+    parser.add_argument("--json-codec", choices=sorted(strata_io.JSON_CODECS),
+                        help="JSON codec to decode with, defaults to the fastest "
+                             "installed.")
+    parser.add_argument("--row-wise", action="store_true",
+                        help="Also time the row-wise calculate_strata.")
+    parser.add_argument("--save-baseline", help="File to save the results to.")
+    parser.add_argument("--baseline", help="File of results to compare against.")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    """
+    Runs the benchmarks, printing the results and comparing them with the baseline.
+    :param argv: List of the arguments, defaults to sys.argv.
+    :return: Exit code, 1 if there are regressions against the baseline.
+    """
+    arguments = parse_arguments(argv)
+    strata_io.set_json_codec(arguments.json_codec)
+
+    results = {}
+    for rows in arguments.rows:
+        results[str(rows)] = run_benchmark(rows, arguments.periods,
+                                           arguments.anomaly_rate,
+                                           arguments.survey_mix,
+                                           arguments.row_wise)
+
+        print(f"{rows} rows, {arguments.periods} periods, "
+              f"{arguments.anomaly_rate:.1%} anomaly rate")
+        for stage, measurements in results[str(rows)].items():
+            print(f"  {stage:<20}{measurements['seconds']:>10.3f}s"
+                  f"{measurements['rows_per_second']:>14.0f} rows/s"
+                  f"{measurements['peak_rss_mb']:>10.0f} MB")
+
+    if arguments.save_baseline:
+        with open(arguments.save_baseline, "w") as file:
+            json.dump(results, file, indent=4)
+
+    if arguments.baseline:
+        with open(arguments.baseline, "r") as file:
+            baseline = json.load(file)
+
+        regressions = compare_with_baseline(results, baseline, arguments.tolerance)
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        if regressions:
+            return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,799 @@
+"""
+Differential tests of the optimised strata paths against the original row-wise
+implementation, on random data concentrated on the edge cases, with a benchmark mode
+which times each path against the original at scale.
+
+    python -m benchmarks.differential_strata --cases 1000 --seed 0
+    python -m benchmarks.differential_strata --rows 100000 1000000
+"""
+import argparse
+import gc
+import io
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from unittest import mock
+
+import numpy as np
+import pandas as pd
+from es_aws_functions import aws_functions
+from moto import mock_s3
+
+import strata_cache
+import strata_io
+import strata_local_runner
+import strata_period_method
+import strata_period_wrangler
+import strata_replay
+from benchmarks.synthetic_data import generate_edge_case_data
+from strata_metrics import peak_rss_mb, reset_peak_rss
+
+CURRENT_PERIOD = "201809"
+
+STRATA_ARGUMENTS = {"value_column": "Q608_total", "region_column": "region",
+                    "strata_column": "strata", "survey_column": "survey"}
+
+REFERENCE = "responder_id"
+PERIOD_COLUMN = "period"
+SEGMENTATION = "strata"
+
+# The column arguments of the mismatch detection, after the current period.
+MISMATCH_ARGUMENTS = [PERIOD_COLUMN, REFERENCE, SEGMENTATION, "good_strata",
+                      "current_period", "previous_period", "current_strata",
+                      "previous_strata"]
+
+# The columns the method reads, which it adds to data of no rows.
+PROJECTED_COLUMNS = [REFERENCE, PERIOD_COLUMN, "region", "survey", "Q608_total"]
+
+BUCKET_NAME = "differential-strata"
+IN_FILE_NAME = "differential_input"
+OUT_FILE_NAME = "differential_output.json"
+REGION_NAME = "eu-west-2"
+
+# The environment of both lambdas, which ignore each other's variables, with fake
+# credentials as every AWS call they make is mocked.
+LAMBDA_ENVIRONMENT = {
+    "AWS_ACCESS_KEY_ID": "testing",
+    "AWS_SECRET_ACCESS_KEY": "testing",
+    "bucket_name": BUCKET_NAME,
+    "method_name": "strata_period_method",
+    "period_column": PERIOD_COLUMN,
+    "reference": REFERENCE,
+    "segmentation": SEGMENTATION,
+    "strata_column": STRATA_ARGUMENTS["strata_column"],
+    "value_column": STRATA_ARGUMENTS["value_column"]
+}
+
+WRANGLER_RUNTIME_VARIABLES = {
+    "bpm_queue_url": "differential_queue_url",
+    "distinct_values": [STRATA_ARGUMENTS["region_column"]],
+    "environment": "differential",
+    "in_file_name": IN_FILE_NAME,
+    "out_file_name": OUT_FILE_NAME,
+    "run_id": "differential",
+    "sns_topic_arn": "differential_sns_arn",
+    "survey": "BMI_SG",
+    "survey_column": STRATA_ARGUMENTS["survey_column"],
+    "total_steps": 6
+}
+
+# Proportions of the random cases with no rows, and with a single row.
+EMPTY_CASE_RATE = 0.05
+SINGLE_ROW_CASE_RATE = 0.05
+
+compact_dataframe = partial(strata_io.compact_dataframe,
+                            int32_columns=[PERIOD_COLUMN, "region"],
+                            int64_columns=[REFERENCE])
+
+
+def reference_strata(data):
+    """
+    Calculates the strata row by row with calculate_strata, as the method originally
+    did.
+    :param data: DataFrame of the input data.
+    :return: DataFrame of the data including the strata.
+    """
+    if len(data) == 0:
+        # The apply never calls calculate_strata without any rows, so the strata
+        # column it adds is added here.
+        return data.assign(**{STRATA_ARGUMENTS["strata_column"]: pd.Series(
+            dtype=object)})
+
+    return data.apply(strata_period_method.calculate_strata, axis=1,
+                      **STRATA_ARGUMENTS)
+
+
+def baseline_mismatch_detector(data, current_period, time, reference, segmentation,
+                               stored_segmentation, current_time, previous_time,
+                               current_segmentation, previous_segmentation):
+    """
+    The original strata_mismatch_detector, copied as it was. It drops the duplicates of
+    every period in the data, so it is only the reference for data of one or two
+    periods, where the detector's comparison with the period before gives the same
+    result.
+    :param data: The DataFrame the miss-match detection will be performed on.
+    :param current_period: The current period of the run.
+    :param time: Field name which is used as a gauge of time'. Added for CAC.
+    :param reference: Field name which is used as a reference for CAC.
+    :param segmentation: Field name of the segmentation used for CAC.
+    :param stored_segmentation: Field name of stored segmentation for CAC.
+    :param current_time: Field name of the current time used for CAC.
+    :param previous_time: Field name of the previous time used for CAC.
+    :param current_segmentation: Field name of the current segmentation used for CAC.
+    :param previous_segmentation: Field name of the current segmentation used for CAC.
+    :return: Tuple of the DataFrames of the patched data and the anomalies.
+    """
+    data_anomalies = data[[reference, segmentation, time]]
+
+    data_anomalies = data_anomalies.drop_duplicates(subset=[reference, segmentation],
+                                                    keep=False)
+
+    if data_anomalies.size > 0:
+        # Filter to only include data from the current period
+        fix_data = data_anomalies[data_anomalies[time] == int(current_period)][
+            [reference, segmentation]]
+        fix_data = fix_data.rename(columns={segmentation: stored_segmentation})
+
+        # Now merge these so that the fix_data strata is
+        # added as an extra column to the input data
+        data = pd.merge(data, fix_data, on=reference, how="left")
+
+        # We should now have a good Strata column in the dataframe - mostly containing
+        # null values, containing strata where there was anomaly using an apply method,
+        # set strata to be the good strata.
+        data[segmentation] = data.apply(
+            lambda x: x[stored_segmentation]
+            if str(x[stored_segmentation]) != "nan" else x[segmentation], axis=1)
+        data = data.drop(stored_segmentation, axis=1)
+
+        # Split on period then merge together so they're same row.
+        current_period_anomalies = data_anomalies[
+            data_anomalies[time] == int(current_period)].rename(
+            columns={segmentation: current_segmentation, time: current_time})
+
+        prev_period_anomalies = data_anomalies[data_anomalies[time]
+                                               != int(current_period)].rename(
+            columns={segmentation: previous_segmentation, time: previous_time})
+
+        data_anomalies = pd.merge(current_period_anomalies, prev_period_anomalies,
+                                  on=reference)
+
+    return data, data_anomalies
+
+
+def reference_mismatch_detector(data, current_period, time, reference, segmentation,
+                                stored_segmentation, current_time, previous_time,
+                                current_segmentation, previous_segmentation):
+    """
+    The original strata_mismatch_detector, with the periods before the one each
+    reference is compared with left out of the drop_duplicates, as the detector now
+    compares each reference's current period with only the period before it. It is
+    the reference for data of more than two periods, which baseline_mismatch_detector
+    can't check.
+    :param data: The DataFrame the miss-match detection will be performed on.
+    :param current_period: The current period of the run.
+    :param time: Field name which is used as a gauge of time'. Added for CAC.
+    :param reference: Field name which is used as a reference for CAC.
+    :param segmentation: Field name of the segmentation used for CAC.
+    :param stored_segmentation: Field name of stored segmentation for CAC.
+    :param current_time: Field name of the current time used for CAC.
+    :param previous_time: Field name of the previous time used for CAC.
+    :param current_segmentation: Field name of the current segmentation used for CAC.
+    :param previous_segmentation: Field name of the current segmentation used for CAC.
+    :return: Tuple of the DataFrames of the patched data and the anomalies.
+    """
+    is_current = data[time] == int(current_period)
+    is_earlier = data[time] < int(current_period)
+    previous_period = data[time].where(is_earlier).groupby(
+        data[reference]).transform("max")
+    compared = is_current | (is_earlier & (data[time] == previous_period))
+
+    data_anomalies = data.loc[compared, [reference, segmentation, time]]
+
+    data_anomalies = data_anomalies.drop_duplicates(subset=[reference, segmentation],
+                                                    keep=False)
+
+    if data_anomalies.size > 0:
+        fix_data = data_anomalies[data_anomalies[time] == int(current_period)][
+            [reference, segmentation]]
+        fix_data = fix_data.rename(columns={segmentation: stored_segmentation})
+
+        data = pd.merge(data, fix_data, on=reference, how="left")
+
+        data[segmentation] = data.apply(
+            lambda x: x[stored_segmentation]
+            if str(x[stored_segmentation]) != "nan" else x[segmentation], axis=1)
+        data = data.drop(stored_segmentation, axis=1)
+
+        current_period_anomalies = data_anomalies[
+            data_anomalies[time] == int(current_period)].rename(
+            columns={segmentation: current_segmentation, time: current_time})
+
+        prev_period_anomalies = data_anomalies[data_anomalies[time]
+                                               != int(current_period)].rename(
+            columns={segmentation: previous_segmentation, time: previous_time})
+
+        data_anomalies = pd.merge(current_period_anomalies, prev_period_anomalies,
+                                  on=reference)
+
+    return data, data_anomalies
+
+
+def reference_run(data, current_period):
+    """
+    Runs the row-wise strata and mismatch detection, with the original detector itself
+    wherever the data has no more than two periods.
+    :param data: DataFrame of the input data.
+    :param current_period: The current period of the run.
+    :return: Tuple of the DataFrames of the data and anomalies.
+    """
+    detector = baseline_mismatch_detector if data[PERIOD_COLUMN].nunique() <= 2 else \
+        reference_mismatch_detector
+
+    return detector(reference_strata(data), current_period, *MISMATCH_ARGUMENTS)
+
+
+def frame_input(data, current_period):
+    """
+    Gets the input of the reference run for a path given the data itself.
+    :param data: DataFrame of the input data.
+    :param current_period: The current period of the run.
+    :return: List of tuples of the data and current period of each reference run.
+    """
+    return [(data, current_period)]
+
+
+def json_input(data, current_period):
+    """
+    Gets the input of the reference run for a path sent the data as records JSON, read
+    as the method originally read it.
+    :param data: DataFrame of the input data.
+    :param current_period: The current period of the run.
+    :return: List of tuples of the data and current period of each reference run.
+    """
+    if len(data) == 0:
+        # Records JSON of no rows carries no column names, which the paths add back.
+        return [(data, current_period)]
+
+    return [(pd.read_json(io.StringIO(data.to_json(orient="records")), dtype=False),
+             current_period)]
+
+
+def period_pair_input(data, current_period):
+    """
+    Gets the input of the reference runs for a multi-period path, which are separate
+    runs over each period and the period before it in the data.
+    :param data: DataFrame of the input data.
+    :param current_period: The current period of the run, which is unused.
+    :return: List of tuples of the data and current period of each reference run.
+    """
+    periods = sorted(data[PERIOD_COLUMN].unique())
+    pairs = []
+    for position, period in enumerate(periods):
+        pair_periods = periods[max(position - 1, 0):position + 1]
+        pairs.append((data[data[PERIOD_COLUMN].isin(pair_periods)], str(period)))
+
+    return pairs
+
+
+def run_method(data, current_period, index=None):
+    """
+    Runs the columnar strata and mismatch detection, as the method does.
+    :param data: DataFrame of the input data.
+    :param current_period: The current period of the run.
+    :param index: ReferenceIndex of the data, built if not given.
+    :return: Tuple of the DataFrames of the data and anomalies.
+    """
+    post_strata = strata_period_method.assign_strata(data, **STRATA_ARGUMENTS)
+
+    return strata_period_method.strata_mismatch_detector(
+        post_strata, current_period, *MISMATCH_ARGUMENTS, index)
+
+
+def columnar_path(data, current_period, generator):
+    """
+    Runs the columnar strata and mismatch detection on the data as it is.
+    :param data: DataFrame of the input data.
+    :param current_period: The current period of the run.
+    :param generator: Numpy random Generator, for paths with random settings.
+    :return: List of tuples of the DataFrames of the data and anomalies.
+    """
+    return [run_method(data, current_period)]
+
+
+def compact_path(data, current_period, generator):
+    """
+    Runs the columnar strata and mismatch detection on the compact dtypes.
+    :param data: DataFrame of the input data.
+    :param current_period: The current period of the run.
+    :param generator: Numpy random Generator, for paths with random settings.
+    :return: List of tuples of the DataFrames of the data and anomalies.
+    """
+    return [run_method(compact_dataframe(data), current_period)]
+
+
+def strata_store_path(data, current_period, generator):
+    """
+    Calculates the strata of the current period and looks the rest up from a strata
+    store, as an earlier run would have written it with some references missing.
+    :param data: DataFrame of the input data.
+    :param current_period: The current period of the run.
+    :param generator: Numpy random Generator, for paths with random settings.
+    :return: List of tuples of the DataFrames of the data and anomalies.
+    """
+    earlier_data = data[(data[PERIOD_COLUMN] != int(current_period)).to_numpy() &
+                        (generator.random(len(data)) < 0.7)]
+    store = strata_io.update_strata_store(
+        pd.DataFrame(),
+        strata_period_method.assign_strata(earlier_data, **STRATA_ARGUMENTS)[
+            [REFERENCE, PERIOD_COLUMN, SEGMENTATION]],
+        [REFERENCE, PERIOD_COLUMN])
+
+    post_strata, _ = strata_period_method.assign_strata_from_store(
+        data, store, current_period, PERIOD_COLUMN, REFERENCE, **STRATA_ARGUMENTS)
+
+    return [strata_period_method.strata_mismatch_detector(
+        post_strata, current_period, *MISMATCH_ARGUMENTS)]
+
+
+def periods_path(data, current_period, generator):
+    """
+    Runs the mismatch detection of every period, with one reference index.
+    :param data: DataFrame of the input data.
+    :param current_period: The current period of the run, which is unused.
+    :param generator: Numpy random Generator, for paths with random settings.
+    :return: List of tuples of the DataFrames of the data and anomalies.
+    """
+    post_strata = strata_period_method.assign_strata(data, **STRATA_ARGUMENTS)
+    periods = [int(period) for period in np.unique(post_strata[PERIOD_COLUMN])]
+
+    return [(strata_check, anomalies) for _, strata_check, anomalies in
+            strata_period_method.strata_mismatch_periods(post_strata, periods,
+                                                         *MISMATCH_ARGUMENTS)]
+
+
+def json_path(data, current_period, generator):
+    """
+    Sends the data to the method as records JSON, decoded with the JSON codec.
+    :param data: DataFrame of the input data.
+    :param current_period: The current period of the run.
+    :param generator: Numpy random Generator, for paths with random settings.
+    :return: List of tuples of the DataFrames of the data and anomalies.
+    """
+    payload = strata_io.encode_dataframe(data)
+    method_data = strata_io.add_missing_columns(
+        compact_dataframe(strata_io.decode_dataframe(payload)), PROJECTED_COLUMNS)
+
+    return [run_method(method_data, current_period)]
+
+
+def read_saved_records(client, file_name):
+    """
+    Reads a records JSON file the lambdas saved to the mock bucket.
+    :param client: Boto3 s3 client of the mock bucket.
+    :param file_name: Name of the file.
+    :return: DataFrame of the records, with no rows if the file wasn't saved.
+    """
+    saved_files = client.list_objects_v2(Bucket=BUCKET_NAME).get("Contents", [])
+    if file_name not in [saved_file["Key"] for saved_file in saved_files]:
+        return pd.DataFrame()
+
+    body = client.get_object(Bucket=BUCKET_NAME, Key=file_name)["Body"].read()
+    return pd.DataFrame(json.loads(body))
+
+
+def run_lambdas(data, current_period, runtime_variables):
+    """
+    Runs the wrangler handler on the data in a mock bucket, with the method handler run
+    in process as strata_replay runs it, and reads back the data and anomalies they
+    saved. The notifications aren't part of the output, so they aren't sent.
+    :param data: DataFrame of the input data.
+    :param current_period: The current period of the run.
+    :param runtime_variables: Dict of the RuntimeVariables of the path's settings.
+    :return: List of tuples of the DataFrames of the data and anomalies.
+    """
+    event = {"RuntimeVariables": dict(WRANGLER_RUNTIME_VARIABLES, period=current_period,
+                                      **runtime_variables)}
+
+    with mock_s3(), mock.patch.dict(os.environ, LAMBDA_ENVIRONMENT), \
+            mock.patch.object(aws_functions, "send_bpm_status"), \
+            mock.patch.object(aws_functions, "send_sns_message_with_anomalies"):
+        strata_cache.clear()
+        try:
+            # The bucket is set up with the lambdas' own cached client, as making
+            # another would load the s3 model again.
+            client = strata_cache.get_resource("s3", REGION_NAME).meta.client
+            client.create_bucket(Bucket=BUCKET_NAME, CreateBucketConfiguration={
+                "LocationConstraint": REGION_NAME})
+            client.put_object(Bucket=BUCKET_NAME, Key=IN_FILE_NAME,
+                              Body=data.to_json(orient="records"))
+            strata_cache.get_client("lambda", strata_replay.LocalLambdaClient)
+
+            strata_period_wrangler.lambda_handler(event, strata_replay.REPLAY_CONTEXT)
+
+            return [(read_saved_records(client, OUT_FILE_NAME),
+                     read_saved_records(client, "Strata_Anomalies"))]
+        finally:
+            # The cached clients belong to the mock bucket.
+            strata_cache.clear()
+
+
+def chunked_path(data, current_period, generator):
+    """
+    Has the method read the data from s3 and stream it a chunk at a time, split into
+    partitions of the references half the time.
+    :param data: DataFrame of the input data.
+    :param current_period: The current period of the run.
+    :param generator: Numpy random Generator, for paths with random settings.
+    :return: List of tuples of the DataFrames of the data and anomalies.
+    """
+    return run_lambdas(data, current_period, {
+        "data_transport": "s3",
+        "chunk_size": int(generator.integers(1, len(data) + 2)),
+        "chunk_partitions": int(generator.integers(2, 5)) if generator.random() < 0.5
+        else 1
+    })
+
+
+def projected_path(data, current_period, generator, data_transport="json"):
+    """
+    Sends only the columns the method needs, and joins the strata back on to the data.
+    :param data: DataFrame of the input data.
+    :param current_period: The current period of the run.
+    :param generator: Numpy random Generator, for paths with random settings.
+    :param data_transport: How the data is passed to the method.
+    :return: List of tuples of the DataFrames of the data and anomalies.
+    """
+    return run_lambdas(data, current_period, {"data_transport": data_transport,
+                                              "project_columns": True})
+
+
+def sharded_path(data, current_period, generator):
+    """
+    Splits the data into shards on the reference, which the method runs separately.
+    :param data: DataFrame of the input data.
+    :param current_period: The current period of the run.
+    :param generator: Numpy random Generator, for paths with random settings.
+    :return: List of tuples of the DataFrames of the data and anomalies.
+    """
+    return run_lambdas(data, current_period,
+                       {"shard_count": int(generator.integers(2, 6))})
+
+
+def patch_path(data, current_period, generator):
+    """
+    Returns only the strata and their patches from the method, which the wrangler
+    applies to the data it holds.
+    :param data: DataFrame of the input data.
+    :param current_period: The current period of the run.
+    :param generator: Numpy random Generator, for paths with random settings.
+    :return: List of tuples of the DataFrames of the data and anomalies.
+    """
+    return run_lambdas(data, current_period, {"patch_output": True})
+
+
+def local_runner_path(data, current_period, generator):
+    """
+    Runs the local runner over shards of the data, in threads rather than processes
+    to keep the cases quick.
+    :param data: DataFrame of the input data.
+    :param current_period: The current period of the run.
+    :param generator: Numpy random Generator, for paths with random settings.
+    :return: List of tuples of the DataFrames of the data and anomalies.
+    """
+    config = dict(STRATA_ARGUMENTS, period_column=PERIOD_COLUMN, reference=REFERENCE,
+                  segmentation=SEGMENTATION, strata_rules=None)
+    with ThreadPoolExecutor(2) as executor:
+        return [strata_local_runner.run_strata_parallel(
+            data, current_period, config, executor, int(generator.integers(2, 6)))]
+
+
+# Each optimised path, and the input its reference runs are given.
+PATHS = {
+    "columnar": (columnar_path, frame_input),
+    "compact": (compact_path, frame_input),
+    "strata_store": (strata_store_path, frame_input),
+    "periods": (periods_path, period_pair_input),
+    "json": (json_path, json_input),
+    "chunked": (chunked_path, json_input),
+    "projected": (projected_path, json_input),
+    "parquet": (partial(projected_path, data_transport="parquet"), json_input),
+    "sharded": (sharded_path, json_input),
+    "patch": (patch_path, json_input),
+    "local_runner": (local_runner_path, frame_input)
+}
+
+
+def run_outputs(run_function):
+    """
+    Runs a path or reference, getting the records of its outputs as they would be
+    saved. Numbers compare by value, as the row-wise apply turns ints into floats when
+    every column is numeric, and streamed chunks are each given their own dtypes. The
+    generated data is all valid input, so an exception is always a failure, even when
+    the other side raises too.
+    :param run_function: Function returning a list of tuples of the DataFrames of the
+        data and anomalies.
+    :return: List of tuples of the lists of the data and anomalies records, or the
+        exception raised.
+    """
+    try:
+        return [(json.loads(output_data.to_json(orient="records")),
+                 json.loads(anomalies.to_json(orient="records")))
+                for output_data, anomalies in run_function()]
+    except Exception as e:
+        return e
+
+
+def reference_outputs(data, path_input, current_period=CURRENT_PERIOD):
+    """
+    Runs the reference on the input of a path.
+    :param data: DataFrame of the input data.
+    :param path_input: Function getting the input of the reference runs.
+    :param current_period: The current period of the run.
+    :return: List of tuples of the data and anomalies JSON, or the exception raised.
+    """
+    def run():
+        return [reference_run(run_data, run_period)
+                for run_data, run_period in path_input(data, current_period)]
+
+    return run_outputs(run)
+
+
+def path_outputs(data, path, seed, current_period=CURRENT_PERIOD):
+    """
+    Runs an optimised path, seeding any random settings it has.
+    :param data: DataFrame of the input data.
+    :param path: Name of the path, one of PATHS.
+    :param seed: Seed for the path's random settings.
+    :param current_period: The current period of the run.
+    :return: List of tuples of the data and anomalies JSON, or the exception raised.
+    """
+    path_function = PATHS[path][0]
+    generator = np.random.default_rng(seed)
+
+    return run_outputs(lambda: path_function(data, current_period, generator))
+
+
+def describe_output(outputs):
+    """
+    Describes the outputs of a run briefly, naming the exception if it raised one.
+    :param outputs: Outputs of the reference or a path, from run_outputs.
+    :return: String describing the outputs.
+    """
+    if isinstance(outputs, Exception):
+        return f"{type(outputs).__name__} raised: {str(outputs)[:200]}"
+
+    return f"{len(outputs)} runs"
+
+
+def describe_difference(expected, produced):
+    """
+    Describes the first difference between the outputs of the reference and a path.
+    :param expected: Outputs of the reference, from run_outputs.
+    :param produced: Outputs of the path, from run_outputs.
+    :return: String describing the difference, or None if they are the same.
+    """
+    if isinstance(expected, Exception) or isinstance(produced, Exception):
+        return f"expected {describe_output(expected)}, got {describe_output(produced)}"
+    if expected == produced:
+        return None
+    if len(expected) != len(produced):
+        return f"expected {len(expected)} runs, got {len(produced)}"
+
+    for run, (expected_run, produced_run) in enumerate(zip(expected, produced)):
+        for name, expected_records, produced_records in zip(
+                ["data", "anomalies"], expected_run, produced_run):
+            if len(expected_records) != len(produced_records):
+                return f"run {run} {name}: expected {len(expected_records)} rows, " \
+                       f"got {len(produced_records)}"
+            for row, (expected_record, produced_record) in enumerate(
+                    zip(expected_records, produced_records)):
+                if expected_record != produced_record:
+                    return f"run {run} {name} row {row}: expected {expected_record}, " \
+                           f"got {produced_record}"
+
+
+def shrink_case(data, path, seed):
+    """
+    Shrinks the data of a failing case by dropping references, then rows, for as long
+    as the path still differs from the reference, so the failure is easier to read.
+    :param data: DataFrame of the failing input data.
+    :param path: Name of the failing path.
+    :param seed: Seed of the path's random settings.
+    :return: DataFrame of the smallest failing data found.
+    """
+    def fails(candidate):
+        return describe_difference(reference_outputs(candidate, PATHS[path][1]),
+                                   path_outputs(candidate, path, seed)) is not None
+
+    for column in [REFERENCE, None]:
+        position = 0
+        while True:
+            keys = data[column].unique() if column else data.index
+            if position >= len(keys) or len(data) == 1:
+                break
+            keep = data[column] != keys[position] if column else \
+                data.index != keys[position]
+            candidate = data[keep].reset_index(drop=True)
+            if len(candidate) > 0 and fails(candidate):
+                data = candidate
+            else:
+                position += 1
+
+    return data
+
+
+def check_case(data, seed, paths=None):
+    """
+    Runs each optimised path over the data and compares it with the reference.
+    :param data: DataFrame of the input data.
+    :param seed: Seed of the paths' random settings.
+    :param paths: List of the names of the paths to check, defaults to all of them.
+    :return: List of dicts of the path and difference of each failing path.
+    """
+    references = {}
+    failures = []
+    for path in paths or list(PATHS):
+        path_input = PATHS[path][1]
+        if path_input not in references:
+            references[path_input] = reference_outputs(data, path_input)
+
+        difference = describe_difference(references[path_input],
+                                         path_outputs(data, path, seed))
+        if difference is not None:
+            failures.append({"path": path, "difference": difference})
+
+    return failures
+
+
+def run_cases(cases, seed=0, max_references=20, paths=None, shrink=True):
+    """
+    Checks the paths over random cases of edge case data, each with its own seed so a
+    failure can be replayed on its own. Some cases have no rows or a single row, and
+    the rest one to three periods.
+    :param cases: Number of cases to run.
+    :param seed: Seed of the first case.
+    :param max_references: Most references in a case.
+    :param paths: List of the names of the paths to check, defaults to all of them.
+    :param shrink: Whether to shrink the data of each failure.
+    :return: List of dicts of the seed, path, difference and data of each failure.
+    """
+    failures = []
+    for case_seed in range(seed, seed + cases):
+        generator = np.random.default_rng(case_seed)
+        shape = generator.random()
+        if shape < EMPTY_CASE_RATE:
+            data = generate_edge_case_data(0, CURRENT_PERIOD, seed=case_seed)
+        elif shape < EMPTY_CASE_RATE + SINGLE_ROW_CASE_RATE:
+            data = generate_edge_case_data(1, CURRENT_PERIOD, duplicate_rate=0,
+                                           seed=case_seed, period_count=1)
+        else:
+            references = int(generator.integers(1, max_references + 1))
+            data = generate_edge_case_data(references, CURRENT_PERIOD, seed=case_seed,
+                                           period_count=int(generator.integers(1, 4)))
+
+        for failure in check_case(data, case_seed, paths):
+            failure_data = data
+            if shrink:
+                failure_data = shrink_case(data, failure["path"], case_seed)
+            failures.append(dict(failure, seed=case_seed, data=failure_data))
+
+    return failures
+
+
+def time_run(run_function, rows):
+    """
+    Runs a path or reference once, measuring its time and peak RSS.
+    :param run_function: Function returning the outputs, from run_outputs.
+    :param rows: Number of rows it processes.
+    :return: Tuple of the outputs and a dict of the measurements.
+    """
+    gc.collect()
+    reset_peak_rss()
+    start = time.perf_counter()
+    outputs = run_function()
+    seconds = time.perf_counter() - start
+
+    return outputs, {"seconds": seconds,
+                     "rows_per_second": rows / seconds if seconds > 0 else float("inf"),
+                     "peak_rss_mb": peak_rss_mb()}
+
+
+def run_benchmark(rows, seed=0, paths=None):
+    """
+    Runs the reference and each optimised path over edge case data at scale, timing
+    them and checking their outputs match.
+    :param rows: Roughly the number of rows to generate.
+    :param seed: Seed for the data and the paths' random settings.
+    :param paths: List of the names of the paths to run, defaults to all of them.
+    :return: Dict of each path's measurements, including its speedup over the
+        reference and whether its output matched.
+    """
+    # References have one, two or three periods, two on average.
+    data = generate_edge_case_data(max(rows // 2, 1), CURRENT_PERIOD, seed=seed)
+    rows = len(data)
+
+    references = {}
+    results = {}
+    for path in paths or list(PATHS):
+        path_input = PATHS[path][1]
+        if path_input not in references:
+            references[path_input] = time_run(
+                lambda: reference_outputs(data, path_input), rows)
+            results[f"reference_{path_input.__name__[:-len('_input')]}"] = \
+                references[path_input][1]
+
+        outputs, results[path] = time_run(lambda: path_outputs(data, path, seed), rows)
+        reference, reference_measurements = references[path_input]
+        results[path]["speedup"] = reference_measurements["seconds"] / \
+            results[path]["seconds"]
+        results[path]["difference"] = describe_difference(reference, outputs)
+
+    return results
+
+
+def parse_arguments(argv=None):
+    """
+    Parses the command line arguments.
+    :param argv: List of the arguments, defaults to sys.argv.
+    :return: Namespace of the parsed arguments.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--cases", type=int, default=200,
+                        help="Number of random cases to check.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--max-references", type=int, default=20,
+                        help="Most references in each case.")
+    parser.add_argument("--paths", nargs="+", choices=list(PATHS),
+                        help="Paths to check, defaults to all of them.")
+    parser.add_argument("--rows", type=int, nargs="+",
+                        help="Benchmark the paths against the reference at these "
+                             "row counts, rather than checking random cases.")
+    parser.add_argument("--json-codec", choices=sorted(strata_io.JSON_CODECS),
+                        help="JSON codec to decode with, defaults to the fastest "
+                             "installed.")
+
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    """
+    Checks the random cases, or runs the benchmarks, printing any differences.
+    :param argv: List of the arguments, defaults to sys.argv.
+    :return: Exit code, 1 if any path differs from the reference.
+    """
+    arguments = parse_arguments(argv)
+    strata_io.set_json_codec(arguments.json_codec)
+
+    if arguments.rows:
+        differences = 0
+        for rows in arguments.rows:
+            results = run_benchmark(rows, arguments.seed, arguments.paths)
+            print(f"{rows} rows")
+            for name, measurements in results.items():
+                speedup = measurements.get("speedup")
+                print(f"  {name:<20}{measurements['seconds']:>10.3f}s"
+                      f"{measurements['rows_per_second']:>14.0f} rows/s"
+                      f"{measurements['peak_rss_mb']:>10.0f} MB" +
+                      (f"{speedup:>10.1f}x" if speedup is not None else ""))
+                if measurements.get("difference"):
+                    differences += 1
+                    print(f"    Differs: {measurements['difference']}")
+
+        return 1 if differences else 0
+
+    failures = run_cases(arguments.cases, arguments.seed, arguments.max_references,
+                         arguments.paths)
+    for failure in failures:
+        print(f"Case {failure['seed']} {failure['path']}: {failure['difference']}")
+        print(failure["data"].to_string())
+    print(f"{arguments.cases} cases, {len(failures)} failures")
+
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,203 @@
+import numpy as np
+import pandas as pd
+
+# Region codes and names, with a county and gor code for each, as in the test data.
+REGIONS = {
+    1: ("North East", 11, "AA", "NORTHUMBERLAND"),
+    2: ("North West", 21, "BB", "CUMBRIA"),
+    3: ("Yorkshire & Humber", 31, "CC", "NORTH YORKSHIRE"),
+    4: ("East Midlands", 41, "DD", "DERBYSHIRE"),
+    5: ("West Midlands", 51, "EE", "STAFFORDSHIRE"),
+    6: ("East of England", 61, "FF", "ESSEX"),
+    7: ("London", 71, "GG", "GREATER LONDON"),
+    8: ("South East", 81, "HH", "KENT"),
+    9: ("South West", 91, "JJ", "DEVON"),
+    10: ("Wales", 65, "KK", "GWYNEDD"),
+    11: ("Wales", 66, "KK", "POWYS"),
+    12: ("Scotland", 64, "KJ", "TAYSIDE & FIFE")
+}
+
+# Values either side of each strata threshold, so every boundary is exercised.
+BOUNDARY_VALUES = [0, 29999, 30000, 79999, 80000, 129999, 130000, 200000, 200001]
+
+# The values, regions and surveys which differential testing concentrates on: the values
+# either side of the E/D, C/B and B/A thresholds, the regions either side of the B1/B2
+# split, and the land and marine surveys along with an unknown survey and a None.
+EDGE_VALUES = [29999, 30000, 129999, 130000, 200000, 200001]
+EDGE_REGIONS = [9, 10]
+EDGE_SURVEYS = ["066", "076", "999", None]
+EDGE_SURVEY_WEIGHTS = [0.6, 0.2, 0.1, 0.1]
+
+
+def previous_periods(current_period, period_count):
+    """
+    Gets the current period and the quarterly periods before it.
+    :param current_period: The current period, as YYYYMM.
+    :param period_count: Number of periods, including the current one.
+    :return: List of the periods as ints, most recent first.
+    """
+    year, month = divmod(int(current_period), 100)
+    periods = []
+    for _ in range(period_count):
+        periods.append(year * 100 + month)
+        month -= 3
+        if month < 1:
+            year -= 1
+            month += 12
+
+    return periods
+
+
+def generate_strata_data(rows, period_count=2, anomaly_rate=0.05,
+                         survey_mix=None, current_period="201809",
+                         boundary_rate=0.01, seed=0):
+    """
+    Generates data shaped like the method input, with a row for each reference in each
+    period. A reference's value is redrawn between periods at the anomaly rate, which
+    usually moves it into a different strata.
+    :param rows: Number of rows to generate, rounded down to a whole number of periods.
+    :param period_count: Number of periods each reference has a row for.
+    :param anomaly_rate: Proportion of rows whose value is redrawn from the previous
+        period.
+    :param survey_mix: Dict of survey code to the proportion of references in it.
+        Defaults to 80% 066 and 20% 076.
+    :param current_period: The current period, as YYYYMM.
+    :param boundary_rate: Proportion of values taken from BOUNDARY_VALUES.
+    :param seed: Seed for the random number generator.
+    :return: DataFrame of the generated data.
+    """
+    if survey_mix is None:
+        survey_mix = {"066": 0.8, "076": 0.2}
+
+    generator = np.random.default_rng(seed)
+    references = max(rows // period_count, 1)
+    periods = previous_periods(current_period, period_count)
+
+    surveys = generator.choice(list(survey_mix), size=references,
+                               p=np.array(list(survey_mix.values())) /
+                               sum(survey_mix.values()))
+    regions = generator.choice(list(REGIONS), size=references)
+    region_details = pd.DataFrame.from_dict(
+        REGIONS, orient="index",
+        columns=["region_name", "county", "gor_code", "county_name"]).loc[regions]
+
+    values = draw_values(generator, references, boundary_rate)
+    period_data = []
+    for period in periods:
+        redraw = generator.random(references) < anomaly_rate
+        values = np.where(redraw, draw_values(generator, references, boundary_rate),
+                          values)
+
+        questions = generator.integers(0, 10000, size=(references, 7))
+        period_data.append(pd.DataFrame({
+            "Q601_asphalting_sand": questions[:, 0],
+            "Q602_building_soft_sand": questions[:, 1],
+            "Q603_concreting_sand": questions[:, 2],
+            "Q604_bituminous_gravel": questions[:, 3],
+            "Q605_concreting_gravel": questions[:, 4],
+            "Q606_other_gravel": questions[:, 5],
+            "Q607_constructional_fill": questions[:, 6],
+            "Q608_total": values,
+            "county": region_details["county"].to_numpy(),
+            "county_name": region_details["county_name"].to_numpy(),
+            "enterprise_ref": generator.integers(1, 10, size=references),
+            "gor_code": region_details["gor_code"].to_numpy(),
+            "marine": np.where(surveys == "076", "y", "n"),
+            "name": "Synthetic",
+            "period": period,
+            "region": regions,
+            "region_name": region_details["region_name"].to_numpy(),
+            "responder_id": 49910000000 + np.arange(references),
+            "response_type": generator.integers(1, 3, size=references),
+            "survey": surveys
+        }))
+
+    # Oldest period first, as the data is usually built up.
+    return pd.concat(period_data[::-1], ignore_index=True)
+
+
+def draw_values(generator, size, boundary_rate):
+    """
+    Draws Q608 total values, mostly log-uniform up to a million with some taken from
+    the strata boundaries.
+    :param generator: Numpy random Generator.
+    :param size: Number of values to draw.
+    :param boundary_rate: Proportion of values taken from BOUNDARY_VALUES.
+    :return: Numpy array of int values.
+    """
+    values = np.exp(generator.uniform(0, np.log(1000000), size=size)).astype(np.int64)
+    on_boundary = generator.random(size) < boundary_rate
+
+    return np.where(on_boundary, generator.choice(BOUNDARY_VALUES, size=size), values)
+
+
+def generate_edge_case_data(references, current_period="201809", none_rate=0.1,
+                            duplicate_rate=0.05, seed=0, period_count=3):
+    """
+    Generates the method input columns for differential testing, concentrated on the
+    edge cases of the strata and the mismatch detection: values on the strata
+    thresholds, regions either side of the B1/B2 split, None values, unknown surveys,
+    and references with one, two or three periods, which now and then have more than
+    one row in a period. Half the time the rows are shuffled, and otherwise they are
+    left in reference and period order, which the mismatch detection doesn't sort.
+    Without any references, it gives the columns with no rows.
+    :param references: Number of references to generate.
+    :param current_period: The current period, as YYYYMM.
+    :param none_rate: Proportion of values, regions and surveys which are None.
+    :param duplicate_rate: Proportion of rows which appear twice in their period.
+    :param seed: Seed for the random number generator.
+    :param period_count: Most periods each reference has, up to three, ending with the
+        current period.
+    :return: DataFrame of the generated data.
+    """
+    generator = np.random.default_rng(seed)
+    periods = np.array(previous_periods(current_period, period_count)[::-1])
+
+    # Each reference gets a random number of the periods, up to period_count, in period
+    # order.
+    period_counts = generator.integers(1, period_count + 1, size=references)
+    period_ranks = np.argsort(generator.random((references, period_count)), axis=1)
+    reference_rows, period_rows = np.nonzero(period_ranks < period_counts[:, None])
+    repeats = 1 + (generator.random(len(reference_rows)) < duplicate_rate)
+    reference_rows = np.repeat(reference_rows, repeats)
+    period_rows = np.repeat(period_rows, repeats)
+    rows = len(reference_rows)
+
+    # Surveys and regions mostly stay with the reference, and values are redrawn at
+    # random, so references both keep and change their strata.
+    surveys = np.array(EDGE_SURVEYS, dtype=object)[generator.choice(
+        len(EDGE_SURVEYS), size=references, p=EDGE_SURVEY_WEIGHTS)][reference_rows]
+    changed = generator.random(rows) < 0.05
+    surveys[changed] = np.array(EDGE_SURVEYS, dtype=object)[
+        generator.choice(len(EDGE_SURVEYS), size=changed.sum(), p=EDGE_SURVEY_WEIGHTS)]
+
+    regions = np.where(generator.random(references) < 0.8,
+                       generator.choice(EDGE_REGIONS, size=references),
+                       generator.choice(list(REGIONS), size=references))
+    regions = regions[reference_rows].astype(float)
+
+    values = np.where(generator.random(references) < 0.6,
+                      generator.choice(EDGE_VALUES, size=references),
+                      draw_values(generator, references, 0.2))[reference_rows]
+    redraw = generator.random(rows) < 0.4
+    values[redraw] = np.where(generator.random(redraw.sum()) < 0.6,
+                              generator.choice(EDGE_VALUES, size=redraw.sum()),
+                              draw_values(generator, redraw.sum(), 0.2))
+    values = values.astype(object)
+
+    surveys[generator.random(rows) < none_rate] = None
+    regions[generator.random(rows) < none_rate] = np.nan
+    values[generator.random(rows) < none_rate] = None
+
+    data = pd.DataFrame({
+        "responder_id": 49910000000 + reference_rows,
+        "period": periods[period_rows],
+        "survey": surveys,
+        "region": regions,
+        "Q608_total": values
+    })
+    if generator.random() < 0.5:
+        data = data.take(generator.permutation(rows))
+        data.index = pd.RangeIndex(rows)
+
+    return data
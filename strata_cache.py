@@ -0,0 +1,77 @@
+"""
+Caches kept for the life of a lambda container, so warm invocations reuse the boto3
+clients and validated environment config made by the first one.
+"""
+import boto3
+
+clients = {}
+environments = {}
+schemas = {}
+
+
+def get_client(service_name, create_client=None, region_name="eu-west-2"):
+    """
+    Gets a boto3 client, creating it on first use.
+    :param service_name: Name of the AWS service.
+    :param create_client: Function to create the client with, defaults to boto3.client.
+    :param region_name: Name of the AWS region.
+    :return: Boto3 client.
+    """
+    key = ("client", service_name, region_name)
+    if key not in clients:
+        if create_client is None:
+            create_client = boto3.client
+        clients[key] = create_client(service_name, region_name=region_name)
+
+    return clients[key]
+
+
+def get_resource(service_name, region_name="eu-west-2"):
+    """
+    Gets a boto3 resource, creating it on first use.
+    :param service_name: Name of the AWS service.
+    :param region_name: Name of the AWS region.
+    :return: Boto3 service resource.
+    """
+    key = ("resource", service_name, region_name)
+    if key not in clients:
+        clients[key] = boto3.resource(service_name, region_name=region_name)
+
+    return clients[key]
+
+
+def get_schema(schema_class):
+    """
+    Gets an instance of a marshmallow schema, creating it on first use.
+    :param schema_class: Schema class.
+    :return: Schema instance.
+    """
+    if schema_class not in schemas:
+        schemas[schema_class] = schema_class()
+
+    return schemas[schema_class]
+
+
+def load_environment(schema_class, environ):
+    """
+    Validates the environment variables with a schema, only validating again if they
+    change.
+    :param schema_class: Schema class to load the environment variables with.
+    :param environ: Mapping of the environment variables, os.environ.
+    :return: Dict of the loaded environment variables.
+    """
+    key = (schema_class, tuple(sorted(environ.items())))
+    if key not in environments:
+        environments.clear()
+        environments[key] = get_schema(schema_class).load(environ)
+
+    return dict(environments[key])
+
+
+def clear():
+    """
+    Empties the caches, as in a new container.
+    """
+    clients.clear()
+    environments.clear()
+    schemas.clear()
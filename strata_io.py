@@ -0,0 +1,1465 @@
+import base64
+import codecs
+import hashlib
+import io
+import json
+import os
+import re
+import zlib
+from datetime import datetime, timezone
+from itertools import islice
+from operator import itemgetter
+
+import numpy as np
+import pandas as pd
+from botocore.exceptions import ClientError
+from marshmallow import ValidationError, fields
+
+import strata_cache
+
+# Ways the data can be passed between the wrangler and the method.
+# json: Records JSON in the payload, the original format.
+# parquet: Base64 encoded Parquet in the payload, holding only the columns the method
+#   needs.
+# s3: Only the bucket and file names are in the payload, and the method reads and
+#   writes the data in s3 itself.
+DATA_TRANSPORTS = ["json", "parquet", "s3"]
+
+# Smallest size of each part but the last of an s3 multipart upload.
+MULTIPART_PART_SIZE = 8 * 1024 * 1024
+
+# Size of the blocks the input is read from s3 in when streaming.
+READ_BLOCK_SIZE = 1024 * 1024
+
+# Whitespace and the array brackets and commas between records, which are skipped
+# when streaming records JSON.
+RECORD_SEPARATORS = re.compile(r"[\s\[\],]*")
+
+# Most distinct values a string column can have, as a proportion of its rows, to be
+# stored as a categorical by compact_dataframe.
+CATEGORY_MAX_RATIO = 0.5
+
+# Column added to projected data so the method's output can be joined back on.
+ROW_NUMBER_COLUMN = "strata_row_number"
+
+# Prefix of the result cache in the bucket. Each entry is a folder, named by its key,
+# of the output data of each period and a manifest written once the data is in place.
+RESULT_CACHE_PREFIX = "strata_result_cache/"
+
+# Formats the output data and anomalies can be saved to s3 in.
+# json: Records JSON, the original format, saved in one put.
+# gzip, zstd: Records JSON compressed as it is streamed with a multipart upload.
+# parquet: Parquet streamed a row group at a time with a multipart upload.
+OUTPUT_FORMATS = ["json", "gzip", "zstd", "parquet"]
+
+# Content type each output format is saved with, so readers can tell the format from
+# the object's metadata as well as from its first bytes.
+OUTPUT_CONTENT_TYPES = {
+    "json": "application/json",
+    "gzip": "application/gzip",
+    "zstd": "application/zstd",
+    "parquet": "application/vnd.apache.parquet"
+}
+
+# Bytes each output format other than json starts with.
+OUTPUT_MAGIC_BYTES = {
+    "gzip": b"\x1f\x8b",
+    "zstd": b"\x28\xb5\x2f\xfd",
+    "parquet": b"PAR1"
+}
+
+# Rows in each row group of a Parquet output.
+OUTPUT_ROW_GROUP_SIZE = 100000
+
+# Rows encoded to JSON at a time when writing a DataFrame as json, gzip or zstd output.
+OUTPUT_JSON_CHUNK_SIZE = 100000
+
+# Column names pandas read_json converts to dates by default, which the fast path of
+# the orjson codec leaves to pandas.
+DATE_COLUMN_SUFFIXES = ("_at", "_time")
+DATE_COLUMN_PREFIXES = ("timestamp",)
+DATE_COLUMN_NAMES = ("modified", "date", "datetime")
+
+# Range of the integers the fast path of the orjson codec reads as int64, beyond which
+# pandas reads them as objects.
+INT64_MIN = np.iinfo(np.int64).min
+INT64_MAX = np.iinfo(np.int64).max
+
+
+class JsonCodec:
+    """
+    Encodes and decodes the JSON passed between the lambdas and saved to s3 with the
+    standard library and pandas, the original behaviour. Faster codecs override its
+    methods, but must give the same output.
+    """
+
+    def loads(self, data):
+        """
+        Decodes a JSON document.
+        :param data: String or bytes of the JSON.
+        :return: The decoded object.
+        """
+        return json.loads(data)
+
+    def dumps(self, data):
+        """
+        Encodes an object as a JSON document.
+        :param data: Object to encode.
+        :return: String of the JSON.
+        """
+        return json.dumps(data)
+
+    def decode_records(self, data):
+        """
+        Decodes records JSON to a DataFrame. Floats are parsed precisely, to the
+        nearest double as the standard library and orjson parse them, rather than with
+        the faster parser pandas uses by default, which can be out in the last bit.
+        :param data: String of the records JSON.
+        :return: DataFrame of the records.
+        """
+        return pd.read_json(data, dtype=False, precise_float=True)
+
+    def encode_records(self, data):
+        """
+        Encodes a DataFrame as records JSON.
+        :param data: DataFrame to encode.
+        :return: String of the records JSON.
+        """
+        return data.to_json(orient="records")
+
+
+class OrjsonCodec(JsonCodec):
+    """
+    Decodes JSON with orjson, building each column of records JSON straight into a
+    typed array. Records pandas might read differently, such as those with date like
+    column names, nested values or missing keys, fall back to pandas. Encoding stays
+    with the standard library and pandas, whose output orjson can't reproduce byte for
+    byte: json.dumps puts spaces after separators, and to_json escapes slashes and
+    rounds floats to 10 digits.
+    """
+
+    def __init__(self):
+        import orjson
+        self.orjson = orjson
+        # Whether pandas keeps each set of column names as they are, so a warm
+        # container only asks pandas once per set.
+        self.column_names_kept = {}
+
+    def loads(self, data):
+        return self.orjson.loads(data)
+
+    def decode_records(self, data):
+        try:
+            records = self.orjson.loads(data)
+        except self.orjson.JSONDecodeError:
+            # Such as integers beyond 64 bits, which pandas reads as objects.
+            return super().decode_records(data)
+
+        frame = self.frame_from_records(records)
+        if frame is None:
+            return super().decode_records(data)
+
+        return frame
+
+    def frame_from_records(self, records):
+        """
+        Builds the DataFrame pandas read_json would give for a list of records, a
+        column at a time. orjson parses floats precisely, so they are the same as
+        read_json gives with precise_float.
+        :param records: List of dicts of the decoded records.
+        :return: DataFrame of the records, or None if they need pandas to read them.
+        """
+        if not isinstance(records, list) or not records or \
+                not isinstance(records[0], dict):
+            return None
+
+        columns = list(records[0])
+        if not all(isinstance(column, str) for column in columns) or \
+                any(is_date_column(column) for column in columns):
+            return None
+        # pandas can convert the column names themselves, such as "1" to a number, so
+        # they are checked against pandas reading a record of just the names.
+        column_names = tuple(columns)
+        if column_names not in self.column_names_kept:
+            self.column_names_kept[column_names] = super().decode_records(
+                self.orjson.dumps([dict.fromkeys(columns)]).decode("UTF-8")
+            ).columns.tolist() == columns
+        if not self.column_names_kept[column_names]:
+            return None
+
+        if sum(map(len, records)) != len(records) * len(columns):
+            return None
+
+        data = {}
+        try:
+            for column in columns:
+                values = list(map(itemgetter(column), records))
+                data[column] = column_array(values)
+        except (KeyError, OverflowError, TypeError):
+            return None
+
+        return pd.DataFrame(data, columns=columns)
+
+
+# Codecs the JSON can be encoded and decoded with, by name.
+JSON_CODECS = {"orjson": OrjsonCodec, "stdlib": JsonCodec}
+
+# The codec chosen by set_json_codec, and each codec made so far, so a warm container
+# reuses them.
+json_codec = {"codec": None, "codecs": {}}
+
+
+def is_date_column(column):
+    """
+    Checks whether pandas read_json converts a column to dates by default.
+    :param column: Name of the column.
+    :return: True if the column is converted.
+    """
+    column = column.lower()
+
+    return column.endswith(DATE_COLUMN_SUFFIXES) or \
+        column.startswith(DATE_COLUMN_PREFIXES) or column in DATE_COLUMN_NAMES
+
+
+def column_array(values):
+    """
+    Builds the array pandas would give for a column of decoded JSON values, for the
+    common mixes of types.
+    :param values: List of the column's values.
+    :return: Numpy array of the column.
+    """
+    types = set(map(type, values))
+    if int in types:
+        integers = values if types == {int} else \
+            [value for value in values if type(value) is int]
+        if min(integers) < INT64_MIN or max(integers) > INT64_MAX:
+            raise OverflowError("Integers beyond 64 bits are left to pandas.")
+    if types == {int}:
+        return np.array(values, dtype=np.int64)
+    if types <= {int, float, type(None)} and types & {int, float}:
+        # Nulls become NaN, and integers become floats, alongside floats or nulls.
+        return np.array(values, dtype=np.float64)
+    if types == {bool}:
+        return np.array(values, dtype=bool)
+    if types not in ({str}, {str, type(None)}):
+        raise TypeError(f"Columns of {types} are left to pandas.")
+
+    array = np.empty(len(values), dtype=object)
+    array[:] = values
+    return array
+
+
+def set_json_codec(name=None):
+    """
+    Chooses the codec used by encode_dataframe, decode_dataframe and get_json_codec.
+    :param name: Name of the codec, one of JSON_CODECS. Defaults to orjson if it's
+        installed, otherwise stdlib.
+    :return: The chosen codec.
+    """
+    if name is None:
+        try:
+            import orjson  # noqa: F401
+            name = "orjson"
+        except ImportError:
+            name = "stdlib"
+    if name not in JSON_CODECS:
+        raise ValueError(f"Unknown JSON codec: {name}")
+
+    if name not in json_codec["codecs"]:
+        try:
+            json_codec["codecs"][name] = JSON_CODECS[name]()
+        except ImportError:
+            raise ValueError(f"The {name} JSON codec isn't installed.")
+    json_codec["codec"] = json_codec["codecs"][name]
+
+    return json_codec["codec"]
+
+
+def get_json_codec():
+    """
+    Gets the codec chosen by set_json_codec, choosing the default on first use.
+    :return: The JSON codec.
+    """
+    if json_codec["codec"] is None:
+        return set_json_codec()
+
+    return json_codec["codec"]
+
+
+def encode_dataframe(data, data_transport="json"):
+    """
+    Encodes a DataFrame to a string which can be sent in a lambda payload.
+    :param data: DataFrame to encode.
+    :param data_transport: Encoding to use, one of DATA_TRANSPORTS.
+    :return: String of the encoded data.
+    """
+    if data_transport == "json":
+        return get_json_codec().encode_records(data)
+
+    if data_transport == "parquet":
+        buffer = io.BytesIO()
+        data.to_parquet(buffer, index=False)
+        return base64.b64encode(buffer.getvalue()).decode("ascii")
+
+    raise ValueError(f"Unknown data transport: {data_transport}")
+
+
+def decode_dataframe(data, data_transport="json"):
+    """
+    Decodes a string produced by encode_dataframe back to a DataFrame.
+    :param data: String of the encoded data.
+    :param data_transport: Encoding used, one of DATA_TRANSPORTS.
+    :return: DataFrame of the decoded data.
+    """
+    if data_transport == "json":
+        return get_json_codec().decode_records(data)
+
+    if data_transport == "parquet":
+        return pd.read_parquet(io.BytesIO(base64.b64decode(data)))
+
+    raise ValueError(f"Unknown data transport: {data_transport}")
+
+
+class PeriodsField(fields.Field):
+    """
+    Field for the periods of a multi-period run, given either as a list of periods or
+    as a range, {"start": "201803", "end": "201809"}, which covers every period in the
+    data between the two inclusive.
+    """
+
+    def _deserialize(self, value, attr, data, **kwargs):
+        if isinstance(value, list) and value and \
+                all(str(period).isdigit() for period in value):
+            return [str(period) for period in value]
+        if isinstance(value, dict) and sorted(value) == ["end", "start"] and \
+                all(str(period).isdigit() for period in value.values()):
+            return {"start": str(value["start"]), "end": str(value["end"])}
+        raise ValidationError("Must be a list of periods or a start and end period.")
+
+
+def select_periods(periods, period_values):
+    """
+    Gets the periods a multi-period run covers, from a list or range of periods as
+    loaded by PeriodsField.
+    :param periods: List of periods, or dict of the start and end period.
+    :param period_values: Array like of the period of each row of the data.
+    :return: Sorted list of the periods as ints.
+    """
+    available_periods = np.unique(np.asarray(period_values))
+
+    if isinstance(periods, dict):
+        return [int(period) for period in available_periods
+                if int(periods["start"]) <= period <= int(periods["end"])]
+
+    selected_periods = sorted(set(int(period) for period in periods))
+    missing_periods = [period for period in selected_periods
+                       if period not in available_periods]
+    if missing_periods:
+        raise ValueError(f"Periods not in the data: {missing_periods}")
+
+    return selected_periods
+
+
+def period_file_name(file_name, period):
+    """
+    Gets the name of a period's output file in a multi-period run.
+    :param file_name: Name of the output file of a single period run.
+    :param period: The period of the output.
+    :return: File name with the period added before any extension.
+    """
+    name, extension = os.path.splitext(file_name)
+
+    return f"{name}_{period}{extension}"
+
+
+def compact_dataframe(data, int32_columns=(), int64_columns=()):
+    """
+    Converts the data to compact dtypes. String columns which repeat heavily, such as
+    the survey code and region name, become categoricals, and the given integer columns
+    become fixed width. Integer columns holding nulls, or values out of range, are left
+    as they are. The values, and so the JSON written from them, are unchanged.
+    :param data: DataFrame to convert.
+    :param int32_columns: Column names to store as int32, such as the period and region.
+    :param int64_columns: Column names to store as int64, such as the reference.
+    :return: DataFrame of the converted data.
+    """
+    data = data.copy(deep=False)
+
+    for column in data.columns:
+        values = data[column]
+        if column in int32_columns or column in int64_columns:
+            dtype = np.int32 if column in int32_columns else np.int64
+            limits = np.iinfo(dtype)
+            if pd.api.types.is_integer_dtype(values) and \
+                    values.between(limits.min, limits.max).all():
+                data[column] = values.astype(dtype)
+        elif values.dtype == object and len(values) > 0 and \
+                pd.api.types.infer_dtype(values, skipna=False) == "string" and \
+                values.nunique() <= len(values) * CATEGORY_MAX_RATIO:
+            data[column] = values.astype("category")
+
+    return data
+
+
+def add_missing_columns(data, columns):
+    """
+    Adds any of the given columns the data is missing, as JSON records of no rows
+    carry no column names. Data with rows is returned unchanged, so a missing column
+    still fails as it would have.
+    :param data: DataFrame to add the columns to.
+    :param columns: List of the column names the data should have.
+    :return: DataFrame with the columns.
+    """
+    missing = [column for column in columns if column not in data.columns]
+    if len(data) > 0 or not missing:
+        return data
+
+    data = data.copy(deep=False)
+    for column in missing:
+        data[column] = pd.Series(dtype=object)
+
+    return data
+
+
+def project_dataframe(data, columns):
+    """
+    Selects only the given columns from the data, adding the row number so the
+    results can be joined back on with join_projected_dataframe.
+    :param data: DataFrame to project.
+    :param columns: List of the column names to keep.
+    :return: DataFrame of the projected data.
+    """
+    if ROW_NUMBER_COLUMN in data.columns:
+        raise ValueError(f"Data already contains a {ROW_NUMBER_COLUMN} column.")
+
+    projected_data = data[columns].copy()
+    projected_data[ROW_NUMBER_COLUMN] = np.arange(len(data))
+
+    return projected_data
+
+
+def join_projected_dataframe(data, projected_data, columns):
+    """
+    Joins columns of projected results back onto the full data by row number. A row
+    which appears more than once in the results is repeated in the same way.
+    :param data: DataFrame which was projected.
+    :param projected_data: DataFrame of the results, including the row number.
+    :param columns: List of the column names to take from the results.
+    :return: DataFrame of the full data with the result columns.
+    """
+    projected_data = add_missing_columns(projected_data,
+                                         [ROW_NUMBER_COLUMN] + list(columns))
+    joined_data = data.take(projected_data[ROW_NUMBER_COLUMN].to_numpy(np.int64))
+    joined_data.index = pd.RangeIndex(len(joined_data))
+
+    for column in columns:
+        joined_data[column] = projected_data[column].to_numpy()
+
+    return joined_data
+
+
+class ReferenceIndex:
+    """
+    Index of the rows of each reference in each period of a DataFrame. It is built
+    with one sort, which is skipped when the data is already ordered by reference and
+    period. The mismatch detection, the strata correction and the anomaly pairing then
+    look rows up with array gathers rather than joins. Runs over several periods, or
+    several shards, of the same data can reuse one index through take.
+    The rows are ordered by reference then period, keeping their original order
+    within each, and split into blocks of one reference in one period.
+    """
+
+    def __init__(self, data, reference, time):
+        self.reference = reference
+        self.time = time
+        self.codes, references = pd.factorize(data[reference])
+        self.references = pd.Index(references)
+        self.periods = data[time].to_numpy()
+
+        # Order by reference then period, unless the data is already grouped that way.
+        same_reference = self.codes[1:] == self.codes[:-1]
+        if np.all((self.codes[1:] >= self.codes[:-1]) &
+                  (~same_reference | (self.periods[1:] >= self.periods[:-1]))):
+            order = np.arange(len(self.codes))
+        else:
+            order = np.lexsort((self.periods, self.codes))
+        self.set_order(order)
+
+    def __len__(self):
+        return len(self.codes)
+
+    def set_order(self, order):
+        """
+        Sets the order of the rows by reference and period, and finds the blocks.
+        :param order: Array of the row positions in reference and period order.
+        """
+        self.order = order
+        sorted_codes = self.codes[order]
+        self.sorted_periods = self.periods[order]
+
+        self.new_reference = np.ones(len(order), dtype=bool)
+        self.new_reference[1:] = sorted_codes[1:] != sorted_codes[:-1]
+        new_block = self.new_reference.copy()
+        new_block[1:] |= self.sorted_periods[1:] != self.sorted_periods[:-1]
+        self.block_starts = np.flatnonzero(new_block)
+        self.block_ids = np.cumsum(new_block) - 1
+        self.block_periods = self.sorted_periods[self.block_starts]
+
+    def take(self, rows):
+        """
+        Gets the index of some of the rows, such as the data of a pair of periods,
+        without sorting them again.
+        :param rows: Array of the row positions, in ascending order.
+        :return: ReferenceIndex of the rows, for data.take(rows).
+        """
+        index = ReferenceIndex.__new__(ReferenceIndex)
+        index.reference = self.reference
+        index.time = self.time
+        index.codes = self.codes[rows]
+        index.references = self.references
+        index.periods = self.periods[rows]
+
+        positions = np.full(len(self.codes), -1)
+        positions[rows] = np.arange(len(rows))
+        order = positions[self.order]
+        index.set_order(order[order >= 0])
+
+        return index
+
+    def period_rows(self):
+        """
+        Gets the rows of each period, with one stable sort of the periods.
+        :return: Tuple of the sorted array of the periods, and a list of arrays of the
+            row positions of each, in ascending order.
+        """
+        order = np.argsort(self.periods, kind="mergesort")
+        periods, starts = np.unique(self.periods[order], return_index=True)
+
+        return periods, np.split(order, starts[1:])
+
+    def current_and_previous(self, current_period):
+        """
+        Marks the rows, in reference and period order, of each reference's current
+        period block and of the block before it, if it's the same reference.
+        :param current_period: The current period, as an int.
+        :return: Tuple of boolean arrays of the current and previous rows.
+        """
+        current_blocks = np.flatnonzero(self.block_periods == current_period)
+        previous_blocks = current_blocks[
+            ~self.new_reference[self.block_starts[current_blocks]]] - 1
+
+        in_current = np.zeros(len(self.block_starts), dtype=bool)
+        in_current[current_blocks] = True
+        in_previous = np.zeros(len(self.block_starts), dtype=bool)
+        in_previous[previous_blocks] = True
+
+        return in_current[self.block_ids], in_previous[self.block_ids]
+
+    def first_rows(self, period, references):
+        """
+        Gets the first row of each of the references in a period.
+        :param period: The period, as an int.
+        :param references: Array like of the reference values.
+        :return: Array of the row positions, with len(self) for a reference which
+            isn't in the period.
+        """
+        block_rows = self.order[self.block_starts[self.block_periods == period]]
+        block_rows = block_rows[self.codes[block_rows] >= 0]
+        first_row = np.full(len(self.references) + 1, len(self))
+        first_row[self.codes[block_rows]] = block_rows
+
+        # A reference that isn't indexed gets a code of -1, which takes the len(self)
+        # on the end.
+        return first_row[self.references.get_indexer(references)]
+
+    def pair_rows(self, current_rows, previous_rows):
+        """
+        Pairs each current row with every previous row of the same reference, as an
+        inner merge on the reference would. Like the merge, the pairs are grouped by
+        reference, in the order each first appears in the current rows, then follow
+        the order of the current rows and then the previous rows.
+        :param current_rows: Array of row positions, in ascending order.
+        :param previous_rows: Array of row positions, in ascending order.
+        :return: Tuple of arrays of the current and previous row of each pair.
+        """
+        current_rows = current_rows[np.argsort(
+            pd.factorize(self.codes[current_rows])[0], kind="mergesort")]
+
+        previous_codes = self.codes[previous_rows]
+        previous_order = np.argsort(previous_codes, kind="mergesort")
+        sorted_codes = previous_codes[previous_order]
+
+        current_codes = self.codes[current_rows]
+        starts = np.searchsorted(sorted_codes, current_codes, side="left")
+        counts = np.searchsorted(sorted_codes, current_codes, side="right") - starts
+        offsets = np.repeat(starts - np.cumsum(counts) + counts, counts) + \
+            np.arange(counts.sum())
+
+        return np.repeat(current_rows, counts), previous_rows[previous_order[offsets]]
+
+    def shard_ids(self, shard_count):
+        """
+        Gets the shard of each row, hashing each reference once rather than each row.
+        :param shard_count: Number of shards.
+        :return: Array of the shard id of each row, or None if there are missing
+            references, which only hashing the rows can place.
+        """
+        if (self.codes < 0).any():
+            return None
+
+        reference_shards = pd.util.hash_pandas_object(
+            self.references.to_series(), index=False).to_numpy() % shard_count
+
+        return reference_shards[self.codes]
+
+
+def apply_good_strata(data, reference, segmentation, good_segmentation, index=None):
+    """
+    Patches the strata of every row of a reference found by find_strata_mismatches with
+    its current period strata. Like a merge, a reference with more than one current
+    period strata gets a row for each of them. As each row is patched on its own, the
+    data can be patched a chunk at a time.
+    :param data: DataFrame to patch.
+    :param reference: Field name which is used as a reference for CAC.
+    :param segmentation: Field name of the segmentation used for CAC.
+    :param good_segmentation: Series of reference to its current period strata.
+    :param index: ReferenceIndex of the data, which the good strata are gathered with
+        rather than joined on, when each reference has one.
+    :return: DataFrame of the patched data, with a RangeIndex.
+    """
+    # Patch the strata on a shallow copy so only the strata column is copied.
+    data = data.copy(deep=False)
+    data.index = pd.RangeIndex(len(data))
+    if index is not None and good_segmentation.index.is_unique and \
+            not good_segmentation.index.hasnans:
+        codes = index.references.get_indexer(good_segmentation.index)
+        found = codes >= 0
+        # The extra entry on the end is for rows with a missing reference.
+        has_good = np.zeros(len(index.references) + 1, dtype=bool)
+        has_good[codes[found]] = True
+        good_strata = np.full(len(index.references) + 1, None, dtype=object)
+        good_strata[codes[found]] = good_segmentation.to_numpy()[found]
+        good_data = pd.DataFrame(
+            {good_segmentation.name: np.where(has_good[index.codes],
+                                              good_strata[index.codes], np.nan)})
+    else:
+        # Join the index onto the reference column only.
+        good_data = data[[reference]].join(good_segmentation, on=reference, how="left")
+        if len(good_data) != len(data):
+            data = data.take(good_data.index)
+            data.index = pd.RangeIndex(len(data))
+
+    strata = data[segmentation]
+    if pd.api.types.is_categorical_dtype(strata):
+        # A chunk may not have every strata in its categories. A None good strata is
+        # missing, so it isn't a category.
+        strata = strata.cat.add_categories(
+            pd.Index(good_segmentation.dropna().unique()).difference(
+                strata.cat.categories))
+
+    # Rows without a good strata are left alone, but like the original apply, a None
+    # good strata is still patched on.
+    good_values = good_data[good_segmentation.name].to_numpy()
+    keep = pd.isnull(good_values) & ~np.equal(good_values, None)
+    data[segmentation] = strata.where(keep, good_values)
+
+    return data
+
+
+def encode_strata_patch(strata, good_segmentation):
+    """
+    Encodes the strata of each row, before any are patched, and the good strata of the
+    references with mismatches, which together are far smaller than the patched data.
+    The strata are held as zlib compressed codes into the list of distinct strata, so
+    stable data, where neighbouring rows mostly share a strata, compresses well.
+    :param strata: Series of the strata of each row.
+    :param good_segmentation: Series of reference to its good strata, or None if there
+        are no mismatches.
+    :return: Dict of the encoded strata and patches, which can be sent as JSON.
+    """
+    codes, categories = pd.factorize(np.asarray(strata, dtype=object))
+    code_dtype = np.dtype(np.int8 if len(categories) < 128 else np.int32)
+
+    patches = []
+    if good_segmentation is not None:
+        patches = [list(patch) for patch in zip(good_segmentation.index.tolist(),
+                                                good_segmentation.tolist())]
+
+    return {
+        "categories": categories.tolist(),
+        "codes": base64.b64encode(
+            zlib.compress(codes.astype(code_dtype).tobytes(), 1)).decode("ascii"),
+        "dtype": code_dtype.name,
+        "patches": patches
+    }
+
+
+def apply_strata_patch(data, strata_patch, reference, segmentation):
+    """
+    Decodes the strata from encode_strata_patch and patches them, giving the same
+    output the method returns when it's sent projected data.
+    :param data: DataFrame of the data the method was sent, in the same row order.
+    :param strata_patch: Dict of the encoded strata and patches.
+    :param reference: Column name of the reference.
+    :param segmentation: Column name of the strata.
+    :return: DataFrame of the row number, reference and patched strata of each row.
+    """
+    codes = np.frombuffer(zlib.decompress(base64.b64decode(strata_patch["codes"])),
+                          dtype=strata_patch["dtype"])
+    if len(codes) != len(data):
+        raise ValueError(f"Strata patch has {len(codes)} rows but the data has "
+                         f"{len(data)}.")
+
+    # A code of -1 is a missing strata, which takes the None on the end.
+    categories = np.array(strata_patch["categories"] + [None], dtype=object)
+    output = pd.DataFrame({ROW_NUMBER_COLUMN: np.arange(len(data)),
+                           reference: data[reference].to_numpy(),
+                           segmentation: categories[codes]})
+
+    if strata_patch["patches"]:
+        patch_references, good_strata = zip(*strata_patch["patches"])
+        output = apply_good_strata(output, reference, segmentation,
+                                   pd.Series(good_strata, index=patch_references,
+                                             name="good_" + segmentation))
+
+    return output
+
+
+def shard_dataframe(data, column, shard_count, index=None):
+    """
+    Splits the data into shards on a hash of a column, so that rows with the same value
+    are always in the same shard. Empty shards are left out, though data with no rows
+    is still given as a single shard, so the method still runs on it.
+    :param data: DataFrame to split.
+    :param column: Column name to shard on.
+    :param shard_count: Number of shards to split the data into.
+    :param index: ReferenceIndex of the data on the column, so each value is only
+        hashed once.
+    :return: List of DataFrames of the shards.
+    """
+    shard_ids = None if index is None else index.shard_ids(shard_count)
+    if shard_ids is None:
+        shard_ids = pd.util.hash_pandas_object(data[column], index=False).to_numpy() \
+            % shard_count
+
+    return [data[shard_ids == shard_id] for shard_id in range(shard_count)
+            if (shard_ids == shard_id).any()] or [data]
+
+
+def partition_chunks(chunks, column, partition, partition_count):
+    """
+    Selects the rows of each chunk in one partition of the values of a column, so a
+    value's rows are all in the same partition whichever chunks they are in. Numbers
+    are partitioned by their value, which doesn't change with the dtype a chunk reads
+    them as, missing values are all in the first partition, and anything else is
+    partitioned by a hash of its text. With more than one partition,
+    each row is numbered by its row in the whole data, so the results of the partitions
+    can be merged like those of shards.
+    :param chunks: Iterable of DataFrames of the chunks of data.
+    :param column: Column name to partition on.
+    :param partition: Number of the partition to select, from 0.
+    :param partition_count: Number of partitions.
+    :return: Generator of the rows of each chunk in the partition, leaving out chunks
+        without any.
+    """
+    if partition_count == 1:
+        yield from chunks
+        return
+
+    rows = 0
+    for chunk in chunks:
+        values = chunk[column]
+        numbers = pd.to_numeric(values, errors="coerce").to_numpy(dtype=float)
+        is_number = ~np.isnan(numbers)
+        is_text = ~is_number & values.notna().to_numpy()
+        partition_ids = np.zeros(len(chunk), dtype=np.int64)
+        partition_ids[is_number] = np.floor(np.mod(numbers[is_number], partition_count))
+        if is_text.any():
+            partition_ids[is_text] = pd.util.hash_array(
+                values[is_text].astype(str).to_numpy(dtype=object)) % partition_count
+
+        selected = partition_ids == partition
+        if selected.any():
+            yield chunk[selected].assign(**{
+                ROW_NUMBER_COLUMN: np.arange(rows, rows + len(chunk))[selected]})
+        rows += len(chunk)
+
+
+def merge_shard_data(shard_data):
+    """
+    Combines the results from each shard of projected data back into row order.
+    :param shard_data: List of DataFrames of the results from each shard, including
+        the row number.
+    :return: DataFrame of the combined results.
+    """
+    merged_data = add_missing_columns(pd.concat(shard_data, ignore_index=True),
+                                      [ROW_NUMBER_COLUMN])
+
+    return merged_data.sort_values(ROW_NUMBER_COLUMN, kind="mergesort",
+                                   ignore_index=True)
+
+
+def merge_shard_anomalies(shard_anomalies, data, current_period, period_column,
+                          reference, index=None):
+    """
+    Combines the anomalies found in each shard, ordering them as they would be from a
+    single run, by the row of each reference's first anomaly in the current period.
+    :param shard_anomalies: List of DataFrames of the anomalies from each shard.
+    :param data: DataFrame of the full input data.
+    :param current_period: The current period of the run.
+    :param period_column: Column name of the dataframe containing the period.
+    :param reference: Column name of the dataframe containing the reference.
+    :param index: ReferenceIndex of the data, built if not given. Only needed for
+        anomalies without the row number, from number_anomalies.
+    :return: DataFrame of the combined anomalies.
+    """
+    shard_anomalies = [anomalies for anomalies in shard_anomalies if anomalies.size > 0]
+    if not shard_anomalies:
+        return pd.DataFrame()
+
+    anomalies = pd.concat(shard_anomalies, ignore_index=True)
+    if ROW_NUMBER_COLUMN in anomalies.columns:
+        # Like the merge in a single run, the anomalies are grouped by reference in
+        # the order of each one's first anomaly row, then follow the order of the rows.
+        row_numbers = anomalies[ROW_NUMBER_COLUMN].to_numpy()
+        first_rows = anomalies.groupby(reference)[ROW_NUMBER_COLUMN].transform(
+            "min").to_numpy()
+        return anomalies.iloc[np.lexsort((row_numbers, first_rows))].drop(
+            columns=ROW_NUMBER_COLUMN)
+
+    # Without row numbers, each reference's first row in the current period stands in
+    # for its first anomaly row, which it is unless the reference has duplicate rows.
+    if index is None:
+        index = ReferenceIndex(data, reference, period_column)
+
+    first_rows = index.first_rows(int(current_period), anomalies[reference])
+
+    return anomalies.iloc[np.argsort(first_rows, kind="mergesort")]
+
+
+def number_anomalies(anomalies, data, current_period, period_column, reference,
+                     segmentation, current_segmentation):
+    """
+    Adds the row number of the current period row of each anomaly, so the anomalies of
+    each shard can be merged back into the order of a single run. An anomaly's current
+    strata appears only once in its reference's current period, so it picks out a
+    single row of the data before it was patched.
+    :param anomalies: DataFrame of the anomalies of the data.
+    :param data: DataFrame of the projected data, with its strata before patching.
+    :param current_period: The current period of the run.
+    :param period_column: Column name of the dataframe containing the period.
+    :param reference: Column name of the dataframe containing the reference.
+    :param segmentation: Column name of the strata.
+    :param current_segmentation: Column name of the current strata of the anomalies.
+    :return: DataFrame of the anomalies with the row number.
+    """
+    if len(anomalies) == 0:
+        return anomalies
+
+    current_rows = np.flatnonzero((data[period_column] == int(current_period)).to_numpy())
+    keys = pd.MultiIndex.from_arrays([
+        data[reference].to_numpy()[current_rows],
+        np.asarray(data[segmentation], dtype=object)[current_rows]])
+    first_keys = ~keys.duplicated()
+    positions = keys[first_keys].get_indexer(pd.MultiIndex.from_arrays([
+        anomalies[reference].to_numpy(),
+        np.asarray(anomalies[current_segmentation], dtype=object)]))
+
+    anomalies = anomalies.copy()
+    anomalies[ROW_NUMBER_COLUMN] = \
+        data[ROW_NUMBER_COLUMN].to_numpy()[current_rows[first_keys][positions]]
+
+    return anomalies
+
+
+def read_s3_text(bucket_name, file_name):
+    """
+    Reads a text file from s3.
+    :param bucket_name: Name of the bucket holding the file.
+    :param file_name: Name of the file.
+    :return: String of the file contents.
+    """
+    s3 = strata_cache.get_resource("s3")
+
+    return s3.Object(bucket_name, file_name).get()["Body"].read().decode("UTF-8")
+
+
+def read_strata_store(bucket_name, file_name, columns):
+    """
+    Reads the strata store, a Parquet file of the strata already calculated for each
+    reference and period, from s3. A store which doesn't exist yet is read as empty.
+    :param bucket_name: Name of the bucket holding the store.
+    :param file_name: Name of the store file.
+    :param columns: List of the reference, period and strata column names.
+    :return: DataFrame of the stored strata.
+    """
+    s3 = strata_cache.get_resource("s3")
+    try:
+        store_object = s3.Object(bucket_name, file_name).get()
+    except ClientError as e:
+        if e.response["Error"]["Code"] not in ["NoSuchKey", "404"]:
+            raise
+        return pd.DataFrame(columns=columns)
+
+    return pd.read_parquet(io.BytesIO(store_object["Body"].read()), columns=columns)
+
+
+def update_strata_store(store, strata, key_columns):
+    """
+    Adds newly calculated strata to the store, replacing any already stored for the
+    same reference and period.
+    :param store: DataFrame of the stored strata.
+    :param strata: DataFrame of the new strata, with the same columns as the store.
+    :param key_columns: List of the reference and period column names.
+    :return: DataFrame of the updated store.
+    """
+    if len(store) > 0:
+        strata = pd.concat([store, strata], ignore_index=True)
+
+    # A reference and period which appears more than once in the data is always
+    # recalculated, so it doesn't matter which of its strata is kept.
+    return strata.drop_duplicates(subset=key_columns, keep="last", ignore_index=True)
+
+
+def write_strata_store(store, bucket_name, file_name):
+    """
+    Writes the strata store to s3 as Parquet.
+    :param store: DataFrame of the stored strata.
+    :param bucket_name: Name of the bucket to hold the store.
+    :param file_name: Name of the store file.
+    :return: Number of bytes written.
+    """
+    buffer = io.BytesIO()
+    store.to_parquet(buffer, index=False)
+
+    s3 = strata_cache.get_resource("s3")
+    s3.Object(bucket_name, file_name).put(Body=buffer.getvalue())
+
+    return buffer.tell()
+
+
+def iter_json_records(blocks):
+    """
+    Parses JSON records from blocks of bytes as they arrive, holding only the current
+    block and any record split across blocks. Accepts both records JSON, as written by
+    to_json, and line delimited JSON.
+    :param blocks: Iterable of bytes blocks of the file.
+    :return: Generator of the dict of each record.
+    """
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder("utf-8")()
+    buffer = ""
+
+    for block in blocks:
+        buffer += text_decoder.decode(block)
+        position = 0
+        while True:
+            position = RECORD_SEPARATORS.match(buffer, position).end()
+            try:
+                record, position_end = decoder.raw_decode(buffer, position)
+            except ValueError:
+                # The rest of the record is in the next block.
+                break
+            yield record
+            position = position_end
+        buffer = buffer[position:]
+
+    buffer += text_decoder.decode(b"", final=True)
+    if RECORD_SEPARATORS.match(buffer).end() != len(buffer):
+        raise ValueError(f"Invalid JSON record: {buffer[:100]}")
+
+
+def read_json_chunks(bucket_name, file_name, chunk_size, chunk_function=None):
+    """
+    Streams a records JSON or line delimited JSON file from s3 as DataFrames of up to
+    chunk_size rows, so only one chunk is in memory at a time.
+    :param bucket_name: Name of the bucket holding the file.
+    :param file_name: Name of the file.
+    :param chunk_size: Most rows in each chunk.
+    :param chunk_function: Function applied to each chunk as it is read, such as
+        compact_dataframe.
+    :return: Generator of DataFrames of the chunks.
+    """
+    s3 = strata_cache.get_resource("s3")
+    body = s3.Object(bucket_name, file_name).get()["Body"]
+
+    return iter_json_chunks(body.iter_chunks(READ_BLOCK_SIZE), chunk_size,
+                            chunk_function)
+
+
+def iter_json_chunks(blocks, chunk_size, chunk_function=None):
+    """
+    Parses JSON records from blocks of bytes into DataFrames of up to chunk_size rows.
+    :param blocks: Iterable of bytes blocks of the file.
+    :param chunk_size: Most rows in each chunk.
+    :param chunk_function: Function applied to each chunk as it is read, such as
+        compact_dataframe.
+    :return: Generator of DataFrames of the chunks.
+    """
+    records = iter_json_records(blocks)
+    while True:
+        chunk = pd.DataFrame(list(islice(records, chunk_size)))
+        if len(chunk) == 0:
+            return
+
+        # pd.read_json reads a column of only nulls as floats, so a chunk where a
+        # column happens to be all null, such as a None value, reads the same way.
+        for column in chunk.columns:
+            values = chunk[column]
+            if values.dtype == object and values.iloc[0] is None and \
+                    values.isna().all():
+                chunk[column] = values.astype(float)
+
+        yield chunk if chunk_function is None else chunk_function(chunk)
+
+
+class S3MultipartWriter:
+    """
+    Writes a file to s3 a part at a time with a multipart upload, so it never has to
+    be held in memory whole. The upload is aborted if the with block raises.
+    """
+
+    def __init__(self, bucket_name, file_name, part_size=MULTIPART_PART_SIZE,
+                 content_type=None, metadata=None, client=None):
+        self.bucket_name = bucket_name
+        self.file_name = file_name
+        self.part_size = part_size
+        self.client = client if client is not None \
+            else strata_cache.get_resource("s3").meta.client
+        self.buffer = io.BytesIO()
+        self.parts = []
+        self.size = 0
+        self.closed = False
+
+        upload_arguments = {"Bucket": bucket_name, "Key": file_name}
+        if content_type is not None:
+            upload_arguments["ContentType"] = content_type
+        if metadata is not None:
+            upload_arguments["Metadata"] = metadata
+        self.upload_id = self.client.create_multipart_upload(
+            **upload_arguments)["UploadId"]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.closed = True
+            self.client.abort_multipart_upload(Bucket=self.bucket_name,
+                                               Key=self.file_name,
+                                               UploadId=self.upload_id)
+
+    def write(self, text):
+        """
+        Adds text, or bytes, to the file, uploading a part once enough is buffered.
+        :param text: String or bytes to write.
+        :return: Number of bytes written.
+        """
+        if isinstance(text, str):
+            text = text.encode("UTF-8")
+        self.buffer.write(text)
+        if self.buffer.tell() >= self.part_size:
+            self.upload_part()
+
+        return len(text)
+
+    def upload_part(self):
+        """
+        Uploads the buffered bytes as the next part.
+        """
+        body = self.buffer.getvalue()
+        response = self.client.upload_part(Bucket=self.bucket_name, Key=self.file_name,
+                                           PartNumber=len(self.parts) + 1,
+                                           UploadId=self.upload_id, Body=body)
+        self.parts.append({"ETag": response["ETag"], "PartNumber": len(self.parts) + 1})
+        self.size += len(body)
+        self.buffer = io.BytesIO()
+
+    def close(self):
+        """
+        Uploads the last part and completes the upload.
+        """
+        if self.buffer.tell() > 0 or not self.parts:
+            self.upload_part()
+        self.client.complete_multipart_upload(Bucket=self.bucket_name,
+                                              Key=self.file_name,
+                                              UploadId=self.upload_id,
+                                              MultipartUpload={"Parts": self.parts})
+        self.closed = True
+
+
+def record_float_columns(chunks, float_columns):
+    """
+    Passes chunks through as they are, adding the name of each column which is float
+    in a chunk to a set. pd.read_json reads a column as floats if any of its values is
+    a float or null, so those are the columns the whole file reads as floats.
+    :param chunks: Iterable of DataFrames of the chunks of data.
+    :param float_columns: Set of column names to add to.
+    :return: Generator of the chunks.
+    """
+    for chunk in chunks:
+        float_columns.update(column for column, dtype in chunk.dtypes.items()
+                             if dtype.kind == "f")
+        yield chunk
+
+
+def apply_float_columns(chunk, float_columns):
+    """
+    Converts the integer columns of a chunk which are float in any chunk to float64, so
+    their values are written as the whole file writes them, such as 30000.0 rather
+    than 30000.
+    :param chunk: DataFrame of the chunk.
+    :param float_columns: Set of column names which are float in any chunk, as found
+        by record_float_columns.
+    :return: DataFrame of the chunk with the columns converted.
+    """
+    integer_columns = [column for column, dtype in chunk.dtypes.items()
+                       if column in float_columns and dtype.kind in "iu"]
+    if not integer_columns:
+        return chunk
+
+    return chunk.astype(dict.fromkeys(integer_columns, np.float64))
+
+
+def write_json_chunks(chunks, writer):
+    """
+    Writes DataFrames to a file as a single records JSON array, a chunk at a time.
+    :param chunks: Iterable of DataFrames to write.
+    :param writer: File like object with a write method.
+    :return: Number of rows written.
+    """
+    rows = 0
+    writer.write("[")
+    for chunk in chunks:
+        records = chunk.to_json(orient="records")[1:-1]
+        if records:
+            writer.write(("," if rows else "") + records)
+            rows += len(chunk)
+    writer.write("]")
+
+    return rows
+
+
+def get_pyarrow():
+    """
+    Imports pyarrow, which is only needed for the parquet output format.
+    :return: The pyarrow module, with pyarrow.parquet imported.
+    """
+    try:
+        import pyarrow
+        import pyarrow.parquet  # noqa: F401
+    except ImportError:
+        raise ValueError("The parquet output format needs the pyarrow package.")
+
+    return pyarrow
+
+
+def get_zstandard():
+    """
+    Imports zstandard, which is only needed for the zstd output format.
+    :return: The zstandard module.
+    """
+    try:
+        import zstandard
+    except ImportError:
+        raise ValueError("The zstd output format needs the zstandard package.")
+
+    return zstandard
+
+
+def get_compressor(output_format):
+    """
+    Gets a streaming compressor for an output format.
+    :param output_format: gzip or zstd.
+    :return: Object with compress and flush methods.
+    """
+    if output_format == "gzip":
+        return zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    if output_format == "zstd":
+        return get_zstandard().ZstdCompressor().compressobj()
+
+    raise ValueError(f"Unknown compressed output format: {output_format}")
+
+
+class CompressingWriter:
+    """
+    File like object which compresses what is written to it as it goes, writing the
+    compressed bytes on to another file.
+    """
+
+    def __init__(self, writer, compressor):
+        """
+        :param writer: File like object to write the compressed bytes to.
+        :param compressor: Object with compress and flush methods, from get_compressor.
+        """
+        self.writer = writer
+        self.compressor = compressor
+
+    def write(self, text):
+        """
+        Compresses text, or bytes, writing whatever the compressor gives back.
+        :param text: String or bytes to write.
+        :return: Number of bytes written, before compression.
+        """
+        if isinstance(text, str):
+            text = text.encode("UTF-8")
+        compressed = self.compressor.compress(text)
+        if compressed:
+            self.writer.write(compressed)
+
+        return len(text)
+
+    def close(self):
+        """
+        Writes the rest of the compressed bytes held by the compressor.
+        """
+        self.writer.write(self.compressor.flush())
+
+
+def write_output(data, bucket_name, file_name, output_format,
+                 part_size=MULTIPART_PART_SIZE, client=None):
+    """
+    Streams output data or anomalies to s3 with a multipart upload, in one of
+    OUTPUT_FORMATS. The content type and the strata-output-format metadata of the
+    object are set to the format, which read_output can also detect from the data.
+    :param data: Records JSON string, or DataFrame, to write.
+    :param bucket_name: Name of the bucket to save to.
+    :param file_name: Name of the file.
+    :param output_format: Format to write, one of OUTPUT_FORMATS.
+    :param part_size: Smallest size of each part but the last.
+    :param client: Boto3 s3 client to write with, defaults to the cached one. Threads
+        should be given a client made on the main thread.
+    :return: Number of bytes written.
+    """
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"Unknown output format: {output_format}")
+
+    with S3MultipartWriter(bucket_name, file_name, part_size,
+                           content_type=OUTPUT_CONTENT_TYPES[output_format],
+                           metadata={"strata-output-format": output_format},
+                           client=client) as writer:
+        if output_format == "parquet":
+            pyarrow = get_pyarrow()
+
+            if isinstance(data, str):
+                data = decode_dataframe(data)
+            # The schema comes from every row, so a column which is null in one row
+            # group has the same type as in the others.
+            schema = pyarrow.Schema.from_pandas(data, preserve_index=False)
+            with pyarrow.parquet.ParquetWriter(writer, schema) as parquet_writer:
+                for start in range(0, max(len(data), 1), OUTPUT_ROW_GROUP_SIZE):
+                    parquet_writer.write_table(pyarrow.Table.from_pandas(
+                        data.iloc[start:start + OUTPUT_ROW_GROUP_SIZE], schema=schema,
+                        preserve_index=False))
+        else:
+            json_writer = writer
+            if output_format != "json":
+                json_writer = CompressingWriter(writer, get_compressor(output_format))
+            if isinstance(data, str):
+                for start in range(0, len(data), part_size):
+                    json_writer.write(data[start:start + part_size])
+            else:
+                # A chunk of rows is encoded at a time, so the records JSON of the
+                # whole DataFrame is never held at once.
+                write_json_chunks(
+                    (data.iloc[start:start + OUTPUT_JSON_CHUNK_SIZE]
+                     for start in range(0, len(data), OUTPUT_JSON_CHUNK_SIZE)),
+                    json_writer)
+            if output_format != "json":
+                json_writer.close()
+
+    return writer.size
+
+
+def detect_output_format(data):
+    """
+    Detects the format of output written by write_output, or saved as records JSON,
+    from its first bytes.
+    :param data: Bytes of the output, or at least its first four bytes.
+    :return: The format, one of OUTPUT_FORMATS.
+    """
+    for output_format, magic_bytes in OUTPUT_MAGIC_BYTES.items():
+        if data.startswith(magic_bytes):
+            return output_format
+
+    return "json"
+
+
+def decompress_output(data, output_format):
+    """
+    Decompresses gzip or zstd output back to the records JSON it was written from.
+    :param data: Bytes of the output.
+    :param output_format: json, gzip or zstd.
+    :return: String of the records JSON.
+    """
+    if output_format == "gzip":
+        data = zlib.decompress(data, 16 + zlib.MAX_WBITS)
+    elif output_format == "zstd":
+        # Streamed frames don't record their size, so they are read as a stream.
+        data = get_zstandard().ZstdDecompressor().decompressobj().decompress(data)
+    elif output_format != "json":
+        raise ValueError(f"Output format {output_format} isn't records JSON.")
+
+    return data.decode("UTF-8")
+
+
+def read_output(bucket_name, file_name):
+    """
+    Reads output data or anomalies from s3 in any of OUTPUT_FORMATS, detecting the
+    format from the data.
+    :param bucket_name: Name of the bucket holding the file.
+    :param file_name: Name of the file.
+    :return: DataFrame of the output.
+    """
+    s3 = strata_cache.get_resource("s3")
+    data = s3.Object(bucket_name, file_name).get()["Body"].read()
+
+    output_format = detect_output_format(data)
+    if output_format == "parquet":
+        return pd.read_parquet(io.BytesIO(data))
+
+    return decode_dataframe(decompress_output(data, output_format))
+
+
+def result_cache_key(bucket_name, file_name, config):
+    """
+    Gets the result cache key of a run, a hash of the input file's ETag and size, which
+    s3 derives from its contents, together with the config the strata depend on.
+    :param bucket_name: Name of the bucket holding the input file.
+    :param file_name: Name of the input file.
+    :param config: Dict of the strata config of the run, which must be JSON.
+    :return: String of the key.
+    """
+    input_object = strata_cache.get_resource("s3").Object(bucket_name, file_name)
+    key_data = json.dumps({"config": config, "e_tag": input_object.e_tag,
+                           "size": input_object.content_length}, sort_keys=True)
+
+    return hashlib.sha256(key_data.encode("UTF-8")).hexdigest()
+
+
+def cached_result_file_name(cache_key, name):
+    """
+    Gets the name of a file in a result cache entry.
+    :param cache_key: Key of the entry, from result_cache_key.
+    :param name: Name of the file in the entry.
+    :return: Name of the file in the bucket.
+    """
+    return f"{RESULT_CACHE_PREFIX}{cache_key}/{name}"
+
+
+def read_cached_result(bucket_name, cache_key, ttl):
+    """
+    Reads the manifest of a result cache entry, if it exists and hasn't expired.
+    :param bucket_name: Name of the bucket holding the cache.
+    :param cache_key: Key of the entry, from result_cache_key.
+    :param ttl: Seconds an entry can be used for after it is written.
+    :return: Dict of the manifest, or None if there is no entry.
+    """
+    s3 = strata_cache.get_resource("s3")
+    try:
+        manifest_object = s3.Object(
+            bucket_name, cached_result_file_name(cache_key, "manifest.json")).get()
+    except ClientError as e:
+        if e.response["Error"]["Code"] not in ["NoSuchKey", "404"]:
+            raise
+        return None
+
+    age = datetime.now(timezone.utc) - manifest_object["LastModified"]
+    if age.total_seconds() > ttl:
+        return None
+
+    return json.loads(manifest_object["Body"].read().decode("UTF-8"))
+
+
+def write_cached_result(bucket_name, cache_key, period_outputs, output_file_names):
+    """
+    Adds a run's result to the cache. The output data already saved to s3 is copied
+    into the entry within s3, so it isn't read or serialised again, and the manifest
+    is written last so a partly written entry is never used.
+    :param bucket_name: Name of the bucket holding the outputs and the cache.
+    :param cache_key: Key of the entry, from result_cache_key.
+    :param period_outputs: List of dicts of the period and anomalies of the run.
+    :param output_file_names: List of the output file of each period.
+    :return: Number of bytes in the entry.
+    """
+    client = strata_cache.get_resource("s3").meta.client
+    manifest = {"periods": []}
+    size = 0
+    for index, (period_output, output_file_name) in enumerate(
+            zip(period_outputs, output_file_names)):
+        client.copy_object(
+            Bucket=bucket_name, Key=cached_result_file_name(cache_key, f"{index}.json"),
+            CopySource={"Bucket": bucket_name, "Key": output_file_name})
+        size += client.head_object(Bucket=bucket_name,
+                                   Key=output_file_name)["ContentLength"]
+        manifest["periods"].append({"period": period_output["period"],
+                                    "anomalies": period_output["anomalies"]})
+
+    manifest_json = json.dumps(manifest)
+    client.put_object(Bucket=bucket_name,
+                      Key=cached_result_file_name(cache_key, "manifest.json"),
+                      Body=manifest_json.encode("UTF-8"))
+
+    return size + len(manifest_json)
+
+
+def restore_cached_result(bucket_name, cache_key, manifest, output_file_names):
+    """
+    Copies the output data of a result cache entry to the output files within s3.
+    :param bucket_name: Name of the bucket holding the cache.
+    :param cache_key: Key of the entry, from result_cache_key.
+    :param manifest: Dict of the entry's manifest, from read_cached_result.
+    :param output_file_names: List of the output file of each period.
+    """
+    client = strata_cache.get_resource("s3").meta.client
+    for index, output_file_name in enumerate(output_file_names):
+        client.copy_object(
+            Bucket=bucket_name, Key=output_file_name,
+            CopySource={"Bucket": bucket_name,
+                        "Key": cached_result_file_name(cache_key, f"{index}.json")})
+
+
+def evict_cached_results(bucket_name, ttl, max_bytes):
+    """
+    Deletes result cache entries which have expired, then the oldest entries until the
+    cache is no bigger than max_bytes. Entries without a manifest are only deleted once
+    they have expired, as they may still be being written.
+    :param bucket_name: Name of the bucket holding the cache.
+    :param ttl: Seconds an entry can be used for after it is written.
+    :param max_bytes: Most bytes the cache can hold.
+    :return: Number of entries deleted.
+    """
+    client = strata_cache.get_resource("s3").meta.client
+    entries = {}
+    for page in client.get_paginator("list_objects_v2").paginate(
+            Bucket=bucket_name, Prefix=RESULT_CACHE_PREFIX):
+        for cache_object in page.get("Contents", []):
+            cache_key = cache_object["Key"][len(RESULT_CACHE_PREFIX):].split("/")[0]
+            entry = entries.setdefault(cache_key, {"keys": [], "size": 0,
+                                                   "written": None, "complete": False})
+            entry["keys"].append(cache_object["Key"])
+            entry["size"] += cache_object["Size"]
+            if entry["written"] is None or \
+                    cache_object["LastModified"] > entry["written"]:
+                entry["written"] = cache_object["LastModified"]
+            if cache_object["Key"].endswith("/manifest.json"):
+                entry["complete"] = True
+
+    now = datetime.now(timezone.utc)
+    total_size = sum(entry["size"] for entry in entries.values())
+    evicted = []
+    for cache_key, entry in sorted(entries.items(), key=lambda item: item[1]["written"]):
+        expired = (now - entry["written"]).total_seconds() > ttl
+        if expired or (entry["complete"] and total_size > max_bytes):
+            evicted.append(cache_key)
+            total_size -= entry["size"]
+
+    delete_keys = [key for cache_key in evicted for key in entries[cache_key]["keys"]]
+    for start in range(0, len(delete_keys), 1000):
+        client.delete_objects(Bucket=bucket_name, Delete={
+            "Objects": [{"Key": key} for key in delete_keys[start:start + 1000]]})
+
+    return len(evicted)
@@ -0,0 +1,191 @@
+"""
+Runs the strata method over local files without lambda, for backfills and reruns.
+The data is split into shards on the reference, which keeps all of a reference's
+periods together, and the shards are run across a process pool.
+
+    python strata_local_runner.py --current-period 201809 --output-dir out input.json
+"""
+import argparse
+import logging
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import strata_io
+import strata_period_method
+
+logger = logging.getLogger("Strata - Local Runner")
+
+
+def run_strata(data, current_period, config, anomaly_row_numbers=False):
+    """
+    Runs the strata calculation and mismatch detection the method performs.
+    :param data: DataFrame of the input data.
+    :param current_period: The current period of the run.
+    :param config: Dict of the column names and strata rules, from get_config.
+    :param anomaly_row_numbers: Whether to add the row number to the anomalies, for
+        merging shards.
+    :return: Tuple of the DataFrames of the data and anomalies.
+    """
+    post_strata = strata_period_method.assign_strata(
+        data,
+        strata_column=config["strata_column"],
+        value_column=config["value_column"],
+        survey_column=config["survey_column"],
+        region_column=config["region_column"],
+        strata_rules=strata_period_method.get_strata_rules(config["strata_rules"]))
+
+    segmentation = config["segmentation"]
+    period_column = config["period_column"]
+
+    strata_data, anomalies = strata_period_method.strata_mismatch_detector(
+        post_strata,
+        current_period,
+        period_column,
+        config["reference"],
+        segmentation,
+        "good_" + segmentation,
+        "current_" + period_column,
+        "previous_" + period_column,
+        "current_" + segmentation,
+        "previous_" + segmentation)
+
+    if anomaly_row_numbers:
+        anomalies = strata_io.number_anomalies(
+            anomalies, post_strata, current_period, period_column, config["reference"],
+            segmentation, "current_" + segmentation)
+
+    return strata_data, anomalies
+
+
+def run_strata_parallel(data, current_period, config, executor, shard_count):
+    """
+    Runs run_strata over shards of the data in the executor, combining the results so
+    they match a single serial run.
+    :param data: DataFrame of the input data.
+    :param current_period: The current period of the run.
+    :param config: Dict of the column names and strata rules, from get_config.
+    :param executor: Executor to run the shards in.
+    :param shard_count: Number of shards to split the data into.
+    :return: Tuple of the DataFrames of the data and anomalies.
+    """
+    numbered_data = strata_io.project_dataframe(data, list(data.columns))
+    shards = strata_io.shard_dataframe(numbered_data, config["reference"], shard_count)
+
+    results = list(executor.map(run_strata, shards, [current_period] * len(shards),
+                                [config] * len(shards), [True] * len(shards)))
+
+    strata_data = strata_io.merge_shard_data([result[0] for result in results])
+    anomalies = strata_io.merge_shard_anomalies(
+        [result[1] for result in results], data, current_period,
+        config["period_column"], config["reference"])
+
+    return strata_data.drop(strata_io.ROW_NUMBER_COLUMN, axis=1), anomalies
+
+
+def get_config(arguments):
+    """
+    Builds the run config from the parsed command line arguments.
+    :param arguments: Namespace of the parsed arguments.
+    :return: Dict of the column names and strata rules.
+    """
+    strata_rules = None
+    if arguments.strata_rules:
+        with open(arguments.strata_rules, "r") as file:
+            strata_rules = file.read()
+
+    return {
+        "period_column": arguments.period_column,
+        "reference": arguments.reference,
+        "region_column": arguments.region_column,
+        "segmentation": arguments.segmentation,
+        "strata_column": arguments.segmentation,
+        "strata_rules": strata_rules,
+        "survey_column": arguments.survey_column,
+        "value_column": arguments.value_column
+    }
+
+
+def parse_arguments(argv=None):
+    """
+    Parses the command line arguments.
+    :param argv: List of the arguments, defaults to sys.argv.
+    :return: Namespace of the parsed arguments.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("input_files", nargs="+",
+                        help="Records JSON files, as read by the wrangler.")
+    parser.add_argument("--current-period", action="append", required=True,
+                        help="Period to run, can be given more than once.")
+    parser.add_argument("--output-dir", required=True)
+    parser.add_argument("--workers", type=int, default=os.cpu_count(),
+                        help="Number of processes, 1 runs serially.")
+    parser.add_argument("--shards-per-worker", type=int, default=4)
+    parser.add_argument("--compare-serial", action="store_true",
+                        help="Also run serially, checking and timing the results.")
+    parser.add_argument("--period-column", default="period")
+    parser.add_argument("--reference", default="responder_id")
+    parser.add_argument("--region-column", default="region")
+    parser.add_argument("--segmentation", default="strata")
+    parser.add_argument("--strata-rules", help="JSON file of the strata rules.")
+    parser.add_argument("--survey-column", default="survey")
+    parser.add_argument("--value-column", default="Q608_total")
+
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    """
+    Runs each input file for each current period, writing the data and anomalies to
+    the output directory in the same form as the method's outputs.
+    :param argv: List of the arguments, defaults to sys.argv.
+    """
+    arguments = parse_arguments(argv)
+    config = get_config(arguments)
+    shard_count = arguments.workers * arguments.shards_per_worker
+    os.makedirs(arguments.output_dir, exist_ok=True)
+
+    with ProcessPoolExecutor(max_workers=arguments.workers) as executor:
+        for input_file in arguments.input_files:
+            with open(input_file, "r") as file:
+                data = strata_io.decode_dataframe(file.read())
+            name = os.path.splitext(os.path.basename(input_file))[0]
+
+            for current_period in arguments.current_period:
+                start = time.perf_counter()
+                if arguments.workers > 1:
+                    strata_data, anomalies = run_strata_parallel(
+                        data, current_period, config, executor, shard_count)
+                else:
+                    strata_data, anomalies = run_strata(data, current_period, config)
+                run_time = time.perf_counter() - start
+
+                logger.info(f"Ran {name} for {current_period}: {len(data)} rows in "
+                            f"{run_time:.3f}s ({len(data) / run_time:.0f} rows/s)")
+
+                data_json = strata_data.to_json(orient="records")
+                anomalies_json = anomalies.to_json(orient="records")
+
+                if arguments.compare_serial:
+                    start = time.perf_counter()
+                    serial_data, serial_anomalies = run_strata(data, current_period,
+                                                               config)
+                    serial_time = time.perf_counter() - start
+                    if serial_data.to_json(orient="records") != data_json or \
+                            serial_anomalies.to_json(orient="records") != anomalies_json:
+                        raise ValueError(f"Parallel and serial results differ for "
+                                         f"{name} in {current_period}.")
+                    logger.info(f"Serial run took {serial_time:.3f}s, a speed up of "
+                                f"{serial_time / run_time:.2f}x")
+
+                output_name = os.path.join(arguments.output_dir,
+                                           f"{name}_{current_period}")
+                with open(output_name + ".json", "w") as file:
+                    file.write(data_json)
+                with open(output_name + "_Strata_Anomalies.json", "w") as file:
+                    file.write(anomalies_json)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    main()
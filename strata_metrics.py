@@ -0,0 +1,227 @@
+import cProfile
+import io
+import json
+import logging
+import os
+import pstats
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+import strata_cache
+
+
+# Number of invocations this container has handled, so a cold start can be told apart.
+container = {"invocations": 0}
+
+# Prefix of the profiles of runs with the profile runtime variable set.
+PROFILE_PREFIX = "strata_profiles/"
+
+# Number of functions and allocation sites listed in a profile report.
+PROFILE_REPORT_LINES = 50
+
+
+def process_age_seconds():
+    """
+    Gets the time since the process started, where the platform reports it (Linux).
+    :return: Seconds since the process started, or None.
+    """
+    try:
+        with open("/proc/self/stat", "r") as file:
+            # The fields after the command name, which can hold spaces, start at the
+            # process state, so the start time (field 22) is the 20th of them.
+            start_ticks = int(file.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/uptime", "r") as file:
+            uptime = float(file.read().split()[0])
+    except (OSError, IndexError, ValueError):
+        return None
+
+    return max(uptime - start_ticks / os.sysconf("SC_CLK_TCK"), 0.0)
+
+
+def reset_peak_rss():
+    """
+    Resets the peak RSS of the process, where the platform allows it (Linux).
+    :return: True if the peak was reset.
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as file:
+            file.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss_mb():
+    """
+    Gets the peak RSS of the process since it was last reset.
+    :return: Peak RSS in MB.
+    """
+    try:
+        with open("/proc/self/status", "r") as file:
+            for line in file:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+
+    # ru_maxrss is in KB on Linux and bytes on macOS, and can't be reset.
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+class StageMetrics:
+    """
+    Records the time and peak memory of each stage of a run, along with the rows and
+    bytes it handled, logging each stage as it completes. The first run in a container
+    also records the cold start: the time from the process starting to the handler
+    being called, and the setup time before the metrics were created, from the start
+    passed in as the time.perf_counter() when the handler was called.
+    """
+
+    def __init__(self, logger=None, start=None):
+        now = time.perf_counter()
+        self.logger = logger
+        self.stages = []
+        self.start = now if start is None else start
+
+        container["invocations"] += 1
+        self.cold_start = {"cold": container["invocations"] == 1,
+                           "setup_seconds": round(now - self.start, 6)}
+        if self.cold_start["cold"]:
+            process_age = process_age_seconds()
+            if process_age is not None:
+                process_age = round(max(process_age - (now - self.start), 0.0), 6)
+            self.cold_start["init_seconds"] = process_age
+
+    @contextmanager
+    def stage(self, name, rows=None, size=None):
+        """
+        Measures the stage run inside the with block. The rows and bytes can be given
+        up front, or set on the yielded dict once they are known.
+        :param name: Name of the stage.
+        :param rows: Number of rows the stage handles.
+        :param size: Number of bytes the stage handles.
+        :return: Dict of the stage metrics.
+        """
+        metric = {"stage": name, "rows": rows, "bytes": size}
+        reset_peak_rss()
+        start = time.perf_counter()
+
+        yield metric
+
+        metric["seconds"] = round(time.perf_counter() - start, 6)
+        metric["peak_rss_mb"] = round(peak_rss_mb(), 1)
+        self.stages.append(metric)
+
+        if self.logger is not None:
+            self.logger.info(f"Stage metrics: {json.dumps(metric)}")
+
+    def summary(self):
+        """
+        Summarises the stages recorded so far.
+        :return: Dict of the total time, peak memory, cold start and each stage's
+            metrics.
+        """
+        return {
+            "total_seconds": round(time.perf_counter() - self.start, 6),
+            "cold_start": self.cold_start,
+            "peak_rss_mb": max([stage["peak_rss_mb"] for stage in self.stages],
+                               default=round(peak_rss_mb(), 1)),
+            "stages": self.stages
+        }
+
+
+class RunProfiler:
+    """
+    Profiles a run with cProfile and tracemalloc, from being created until it is
+    stopped. The stats can be saved as a pstats file, which can be loaded by pstats or
+    snakeviz, along with a text report of the slowest functions and the largest
+    allocation sites. Only one run in a process can be profiled at a time, so a
+    profiler created while another is running, such as the method's when it's run in
+    process by the wrangler, is left inactive and the enclosing profile covers it.
+    """
+
+    def __init__(self, frame_limit=10):
+        self.active = not tracemalloc.is_tracing()
+        self.profile = cProfile.Profile()
+        self.snapshot = None
+        self.peak_traced_mb = None
+        if self.active:
+            tracemalloc.start(frame_limit)
+            self.profile.enable()
+
+    def stop(self):
+        """
+        Stops profiling, if it hasn't been stopped already.
+        """
+        if self.snapshot is not None or not self.active:
+            return
+
+        self.profile.disable()
+        self.snapshot = tracemalloc.take_snapshot()
+        self.peak_traced_mb = tracemalloc.get_traced_memory()[1] / (1024 * 1024)
+        tracemalloc.stop()
+
+    def get_stats(self):
+        """
+        Stops profiling and gets the cProfile stats in the pstats file format.
+        :return: Bytes of the stats.
+        """
+        self.stop()
+        with tempfile.TemporaryDirectory() as directory:
+            stats_file_name = os.path.join(directory, "run.pstats")
+            self.profile.dump_stats(stats_file_name)
+            with open(stats_file_name, "rb") as file:
+                return file.read()
+
+    def get_report(self, lines=PROFILE_REPORT_LINES):
+        """
+        Stops profiling and gets a report of the functions with the most cumulative
+        time and the lines which allocated the most memory still held at the end.
+        :param lines: Number of functions and allocation sites to list.
+        :return: String of the report.
+        """
+        self.stop()
+        report = io.StringIO()
+        pstats.Stats(self.profile, stream=report).sort_stats(
+            "cumulative").print_stats(lines)
+
+        report.write(f"Peak traced memory: {self.peak_traced_mb:.1f} MB\n")
+        report.write("Top allocation sites:\n")
+        for statistic in self.snapshot.statistics("lineno")[:lines]:
+            report.write(f"{statistic}\n")
+
+        return report.getvalue()
+
+    def save(self, bucket_name, file_name, logger=None):
+        """
+        Stops profiling and saves the stats and report to s3, as file_name with .pstats
+        and .txt added. A failure is only logged, so profiling can't fail a run.
+        :param bucket_name: Name of the bucket to save to.
+        :param file_name: Name of the files, without an extension.
+        :param logger: Logger to log the saved files or failure to.
+        :return: List of the names of the saved files.
+        """
+        if logger is None:
+            logger = logging.getLogger(__name__)
+
+        if not self.active:
+            logger.info(f"Not saving profile {file_name}, as an enclosing run is "
+                        f"being profiled.")
+            return []
+
+        try:
+            s3 = strata_cache.get_resource("s3")
+            s3.Object(bucket_name, file_name + ".pstats").put(Body=self.get_stats())
+            s3.Object(bucket_name, file_name + ".txt").put(
+                Body=self.get_report().encode("UTF-8"))
+        except Exception as e:
+            logger.warning(f"Failed to save profile {file_name}: {e}")
+            return []
+
+        logger.info(f"Saved profile to {file_name}.pstats and {file_name}.txt")
+        return [file_name + ".pstats", file_name + ".txt"]
@@ -1,9 +1,73 @@
+import json
 import logging
 import os
+import time
+import uuid
+from collections import namedtuple
+from functools import partial
 
+import numpy as np
 import pandas as pd
-from es_aws_functions import general_functions
-from marshmallow import EXCLUDE, Schema, fields
+from es_aws_functions import aws_functions, general_functions
+from marshmallow import (EXCLUDE, Schema, ValidationError, fields, validate,
+                         validates_schema)
+
+import strata_cache
+import strata_io
+from strata_metrics import PROFILE_PREFIX, RunProfiler, StageMetrics
+
+# The strata rules used when no strata_rules environment variable is set. These are the
+# 066 (Land) and 076 (Marine) thresholds that calculate_strata is written around.
+DEFAULT_STRATA_RULES = {
+    "066": {
+        "breakpoints": [29999, 79999, 129999, 200000],
+        "strata": ["E", "D", "C", "B", "A"],
+        "regions": {
+            "B": {"breakpoints": [10], "strata": ["B1", "B2"]}
+        }
+    },
+    "076": {
+        "breakpoints": [],
+        "strata": ["M"]
+    }
+}
+
+CompiledStrataRule = namedtuple("CompiledStrataRule",
+                                ["breakpoints", "strata", "regions"])
+
+# Compiled strata rules, kept for the life of the container so warm invocations
+# don't validate and compile the same rule table again.
+compiled_strata_rules = {}
+
+
+class RegionRuleSchema(Schema):
+    class Meta:
+        unknown = EXCLUDE
+
+    breakpoints = fields.List(fields.Number(), required=True)
+    strata = fields.List(fields.Str(), required=True)
+
+    @validates_schema
+    def validate_bands(self, data, **kwargs):
+        breakpoints = data["breakpoints"]
+        if len(data["strata"]) != len(breakpoints) + 1:
+            raise ValidationError("There must be one more strata than breakpoints.")
+        if any(low >= high for low, high in zip(breakpoints, breakpoints[1:])):
+            raise ValidationError("Breakpoints must be in ascending order.")
+
+
+class StrataRuleSchema(RegionRuleSchema):
+    def handle_error(self, e, data, **kwargs):
+        logging.error(f"Error validating strata rules: {e}")
+        raise ValueError(f"Error validating strata rules: {e}")
+
+    regions = fields.Dict(keys=fields.Str(), values=fields.Nested(RegionRuleSchema))
+
+    @validates_schema
+    def validate_regions(self, data, **kwargs):
+        for strata in data.get("regions", {}):
+            if strata not in data["strata"]:
+                raise ValidationError(f"Region split for unknown strata {strata}.")
 
 
 class EnvironmentSchema(Schema):
@@ -14,7 +78,10 @@ class EnvironmentSchema(Schema):
         logging.error(f"Error validating environment params: {e}")
         raise ValueError(f"Error validating environment params: {e}")
 
+    json_codec = fields.Str(required=False,
+                            validate=validate.OneOf(list(strata_io.JSON_CODECS)))
     strata_column = fields.Str(required=True)
+    strata_rules = fields.Str(required=False)
     value_column = fields.Str(required=True)
 
 
@@ -26,21 +93,78 @@ class RuntimeSchema(Schema):
         logging.error(f"Error validating runtime params: {e}")
         raise ValueError(f"Error validating runtime params: {e}")
 
+    anomaly_row_numbers = fields.Bool(required=False)
     bpm_queue_url = fields.Str(required=True)
-    current_period = fields.Str(required=True)
-    data = fields.Str(required=True)
+    bucket_name = fields.Str(required=False)
+    chunk_partitions = fields.Int(required=False, validate=validate.Range(min=1))
+    chunk_size = fields.Int(required=False, validate=validate.Range(min=1))
+    completion = fields.Dict(required=False)
+    current_period = fields.Str(required=False)
+    data = fields.Str(required=False)
+    data_transport = fields.Str(required=False,
+                                validate=validate.OneOf(strata_io.DATA_TRANSPORTS))
     environment = fields.Str(required=True)
+    in_file_name = fields.Str(required=False)
+    out_file_name = fields.Str(required=False)
+    output_columns = fields.List(fields.Str(), required=False)
+    patch_output = fields.Bool(required=False)
     period_column = fields.Str(required=True)
+    periods = strata_io.PeriodsField(required=False)
+    profile = fields.Bool(required=False)
     reference = fields.Str(required=True)
     region_column = fields.Str(required=True)
+    result_file_name = fields.Str(required=False)
     segmentation = fields.Str(required=True)
+    strata_store = fields.Str(required=False)
     survey = fields.Str(required=True)
     survey_column = fields.Str(required=True)
 
+    @validates_schema
+    def validate_data_location(self, data, **kwargs):
+        if data.get("data_transport") == "s3":
+            required = ["bucket_name", "in_file_name", "out_file_name"]
+        else:
+            required = ["data"]
+        if "strata_store" in data or "result_file_name" in data or \
+                data.get("profile"):
+            required.append("bucket_name")
+        missing = [field for field in required if field not in data]
+        if missing:
+            raise ValidationError(f"Missing data location fields: {missing}")
+
+    @validates_schema
+    def validate_streaming(self, data, **kwargs):
+        if "chunk_size" not in data:
+            if "chunk_partitions" in data:
+                raise ValidationError("Partitions can only be used with a chunk size.")
+            return
+        if data.get("data_transport") != "s3":
+            raise ValidationError("Data can only be streamed with the s3 data transport.")
+        if "strata_store" in data:
+            raise ValidationError("Data can't be streamed with a strata store.")
+
+    @validates_schema
+    def validate_periods(self, data, **kwargs):
+        if "periods" not in data:
+            if "current_period" not in data:
+                raise ValidationError("A current period is needed unless multiple "
+                                      "periods are run.")
+            return
+        if data.get("data_transport") == "s3" or "strata_store" in data:
+            raise ValidationError("Multiple periods can't be run with the s3 data "
+                                  "transport or a strata store.")
+
+    @validates_schema
+    def validate_patch_output(self, data, **kwargs):
+        if data.get("patch_output") and (data.get("data_transport") == "s3" or
+                                         "periods" in data):
+            raise ValidationError("Patches can't be output with the s3 data transport "
+                                  "or multiple periods.")
+
 
 def lambda_handler(event, context):
     """
-    Applies Calculate strata function to row of DataFrame.
+    Calculates the strata for every row of the DataFrame, then checks for mismatches.
     :param event: Event Object.
     :param context: Context object.
     :return: strata_out - Dict with "success" and "data" or "success and "error".
@@ -50,36 +174,55 @@ def lambda_handler(event, context):
     bpm_queue_url = None
     # Define run_id outside of try block
     run_id = 0
+    handler_start = time.perf_counter()
 
     try:
         # Retrieve run_id before input validation
         # Because it is used in exception handling
         run_id = event["RuntimeVariables"]["run_id"]
 
-        environment_variables = EnvironmentSchema().load(os.environ)
+        environment_variables = strata_cache.load_environment(EnvironmentSchema,
+                                                              os.environ)
+        strata_io.set_json_codec(environment_variables.get("json_codec"))
+        strata_rules = get_strata_rules(environment_variables.get("strata_rules"))
 
-        runtime_variables = RuntimeSchema().load(event["RuntimeVariables"])
+        runtime_variables = strata_cache.get_schema(RuntimeSchema).load(
+            event["RuntimeVariables"])
 
         # Environment Variables
         strata_column = environment_variables["strata_column"]
         value_column = environment_variables["value_column"]
 
         # Runtime Variables
+        anomaly_row_numbers = runtime_variables.get("anomaly_row_numbers", False)
         bpm_queue_url = runtime_variables["bpm_queue_url"]
-        current_period = runtime_variables["current_period"]
-        data = runtime_variables["data"]
+        bucket_name = runtime_variables.get("bucket_name")
+        chunk_partitions = runtime_variables.get("chunk_partitions", 1)
+        chunk_size = runtime_variables.get("chunk_size")
+        completion = runtime_variables.get("completion")
+        current_period = runtime_variables.get("current_period")
+        data = runtime_variables.get("data")
+        data_transport = runtime_variables.get("data_transport", "json")
         environment = runtime_variables['environment']
+        in_file_name = runtime_variables.get("in_file_name")
+        out_file_name = runtime_variables.get("out_file_name")
+        output_columns = runtime_variables.get("output_columns")
+        patch_output = runtime_variables.get("patch_output", False)
         period_column = runtime_variables["period_column"]
+        periods = runtime_variables.get("periods")
+        profile = runtime_variables.get("profile", False)
         reference = runtime_variables["reference"]
         region_column = runtime_variables["region_column"]
+        result_file_name = runtime_variables.get("result_file_name")
         segmentation = runtime_variables["segmentation"]
+        strata_store = runtime_variables.get("strata_store")
         survey = runtime_variables['survey']
         survey_column = runtime_variables["survey_column"]
 
     except Exception as e:
         error_message = general_functions.handle_exception(e, current_module, run_id,
                                                            context=context)
-        return {"success": False, "error": error_message}
+        return save_failed_result(event, {"success": False, "error": error_message})
 
     try:
         logger = general_functions.get_logger(survey, current_module, environment,
@@ -87,38 +230,191 @@ def lambda_handler(event, context):
     except Exception as e:
         error_message = general_functions.handle_exception(e, current_module,
                                                            run_id, context=context)
-        return {"success": False, "error": error_message}
+        return save_failed_result(event, {"success": False, "error": error_message})
 
+    profiler = None
     try:
         logger.info("Started - retrieved configuration variables.")
-        input_data = pd.read_json(data, dtype=False)
-        post_strata = input_data.apply(
-            calculate_strata,
-            strata_column=strata_column,
-            value_column=value_column,
-            survey_column=survey_column,
-            region_column=region_column,
-            axis=1,
-        )
-        logger.info("Successfully ran calculation")
-
-        # Perform mismatch detection
-        strata_check, anomalies = strata_mismatch_detector(
-            post_strata,
-            current_period,
-            period_column,
-            reference,
-            segmentation,
-            "good_" + segmentation,
-            "current_" + period_column,
-            "previous_" + period_column,
-            "current_" + segmentation,
-            "previous_" + segmentation)
-
-        json_out = strata_check.to_json(orient="records")
-        anomalies_out = anomalies.to_json(orient="records")
-
-        final_output = {"data": json_out, "anomalies": anomalies_out}
+        metrics = StageMetrics(logger, start=handler_start)
+        if profile:
+            profiler = RunProfiler()
+        compact_int32_columns = [period_column, region_column]
+
+        if chunk_size:
+            anomalies = stream_strata(
+                bucket_name, in_file_name, out_file_name, chunk_size, chunk_partitions,
+                current_period, period_column, reference, segmentation, value_column,
+                region_column, strata_column, survey_column, strata_rules,
+                output_columns, metrics, logger)
+            final_output = {"anomalies": strata_io.encode_dataframe(anomalies)}
+        else:
+            if data_transport == "s3":
+                with metrics.stage("s3_read") as metric:
+                    input_data = strata_io.compact_dataframe(
+                        aws_functions.read_dataframe_from_s3(bucket_name, in_file_name),
+                        compact_int32_columns, [reference])
+                    metric["rows"] = len(input_data)
+                logger.info("Successfully retrieved data from s3")
+            else:
+                with metrics.stage("parse", size=len(data)) as metric:
+                    input_data = strata_io.compact_dataframe(
+                        strata_io.decode_dataframe(data, data_transport),
+                        compact_int32_columns, [reference])
+                    metric["rows"] = len(input_data)
+            input_data = strata_io.add_missing_columns(
+                input_data,
+                [reference, period_column, region_column, survey_column, value_column]
+                + [column for column in output_columns or [] if column != segmentation])
+
+            if strata_store:
+                # Only the current period, and anything missing from the store, is
+                # calculated. The rest of the strata are looked up from earlier runs.
+                store_columns = [reference, period_column, strata_column]
+                with metrics.stage("store_read") as metric:
+                    store = strata_io.read_strata_store(bucket_name, strata_store,
+                                                        store_columns)
+                    metric["rows"] = len(store)
+
+                with metrics.stage("strata", rows=len(input_data)) as metric:
+                    post_strata, calculated = assign_strata_from_store(
+                        input_data,
+                        store,
+                        current_period,
+                        period_column,
+                        reference,
+                        strata_column=strata_column,
+                        value_column=value_column,
+                        survey_column=survey_column,
+                        region_column=region_column,
+                        strata_rules=strata_rules,
+                    )
+                    metric["rows"] = int(calculated.sum())
+                logger.info("Successfully ran calculation")
+
+                with metrics.stage("store_write") as metric:
+                    store = strata_io.update_strata_store(
+                        store, post_strata.loc[calculated, store_columns],
+                        [reference, period_column])
+                    metric["rows"] = len(store)
+                    metric["bytes"] = strata_io.write_strata_store(store, bucket_name,
+                                                                   strata_store)
+                logger.info("Successfully updated strata store")
+            else:
+                with metrics.stage("strata", rows=len(input_data)):
+                    post_strata = assign_strata(
+                        input_data,
+                        strata_column=strata_column,
+                        value_column=value_column,
+                        survey_column=survey_column,
+                        region_column=region_column,
+                        strata_rules=strata_rules,
+                    )
+                logger.info("Successfully ran calculation")
+
+            if periods:
+                # Each period is compared with the one before it in the data, as
+                # separate runs over just those two periods would be.
+                with metrics.stage("mismatch_detection", rows=len(post_strata)):
+                    period_results = strata_mismatch_periods(
+                        post_strata,
+                        strata_io.select_periods(periods, post_strata[period_column]),
+                        period_column,
+                        reference,
+                        segmentation,
+                        "good_" + segmentation,
+                        "current_" + period_column,
+                        "previous_" + period_column,
+                        "current_" + segmentation,
+                        "previous_" + segmentation)
+
+                with metrics.stage("encode") as metric:
+                    period_outputs = []
+                    for period, strata_check, anomalies in period_results:
+                        if output_columns:
+                            strata_check = strata_check[output_columns]
+                        period_outputs.append({
+                            "period": str(period),
+                            "data": strata_io.encode_dataframe(strata_check,
+                                                               data_transport),
+                            "anomalies": strata_io.encode_dataframe(anomalies)
+                        })
+                    metric["rows"] = sum(len(result[1]) for result in period_results)
+                    metric["bytes"] = sum(len(output["data"]) + len(output["anomalies"])
+                                          for output in period_outputs)
+                final_output = {"periods": period_outputs}
+            elif patch_output:
+                # Only the strata and the patches to them are returned, which the
+                # wrangler applies to the data it holds.
+                with metrics.stage("mismatch_detection", rows=len(post_strata)):
+                    good_segmentation, anomalies = find_strata_mismatches(
+                        post_strata,
+                        current_period,
+                        period_column,
+                        reference,
+                        segmentation,
+                        "good_" + segmentation,
+                        "current_" + period_column,
+                        "previous_" + period_column,
+                        "current_" + segmentation,
+                        "previous_" + segmentation)
+
+                with metrics.stage("encode", rows=len(post_strata)) as metric:
+                    strata_patch = strata_io.encode_strata_patch(
+                        post_strata[segmentation], good_segmentation)
+                    anomalies_out = strata_io.encode_dataframe(anomalies)
+                    metric["bytes"] = len(strata_patch["codes"]) + len(anomalies_out)
+                final_output = {"strata_patch": strata_patch, "anomalies": anomalies_out}
+            else:
+                # Perform mismatch detection
+                with metrics.stage("mismatch_detection", rows=len(post_strata)):
+                    strata_check, anomalies = strata_mismatch_detector(
+                        post_strata,
+                        current_period,
+                        period_column,
+                        reference,
+                        segmentation,
+                        "good_" + segmentation,
+                        "current_" + period_column,
+                        "previous_" + period_column,
+                        "current_" + segmentation,
+                        "previous_" + segmentation)
+
+                if anomaly_row_numbers:
+                    # The wrangler merges the anomalies of each shard back into the
+                    # order of a single run by the row of their current strata.
+                    anomalies = strata_io.number_anomalies(
+                        anomalies, post_strata, current_period, period_column,
+                        reference, segmentation, "current_" + segmentation)
+
+                if output_columns:
+                    strata_check = strata_check[output_columns]
+
+                with metrics.stage("encode", rows=len(strata_check)) as metric:
+                    anomalies_out = strata_io.encode_dataframe(anomalies)
+                    if data_transport == "s3":
+                        json_out = strata_io.encode_dataframe(strata_check)
+                    else:
+                        json_out = strata_io.encode_dataframe(strata_check,
+                                                              data_transport)
+                    metric["bytes"] = len(json_out) + len(anomalies_out)
+
+                if data_transport == "s3":
+                    with metrics.stage("s3_write", rows=len(strata_check),
+                                       size=len(json_out)):
+                        aws_functions.save_to_s3(bucket_name, out_file_name, json_out)
+                    logger.info("Successfully sent data to s3")
+                    final_output = {"anomalies": anomalies_out}
+                else:
+                    final_output = {"data": json_out, "anomalies": anomalies_out}
+
+        final_output["metrics"] = metrics.summary()
+
+        if result_file_name:
+            # An asynchronous run is finished by the wrangler's completion stage,
+            # which is triggered by the result landing in s3.
+            save_result(bucket_name, result_file_name, completion,
+                        dict(final_output, success=True))
+            logger.info("Successfully sent result to s3")
 
     except Exception as e:
         error_message = general_functions.handle_exception(e,
@@ -127,15 +423,163 @@ def lambda_handler(event, context):
                                                            context=context,
                                                            bpm_queue_url=bpm_queue_url)
     finally:
+        if profiler is not None:
+            # Sharded runs invoke the method more than once, so each profile gets a
+            # name of its own.
+            profiler.save(bucket_name,
+                          f"{PROFILE_PREFIX}{run_id}/method_{uuid.uuid4().hex[:8]}",
+                          logger)
         if (len(error_message)) > 0:
             logger.error(error_message)
-            return {"success": False, "error": error_message}
+            final_output = {"success": False, "error": error_message}
+            if result_file_name:
+                save_result(bucket_name, result_file_name, completion, final_output)
+            return final_output
 
     logger.info("Successfully completed module: " + current_module)
     final_output["success"] = True
     return final_output
 
 
+def stream_strata(bucket_name, in_file_name, out_file_name, chunk_size,
+                  chunk_partitions, current_period, period_column, reference,
+                  segmentation, value_column, region_column, strata_column,
+                  survey_column, strata_rules, output_columns, metrics, logger):
+    """
+    Runs the method over an input file in s3 a chunk at a time, so the full rows of the
+    file are never all in memory. The first pass keeps only the reference, strata and
+    period of each row to find the mismatches, and a second patches the strata and
+    uploads the output as it goes. The first pass holds those columns for every row, so
+    with chunk partitions it is split into a pass over the rows of each partition of
+    the references, merged like shards.
+    :param bucket_name: Name of the bucket holding the input and output.
+    :param in_file_name: Name of the input file.
+    :param out_file_name: Name of the output file.
+    :param chunk_size: Most rows in each chunk.
+    :param chunk_partitions: Number of partitions of the references.
+    :param current_period: The current period of the run.
+    :param period_column: Column name of the period.
+    :param reference: Column name of the reference.
+    :param segmentation: Column name of the strata.
+    :param value_column: Column name of the Q608 total.
+    :param region_column: Column name of the region code.
+    :param strata_column: Column name the strata is calculated into.
+    :param survey_column: Column name of the survey code.
+    :param strata_rules: DataFrame of the strata rules.
+    :param output_columns: List of the column names to output, or None for all.
+    :param metrics: StageMetrics of the run.
+    :param logger: Logger of the run.
+    :return: DataFrame of the anomalies.
+    """
+    compact_chunk = partial(strata_io.compact_dataframe,
+                            int32_columns=[period_column, region_column],
+                            int64_columns=[reference])
+    mismatch_columns = [reference, segmentation, period_column]
+    if chunk_partitions > 1:
+        mismatch_columns.append(strata_io.ROW_NUMBER_COLUMN)
+    # The columns which are floats in any chunk, so the second pass reads them as floats
+    # in every chunk, as they are read from the whole file.
+    float_columns = set()
+    good_strata = []
+    partition_anomalies = []
+    for partition in range(chunk_partitions):
+        with metrics.stage("strata") as metric:
+            compact_data = pd.concat(
+                [chunk[mismatch_columns] for chunk in assign_strata_chunks(
+                    strata_io.partition_chunks(
+                        strata_io.record_float_columns(
+                            strata_io.read_json_chunks(bucket_name, in_file_name,
+                                                       chunk_size, compact_chunk),
+                            float_columns),
+                        reference, partition, chunk_partitions),
+                    value_column, region_column, strata_column, survey_column,
+                    strata_rules)] or [pd.DataFrame(columns=mismatch_columns)],
+                ignore_index=True)
+            metric["rows"] = len(compact_data)
+        logger.info("Successfully ran calculation")
+
+        with metrics.stage("mismatch_detection", rows=len(compact_data)):
+            good_segmentation, anomalies = find_strata_mismatches(
+                compact_data,
+                current_period,
+                period_column,
+                reference,
+                segmentation,
+                "good_" + segmentation,
+                "current_" + period_column,
+                "previous_" + period_column,
+                "current_" + segmentation,
+                "previous_" + segmentation)
+            if chunk_partitions > 1:
+                anomalies = strata_io.number_anomalies(
+                    anomalies, compact_data, current_period, period_column,
+                    reference, segmentation, "current_" + segmentation)
+        if good_segmentation is not None:
+            good_strata.append(good_segmentation)
+        partition_anomalies.append(anomalies)
+        compact_data = None
+
+    good_segmentation = pd.concat(good_strata) if good_strata else None
+    if chunk_partitions > 1:
+        anomalies = strata_io.merge_shard_anomalies(
+            partition_anomalies, None, current_period, period_column, reference)
+
+    strata_chunks = assign_strata_chunks(
+        (strata_io.apply_float_columns(chunk, float_columns)
+         for chunk in strata_io.read_json_chunks(bucket_name, in_file_name, chunk_size,
+                                                 compact_chunk)),
+        value_column, region_column, strata_column, survey_column,
+        strata_rules)
+    if good_segmentation is not None:
+        strata_chunks = (
+            strata_io.apply_good_strata(chunk, reference, segmentation,
+                                        good_segmentation)
+            for chunk in strata_chunks)
+    if output_columns:
+        strata_chunks = (chunk[output_columns] for chunk in strata_chunks)
+
+    with metrics.stage("s3_write") as metric:
+        with strata_io.S3MultipartWriter(bucket_name, out_file_name) as writer:
+            metric["rows"] = strata_io.write_json_chunks(strata_chunks, writer)
+        metric["bytes"] = writer.size
+    logger.info("Successfully sent data to s3")
+
+    return anomalies
+
+
+def save_result(bucket_name, result_file_name, completion, final_output):
+    """
+    Saves the result of an asynchronous run to s3, along with the wrangler's runtime
+    variables so the completion stage can finish the run.
+    :param bucket_name: Name of the bucket to save to.
+    :param result_file_name: Name of the result file.
+    :param completion: Dict of the wrangler's runtime variables.
+    :param final_output: Dict of the method output.
+    """
+    aws_functions.save_to_s3(bucket_name, result_file_name,
+                             strata_io.get_json_codec().dumps(
+                                 {"RuntimeVariables": completion,
+                                  "result": final_output}))
+
+
+def save_failed_result(event, final_output):
+    """
+    Saves the result of an asynchronous run which failed before its runtime variables
+    were validated, taking where to save it straight from the event, so the completion
+    stage still finishes the run. Synchronous runs save nothing.
+    :param event: Event Object.
+    :param final_output: Dict of the method output.
+    :return: The method output.
+    """
+    runtime_variables = event.get("RuntimeVariables", {})
+    if runtime_variables.get("bucket_name") and runtime_variables.get("result_file_name"):
+        save_result(runtime_variables["bucket_name"],
+                    runtime_variables["result_file_name"],
+                    runtime_variables.get("completion"), final_output)
+
+    return final_output
+
+
 def calculate_strata(row, value_column, region_column, strata_column, survey_column):
     """
     Calculates the strata for the reference based on Land or Marine value, question total
@@ -180,14 +624,189 @@ def calculate_strata(row, value_column, region_column, strata_column, survey_col
     return row
 
 
+def assign_strata(data, value_column, region_column, strata_column, survey_column,
+                  strata_rules=None):
+    """
+    Columnar equivalent of calculate_strata. Calculates the strata for every reference
+    using the compiled strata rules, so each row costs a binary search of the survey's
+    breakpoints rather than a cascade of comparisons.
+    A value moves into the next band when it is greater than the breakpoint, and a
+    region moves into the next band when it is at least the breakpoint, matching the
+    comparisons in calculate_strata. Rows with a None value or a survey which has no
+    rule get a blank strata.
+    :param data: DataFrame containing the data to calculate strata for.
+    :param value_column: Column of the dataframe containing the Q608 total.
+    :param region_column: Column name of the dataframe containing the region code.
+    :param strata_column: Column of dataframe for the strata_column to be held.
+    :param survey_column: Column name of the dataframe containing the survey code.
+    :param strata_rules: Compiled strata rules, from get_strata_rules. Defaults to the
+        066/076 rules.
+    :return: data: Copy of the DataFrame including the strata.
+    """
+    if strata_rules is None:
+        strata_rules = get_strata_rules()
+
+    data = data.copy()
+
+    value = data[value_column]
+    region = data[region_column].to_numpy()
+    survey = data[survey_column]
+
+    # calculate_strata leaves the strata blank for None values, whereas NaN values
+    # fall through its comparisons, so the two have to be told apart.
+    missing = np.zeros(len(data), dtype=bool)
+    if value.dtype == object:
+        missing = np.equal(value.to_numpy(dtype=object), None)
+        value = value.where(~missing).astype(float)
+    value = value.to_numpy()
+
+    strata = np.full(len(data), "", dtype=object)
+    for survey_code, rule in strata_rules.items():
+        in_survey = (survey == survey_code).to_numpy() & ~missing
+        if not in_survey.any():
+            continue
+
+        survey_value = value[in_survey]
+        band = np.searchsorted(rule.breakpoints, survey_value, side="left")
+        survey_strata = rule.strata[band]
+
+        # A NaN value can't be placed in a band, so it only gets a strata when the
+        # survey doesn't have any bands.
+        if len(rule.breakpoints) > 0:
+            survey_strata[np.isnan(survey_value.astype(float))] = ""
+
+        survey_region = region[in_survey]
+        for split_band, (region_breakpoints, region_strata) in rule.regions.items():
+            in_band = band == split_band
+            band_region = survey_region[in_band].astype(float)
+            band_strata = region_strata[
+                np.searchsorted(region_breakpoints, band_region, side="right")]
+            # Without a region the row can't be split, so like calculate_strata it
+            # stays in the band below.
+            band_strata[np.isnan(band_region)] = \
+                rule.strata[split_band - 1] if split_band > 0 else ""
+            survey_strata[in_band] = band_strata
+
+        strata[in_survey] = survey_strata
+
+    data[strata_column] = strata
+
+    return data
+
+
+def assign_strata_chunks(chunks, value_column, region_column, strata_column,
+                         survey_column, strata_rules=None):
+    """
+    Runs assign_strata over each chunk of the data as it is needed.
+    :param chunks: Iterable of DataFrames of the chunks of data.
+    :param value_column: Column of the dataframe containing the Q608 total.
+    :param region_column: Column name of the dataframe containing the region code.
+    :param strata_column: Column of dataframe for the strata_column to be held.
+    :param survey_column: Column name of the dataframe containing the survey code.
+    :param strata_rules: Compiled strata rules, from get_strata_rules. Defaults to the
+        066/076 rules.
+    :return: Generator of copies of the chunks including the strata.
+    """
+    for chunk in chunks:
+        yield assign_strata(chunk, value_column, region_column, strata_column,
+                            survey_column, strata_rules)
+
+
+def assign_strata_from_store(data, store, current_period, period_column, reference,
+                             value_column, region_column, strata_column,
+                             survey_column, strata_rules=None):
+    """
+    Incremental equivalent of assign_strata. Only the current period rows are
+    calculated, and the strata of other periods are looked up from the strata store.
+    Rows which aren't in the store, or whose reference and period appear more than
+    once in the data, are calculated as well so the result is always the same as
+    assign_strata's.
+    :param data: DataFrame containing the data to calculate strata for.
+    :param store: DataFrame of the stored strata, from read_strata_store.
+    :param current_period: The current period of the run.
+    :param period_column: Column name of the dataframe containing the period.
+    :param reference: Column name of the dataframe containing the reference.
+    :param value_column: Column of the dataframe containing the Q608 total.
+    :param region_column: Column name of the dataframe containing the region code.
+    :param strata_column: Column of dataframe for the strata_column to be held.
+    :param survey_column: Column name of the dataframe containing the survey code.
+    :param strata_rules: Compiled strata rules, from get_strata_rules. Defaults to the
+        066/076 rules.
+    :return: Tuple of a copy of the DataFrame including the strata, and a boolean
+        array of the rows which were calculated.
+    """
+    keys = pd.MultiIndex.from_arrays([data[reference].to_numpy(),
+                                      data[period_column].to_numpy()])
+    stored_keys = pd.MultiIndex.from_arrays([store[reference].to_numpy(),
+                                             store[period_column].to_numpy()])
+    stored_rows = stored_keys.get_indexer(keys)
+
+    calculated = (data[period_column] == int(current_period)).to_numpy() | \
+        (stored_rows == -1) | keys.duplicated(keep=False)
+
+    strata = np.full(len(data), "", dtype=object)
+    strata[~calculated] = store[strata_column].to_numpy()[stored_rows[~calculated]]
+    if calculated.any():
+        strata[calculated] = assign_strata(
+            data[calculated], value_column, region_column, strata_column,
+            survey_column, strata_rules)[strata_column].to_numpy()
+
+    data = data.copy()
+    data[strata_column] = strata
+
+    return data, calculated
+
+
+def get_strata_rules(strata_rules=None):
+    """
+    Validates and compiles a strata rule table into sorted breakpoint arrays. The rule
+    table maps each survey code to its value breakpoints and strata, with optional
+    region splits of a strata, for example:
+    {"066": {"breakpoints": [29999], "strata": ["E", "D"],
+             "regions": {"D": {"breakpoints": [10], "strata": ["D1", "D2"]}}}}
+    Compiled tables are cached for the life of the container.
+    :param strata_rules: JSON string of the rule table. Defaults to the 066/076 rules.
+    :return: Dict of survey code to CompiledStrataRule.
+    """
+    if strata_rules is None:
+        strata_rules = json.dumps(DEFAULT_STRATA_RULES)
+
+    if strata_rules not in compiled_strata_rules:
+        try:
+            rule_table = json.loads(strata_rules)
+        except ValueError as e:
+            raise ValueError(f"Error validating strata rules: {e}")
+        if not isinstance(rule_table, dict):
+            raise ValueError("Error validating strata rules: Expected a JSON object.")
+
+        compiled_rules = {}
+        for survey_code, rule in rule_table.items():
+            rule = StrataRuleSchema().load(rule)
+            strata = list(rule["strata"])
+            regions = {}
+            for split_strata, region_rule in rule.get("regions", {}).items():
+                regions[strata.index(split_strata)] = (
+                    np.array(region_rule["breakpoints"], dtype=float),
+                    np.array(region_rule["strata"], dtype=object))
+            compiled_rules[survey_code] = CompiledStrataRule(
+                np.array(rule["breakpoints"], dtype=float),
+                np.array(strata, dtype=object),
+                regions)
+
+        compiled_strata_rules[strata_rules] = compiled_rules
+
+    return compiled_strata_rules[strata_rules]
+
+
 def strata_mismatch_detector(data, current_period, time, reference, segmentation,
                              stored_segmentation, current_time, previous_time,
-                             current_segmentation, previous_segmentation):
+                             current_segmentation, previous_segmentation, index=None):
     """
-    Looks only at id and strata columns. Then drops any duplicated rows (keep=false means
-    that if there is a dupe it'll drop both). If there are any rows in this DataFrame it
-    shows that the reference-strata combination was unique, and therefore the strata is
-    different between periods. (CAC = Config As Code)
+    Compares the strata of each reference in the current period with its strata in the
+    period before, its previous row once the data is ordered by reference and period.
+    Where the strata has changed, the current period strata is patched onto every row
+    of the reference and the current and previous strata are returned as an anomaly.
+    (CAC = Config As Code)
     :param data: The DataFrame the miss-match detection will be performed on.
     :param current_period: The current period of the run.
     :param time: Field name which is used as a gauge of time'. Added for CAC.
@@ -198,41 +817,161 @@ def strata_mismatch_detector(data, current_period, time, reference, segmentation
     :param previous_time: Field name of the previous time used for CAC.
     :param current_segmentation: Field name of the current segmentation used for CAC.
     :param previous_segmentation: Field name of the current segmentation used for CAC.
+    :param index: ReferenceIndex of the data, built if not given.
     :return: Success & Error on Fail or Success, Impute and distinct_values Type: JSON
     """
-    data_anomalies = data[[reference, segmentation, time]]
+    if len(data) == 0:
+        return data, data[[reference, segmentation, time]]
 
-    data_anomalies = data_anomalies.drop_duplicates(subset=[reference, segmentation],
-                                                    keep=False)
+    if index is None:
+        index = strata_io.ReferenceIndex(data, reference, time)
 
-    if data_anomalies.size > 0:
-        # Filter to only include data from the current period
-        fix_data = data_anomalies[data_anomalies[time] == int(current_period)][
-            [reference, segmentation]]
-        fix_data = fix_data.rename(columns={segmentation: stored_segmentation})
+    good_segmentation, data_anomalies = find_strata_mismatches(
+        data, current_period, time, reference, segmentation, stored_segmentation,
+        current_time, previous_time, current_segmentation, previous_segmentation,
+        index)
 
-        # Now merge these so that the fix_data strata is
-        # added as an extra column to the input data
-        data = pd.merge(data, fix_data, on=reference, how="left")
+    if good_segmentation is not None:
+        data = strata_io.apply_good_strata(data, reference, segmentation,
+                                           good_segmentation, index)
+
+    return data, data_anomalies
 
-        # We should now have a good Strata column in the dataframe - mostly containing
-        # null values, containing strata where there was anomaly using an apply method,
-        # set strata to be the good strata.
-        data[segmentation] = data.apply(
-            lambda x: x[stored_segmentation]
-            if str(x[stored_segmentation]) != "nan" else x[segmentation], axis=1)
-        data = data.drop(stored_segmentation, axis=1)
 
-        # Split on period then merge together so they're same row.
-        current_period_anomalies = data_anomalies[
-            data_anomalies[time] == int(current_period)].rename(
-            columns={segmentation: current_segmentation, time: current_time})
+def strata_mismatch_periods(data, periods, time, reference, segmentation,
+                            stored_segmentation, current_time, previous_time,
+                            current_segmentation, previous_segmentation):
+    """
+    Runs strata_mismatch_detector for each period, comparing it with the period before
+    it in the data, as separate runs over just those two periods would. One reference
+    index is built for all the periods, and the rows of every period are found with a
+    single stable sort of the period column, so each run takes the index of just its
+    two periods rather than sorting them again.
+    :param data: The DataFrame the miss-match detection will be performed on.
+    :param periods: List of the periods to run, as ints.
+    :param time: Field name which is used as a gauge of time'. Added for CAC.
+    :param reference: Field name which is used as a reference for CAC.
+    :param segmentation: Field name of the segmentation used for CAC.
+    :param stored_segmentation: Field name of stored segmentation for CAC.
+    :param current_time: Field name of the current time used for CAC.
+    :param previous_time: Field name of the previous time used for CAC.
+    :param current_segmentation: Field name of the current segmentation used for CAC.
+    :param previous_segmentation: Field name of the current segmentation used for CAC.
+    :return: List of tuples of each period and the DataFrames of its data and anomalies.
+    """
+    index = strata_io.ReferenceIndex(data, reference, time)
+    available_periods, period_rows = index.period_rows()
+
+    results = []
+    for period in periods:
+        position = np.searchsorted(available_periods, period)
+        rows = period_rows[position]
+        if position > 0:
+            rows = np.sort(np.concatenate([period_rows[position - 1], rows]))
+
+        pair_data = data.take(rows)
+        pair_data.index = pd.RangeIndex(len(pair_data))
+        strata_check, anomalies = strata_mismatch_detector(
+            pair_data, str(period), time, reference, segmentation, stored_segmentation,
+            current_time, previous_time, current_segmentation, previous_segmentation,
+            index.take(rows))
+        results.append((period, strata_check, anomalies))
 
-        prev_period_anomalies = data_anomalies[data_anomalies[time]
-                                               != int(current_period)].rename(
-            columns={segmentation: previous_segmentation, time: previous_time})
+    return results
 
-        data_anomalies = pd.merge(current_period_anomalies, prev_period_anomalies,
-                                  on=reference)
 
-    return data, data_anomalies
+def find_strata_mismatches(data, current_period, time, reference, segmentation,
+                           stored_segmentation, current_time, previous_time,
+                           current_segmentation, previous_segmentation, index=None):
+    """
+    Finds the references whose strata differs between the current period and the
+    period before it, without patching the data. Only the reference, strata and period
+    columns are used, so it can be run on a compact copy of them.
+    The reference index orders the rows by reference and period, so each reference's
+    current period follows its previous period and the two can be compared as
+    adjacent rows. Older periods are left out of the comparison. A strata is a
+    mismatch when it appears only once over the two periods, so with one row per
+    period it is simply a change. Where there is more than one row for a reference in
+    a period, the rows are matched up by strata with a second sort of just those
+    references.
+    :param data: DataFrame containing at least the reference, strata and period.
+    :param current_period: The current period of the run.
+    :param time: Field name which is used as a gauge of time'. Added for CAC.
+    :param reference: Field name which is used as a reference for CAC.
+    :param segmentation: Field name of the segmentation used for CAC.
+    :param stored_segmentation: Field name of stored segmentation for CAC.
+    :param current_time: Field name of the current time used for CAC.
+    :param previous_time: Field name of the previous time used for CAC.
+    :param current_segmentation: Field name of the current segmentation used for CAC.
+    :param previous_segmentation: Field name of the current segmentation used for CAC.
+    :param index: ReferenceIndex of the data, built if not given.
+    :return: Tuple of a Series of reference to its current period strata, or None if
+        there are no mismatches, and a DataFrame of the anomalies.
+    """
+    data_anomalies = data[[reference, segmentation, time]]
+    if len(data) == 0:
+        return None, data_anomalies
+
+    if index is None:
+        index = strata_io.ReferenceIndex(data, reference, time)
+
+    reference_codes = index.codes
+    strata_codes = pd.factorize(data[segmentation])[0]
+    order = index.order
+
+    # Mark each reference's current period block and the block before it.
+    is_current, is_previous = index.current_and_previous(int(current_period))
+
+    if len(index.block_starts) == len(data):
+        # One row per reference and period, so a current row is unique if it differs
+        # from the row before it, and a previous row if it differs from the row after.
+        sorted_strata = strata_codes[order]
+        changed = np.zeros(len(data), dtype=bool)
+        changed[1:] = is_current[1:] & is_previous[:-1] & \
+            (sorted_strata[1:] != sorted_strata[:-1])
+        unique = is_current & ~is_previous
+        unique[1:] &= ~(is_previous[:-1] & ~changed[1:])
+        unique |= np.concatenate([changed[1:], [False]]) | changed
+    else:
+        # Sort the rows of the two periods by strata within their reference, so equal
+        # strata are next to each other whichever period they're in.
+        scope = np.flatnonzero(is_current | is_previous)
+        scope_order = scope[np.lexsort((strata_codes[order][scope],
+                                        reference_codes[order][scope]))]
+        scope_references = reference_codes[order][scope_order]
+        scope_strata = strata_codes[order][scope_order]
+        repeated = (scope_references[1:] == scope_references[:-1]) & \
+            (scope_strata[1:] == scope_strata[:-1])
+        unique = np.zeros(len(data), dtype=bool)
+        unique[scope_order] = ~(np.concatenate([[False], repeated]) |
+                                np.concatenate([repeated, [False]]))
+
+    # Back to the original row order, which the output keeps.
+    unique_rows = np.zeros(len(data), dtype=bool)
+    unique_rows[order] = unique
+    current_rows = np.zeros(len(data), dtype=bool)
+    current_rows[order] = is_current
+
+    good_rows = np.flatnonzero(unique_rows & current_rows)
+    previous_rows = np.flatnonzero(unique_rows & ~current_rows)
+    if len(good_rows) == 0 and len(previous_rows) == 0:
+        return None, data_anomalies.iloc[:0]
+
+    fix_data = data_anomalies.iloc[good_rows]
+    good_segmentation = pd.Series(
+        fix_data[segmentation].to_numpy(), index=fix_data[reference].to_numpy(),
+        name=stored_segmentation)
+
+    # Pair each current row with the previous rows of its reference, in row order.
+    pair_current_rows, pair_previous_rows = index.pair_rows(good_rows, previous_rows)
+    current_period_anomalies = data_anomalies.iloc[pair_current_rows].rename(
+        columns={segmentation: current_segmentation, time: current_time})
+    prev_period_anomalies = data_anomalies[[segmentation, time]].iloc[
+        pair_previous_rows].rename(
+        columns={segmentation: previous_segmentation, time: previous_time})
+
+    data_anomalies = pd.concat(
+        [current_period_anomalies.reset_index(drop=True),
+         prev_period_anomalies.reset_index(drop=True)], axis=1)
+
+    return good_segmentation, data_anomalies
@@ -1,10 +1,34 @@
-import json
 import logging
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import unquote_plus
 
 import boto3
 from es_aws_functions import aws_functions, exception_classes, general_functions
-from marshmallow import EXCLUDE, Schema, fields
+from marshmallow import (EXCLUDE, Schema, ValidationError, fields, validate,
+                         validates_schema)
+
+import strata_cache
+import strata_io
+from strata_metrics import PROFILE_PREFIX, RunProfiler, StageMetrics
+
+# Most method invocations the wrangler will run at once when sharding.
+MAX_CONCURRENT_SHARDS = 8
+
+# Most uploads the wrangler will run at once.
+MAX_CONCURRENT_SIDE_EFFECTS = 4
+
+# Prefix of the method results of asynchronous runs, which trigger completion_handler.
+RESULT_PREFIX = "strata_results/"
+
+# Most characters Step Functions takes as the cause of a task failure.
+TASK_CAUSE_MAX_LENGTH = 32768
+
+# Seconds a cached result can be used for, and the most bytes the result cache holds,
+# unless set by the result_cache_ttl and result_cache_max_bytes environment variables.
+RESULT_CACHE_TTL = 7 * 24 * 60 * 60
+RESULT_CACHE_MAX_BYTES = 1024 * 1024 * 1024
 
 
 class EnvironmentSchema(Schema):
@@ -16,10 +40,15 @@ class EnvironmentSchema(Schema):
         raise ValueError(f"Error validating environment params: {e}")
 
     bucket_name = fields.Str(required=True)
+    json_codec = fields.Str(required=False,
+                            validate=validate.OneOf(list(strata_io.JSON_CODECS)))
     method_name = fields.Str(required=True)
     period_column = fields.Str(required=True)
     reference = fields.Str(required=True)
+    result_cache_max_bytes = fields.Int(required=False, validate=validate.Range(min=0))
+    result_cache_ttl = fields.Int(required=False, validate=validate.Range(min=0))
     segmentation = fields.Str(required=True)
+    value_column = fields.Str(required=False)
 
 
 class RuntimeSchema(Schema):
@@ -30,17 +59,66 @@ class RuntimeSchema(Schema):
         logging.error(f"Error validating runtime params: {e}")
         raise ValueError(f"Error validating runtime params: {e}")
 
+    asynchronous = fields.Bool(required=False)
     bpm_queue_url = fields.Str(required=True)
+    chunk_partitions = fields.Int(required=False, validate=validate.Range(min=1))
+    chunk_size = fields.Int(required=False, validate=validate.Range(min=1))
+    data_transport = fields.Str(required=False,
+                                validate=validate.OneOf(strata_io.DATA_TRANSPORTS))
     distinct_values = fields.List(fields.String, required=True)
     environment = fields.Str(Required=True)
     in_file_name = fields.Str(required=True)
     out_file_name = fields.Str(required=True)
-    period = fields.Str(required=True)
+    output_format = fields.Str(required=False,
+                               validate=validate.OneOf(strata_io.OUTPUT_FORMATS))
+    patch_output = fields.Bool(required=False)
+    period = fields.Str(required=False)
+    periods = strata_io.PeriodsField(required=False)
+    profile = fields.Bool(required=False)
+    project_columns = fields.Bool(required=False)
+    result_cache = fields.Bool(required=False)
+    shard_count = fields.Int(required=False, validate=validate.Range(min=1))
     sns_topic_arn = fields.Str(required=True)
+    strata_store = fields.Str(required=False)
     survey = fields.Str(required=True)
     survey_column = fields.Str(required=True)
+    task_token = fields.Str(required=False)
     total_steps = fields.Int(required=True)
 
+    @validates_schema
+    def validate_shards(self, data, **kwargs):
+        if "period" not in data and "periods" not in data:
+            raise ValidationError("A period is needed unless multiple periods are run.")
+        if data.get("shard_count", 1) > 1 and data.get("data_transport") == "s3":
+            raise ValidationError("Data can't be sharded with the s3 data transport.")
+        if data.get("shard_count", 1) > 1 and "strata_store" in data:
+            raise ValidationError("Data can't be sharded with a strata store.")
+        if "chunk_size" in data and data.get("data_transport") != "s3":
+            raise ValidationError("Data can only be streamed with the s3 data transport.")
+        if "chunk_partitions" in data and "chunk_size" not in data:
+            raise ValidationError("Partitions can only be used with a chunk size.")
+        if "periods" in data and (data.get("shard_count", 1) > 1 or
+                                  data.get("data_transport") == "s3" or
+                                  "strata_store" in data):
+            raise ValidationError("Multiple periods can't be run with sharding, the s3 "
+                                  "data transport or a strata store.")
+        if "task_token" in data and not data.get("asynchronous"):
+            raise ValidationError("A task token can only be given to an asynchronous "
+                                  "run.")
+        if data.get("asynchronous") and data.get("data_transport") != "s3":
+            raise ValidationError("Runs can only be asynchronous with the s3 data "
+                                  "transport, as an asynchronous invoke's payload is "
+                                  "too small to hold the data.")
+        if data.get("patch_output") and (data.get("shard_count", 1) > 1 or
+                                         data.get("data_transport") == "s3" or
+                                         "periods" in data):
+            raise ValidationError("Patches can't be output with sharding, the s3 data "
+                                  "transport or multiple periods.")
+        if data.get("output_format", "json") != "json" and \
+                data.get("data_transport") == "s3":
+            raise ValidationError("The output format can't be changed with the s3 data "
+                                  "transport, as the method saves the data itself.")
+
 
 def lambda_handler(event, context):
     """
@@ -61,16 +139,20 @@ def lambda_handler(event, context):
 
     # Define run_id outside of try block
     run_id = 0
+    handler_start = time.perf_counter()
     try:
         # Retrieve run_id before input validation
         # Because it is used in exception handling
         run_id = event["RuntimeVariables"]["run_id"]
         # Set up clients
-        var_lambda = boto3.client("lambda", region_name="eu-west-2")
+        var_lambda = strata_cache.get_client("lambda", boto3.client)
 
-        environment_variables = EnvironmentSchema().load(os.environ)
+        environment_variables = strata_cache.load_environment(EnvironmentSchema,
+                                                              os.environ)
+        strata_io.set_json_codec(environment_variables.get("json_codec"))
 
-        runtime_variables = RuntimeSchema().load(event["RuntimeVariables"])
+        runtime_variables = strata_cache.get_schema(RuntimeSchema).load(
+            event["RuntimeVariables"])
 
         # Environment Variables
         bucket_name = environment_variables["bucket_name"]
@@ -78,19 +160,40 @@ def lambda_handler(event, context):
         period_column = environment_variables["period_column"]
         segmentation = environment_variables["segmentation"]
         reference = environment_variables["reference"]
+        value_column = environment_variables.get("value_column")
 
         # Runtime Variables
+        asynchronous = runtime_variables.get("asynchronous", False)
         bpm_queue_url = runtime_variables["bpm_queue_url"]
-        current_period = runtime_variables["period"]
+        chunk_partitions = runtime_variables.get("chunk_partitions")
+        chunk_size = runtime_variables.get("chunk_size")
+        data_transport = runtime_variables.get("data_transport", "json")
+        current_period = runtime_variables.get("period")
+        periods = runtime_variables.get("periods")
+        profile = runtime_variables.get("profile", False)
         environment = runtime_variables['environment']
         in_file_name = runtime_variables["in_file_name"]
         out_file_name = runtime_variables["out_file_name"]
+        output_format = runtime_variables.get("output_format", "json")
+        patch_output = runtime_variables.get("patch_output", False)
+        # Projection is the default whenever the value column it needs is known.
+        project_columns = runtime_variables.get("project_columns",
+                                                value_column is not None)
         region_column = runtime_variables["distinct_values"][0]
+        result_cache = runtime_variables.get("result_cache", False)
+        shard_count = runtime_variables.get("shard_count", 1)
         sns_topic_arn = runtime_variables["sns_topic_arn"]
+        strata_store = runtime_variables.get("strata_store")
         survey = runtime_variables["survey"]
         survey_column = runtime_variables["survey_column"]
         total_steps = runtime_variables["total_steps"]
 
+        # The value column is only needed to pick the columns sent to the method.
+        if value_column is None and uses_projection(project_columns, data_transport,
+                                                    shard_count, patch_output):
+            raise ValueError("Error validating environment params: value_column is "
+                             "needed to project the columns sent to the method.")
+
     except Exception as e:
         error_message = general_functions.handle_exception(e, current_module, run_id,
                                                            context=context)
@@ -105,24 +208,23 @@ def lambda_handler(event, context):
 
         raise exception_classes.LambdaFailure(error_message)
 
+    profiler = None
+    dispatcher = SideEffectDispatcher(output_format)
     try:
 
         logger.info("Started - retrieved configuration variables.")
+        metrics = StageMetrics(logger, start=handler_start)
+        if profile:
+            profiler = RunProfiler()
 
         # Send start of module status to BPM.
         status = "IN PROGRESS"
         aws_functions.send_bpm_status(bpm_queue_url, current_module, status, run_id,
                                       current_step_num, total_steps)
 
-        data_df = aws_functions.read_dataframe_from_s3(bucket_name, in_file_name)
-        logger.info("Successfully retrieved data from s3")
-
-        data_json = data_df.to_json(orient="records")
         json_payload = {
             "RuntimeVariables": {
                 "bpm_queue_url": bpm_queue_url,
-                "current_period": current_period,
-                "data": data_json,
                 "environment": environment,
                 "period_column": period_column,
                 "reference": reference,
@@ -133,31 +235,335 @@ def lambda_handler(event, context):
                 "survey_column": survey_column
             }
         }
-        returned_data = var_lambda.invoke(FunctionName=method_name,
-                                          Payload=json.dumps(json_payload))
-        logger.info("Successfully invoked method.")
 
-        json_response = json.loads(returned_data.get("Payload").read().decode("UTF-8"))
-        logger.info("JSON extracted from method response.")
+        if current_period:
+            json_payload["RuntimeVariables"]["current_period"] = current_period
+
+        if periods:
+            json_payload["RuntimeVariables"]["periods"] = periods
+
+        if patch_output:
+            json_payload["RuntimeVariables"]["patch_output"] = patch_output
+
+        if profile:
+            json_payload["RuntimeVariables"].update({
+                "bucket_name": bucket_name,
+                "profile": profile
+            })
+
+        if strata_store:
+            json_payload["RuntimeVariables"].update({
+                "bucket_name": bucket_name,
+                "strata_store": strata_store
+            })
+
+        if result_cache:
+            with metrics.stage("cache_lookup"):
+                cache_key = get_result_cache_key(
+                    bucket_name, in_file_name, environment_variables, runtime_variables,
+                    get_method_configuration(var_lambda, method_name))
+                cached_result = strata_io.read_cached_result(
+                    bucket_name, cache_key,
+                    environment_variables.get("result_cache_ttl", RESULT_CACHE_TTL))
+
+            if cached_result is not None:
+                # The same input has already been run with the same config, so the
+                # run is finished from the cache rather than invoking the method.
+                have_anomalies = restore_result(bucket_name, cache_key, cached_result,
+                                                out_file_name, segmentation, dispatcher,
+                                                metrics, logger)
+                dispatcher.complete([
+                    (aws_functions.send_sns_message_with_anomalies, have_anomalies,
+                     sns_topic_arn, "Strata."),
+                    (aws_functions.send_bpm_status, bpm_queue_url, current_module,
+                     "DONE", run_id, current_step_num, total_steps)
+                ])
+                logger.info("Successfully sent message to sns")
+
+                return {"success": True, "cached": True, "metrics": metrics.summary()}
+
+        data_df = None
+        project_columns = uses_projection(project_columns, data_transport, shard_count,
+                                          patch_output)
+        if data_transport == "s3":
+            # The method reads and writes the data itself, so only where to find it
+            # is sent.
+            json_payload["RuntimeVariables"].update({
+                "bucket_name": bucket_name,
+                "data_transport": data_transport,
+                "in_file_name": in_file_name,
+                "out_file_name": out_file_name
+            })
+            if chunk_size:
+                json_payload["RuntimeVariables"]["chunk_size"] = chunk_size
+            if chunk_partitions:
+                json_payload["RuntimeVariables"]["chunk_partitions"] = chunk_partitions
+        else:
+            with metrics.stage("s3_read") as metric:
+                data_df = strata_io.compact_dataframe(
+                    aws_functions.read_dataframe_from_s3(bucket_name, in_file_name),
+                    [period_column, region_column], [reference])
+                data_df = strata_io.add_missing_columns(
+                    data_df, [reference, period_column, region_column, survey_column]
+                    + ([value_column] if value_column else []))
+                metric["rows"] = len(data_df)
+            logger.info("Successfully retrieved data from s3")
+
+            # Only the columns the method needs are sent when projecting, and the
+            # strata is joined back on to the full data afterwards.
+            if project_columns:
+                method_data = strata_io.project_dataframe(
+                    data_df, [reference, period_column, region_column, survey_column,
+                              value_column])
+                json_payload["RuntimeVariables"]["output_columns"] = [
+                    strata_io.ROW_NUMBER_COLUMN, reference, period_column, segmentation]
+            else:
+                method_data = data_df
+
+            if data_transport != "json":
+                json_payload["RuntimeVariables"]["data_transport"] = data_transport
+
+        if shard_count > 1:
+            # Sharding on the reference keeps all of a reference's periods together,
+            # so each shard can be checked for mismatches on its own. The method data
+            # has the rows of the full data in order, so one index serves both.
+            json_payload["RuntimeVariables"]["anomaly_row_numbers"] = True
+            with metrics.stage("serialisation", rows=len(method_data)) as metric:
+                index = strata_io.ReferenceIndex(data_df, reference, period_column)
+                shards = [strata_io.encode_dataframe(shard, data_transport) for shard in
+                          strata_io.shard_dataframe(method_data, reference, shard_count,
+                                                    index)]
+                metric["bytes"] = sum(len(shard) for shard in shards)
+
+            with metrics.stage("invoke", rows=len(method_data),
+                               size=metric["bytes"]) as metric:
+                json_responses = invoke_method_shards(var_lambda, method_name,
+                                                      json_payload, shards)
+            logger.info(f"Successfully invoked method on {len(shards)} shards.")
+
+            with metrics.stage("decode") as metric:
+                method_output = strata_io.merge_shard_data(
+                    [strata_io.decode_dataframe(json_response["data"], data_transport)
+                     for json_response in json_responses])
+                anomalies = strata_io.merge_shard_anomalies(
+                    [strata_io.decode_dataframe(json_response["anomalies"])
+                     for json_response in json_responses],
+                    data_df, current_period, period_column, reference, index)
+                metric["rows"] = len(method_output)
+            period_outputs = [{"period": None, "data": method_output,
+                               "anomalies": strata_io.encode_dataframe(anomalies)}]
+            method_metrics = [json_response.get("metrics")
+                              for json_response in json_responses]
+        else:
+            if data_transport != "s3":
+                with metrics.stage("serialisation", rows=len(method_data)) as metric:
+                    json_payload["RuntimeVariables"]["data"] = \
+                        strata_io.encode_dataframe(method_data, data_transport)
+                    metric["bytes"] = len(json_payload["RuntimeVariables"]["data"])
+
+            if asynchronous:
+                # The method saves its result to s3, which triggers completion_handler
+                # to finish the run, so the wrangler doesn't wait for it.
+                json_payload["RuntimeVariables"].update({
+                    "bucket_name": bucket_name,
+                    "completion": event["RuntimeVariables"],
+                    "result_file_name": f"{RESULT_PREFIX}{run_id}_{current_period}.json"
+                })
+                with metrics.stage("invoke"):
+                    var_lambda.invoke(
+                        FunctionName=method_name, InvocationType="Event",
+                        Payload=strata_io.get_json_codec().dumps(json_payload))
+                logger.info("Successfully invoked method asynchronously.")
+
+                # The completion stage sends the rest of the notifications.
+                dispatcher.complete([])
+
+                return {"success": True, "asynchronous": True,
+                        "metrics": metrics.summary()}
+
+            with metrics.stage("invoke"):
+                json_response = invoke_method(var_lambda, method_name, json_payload)
+            logger.info("Successfully invoked method.")
+
+            if patch_output:
+                period_outputs = get_patched_outputs(json_response, data_df, reference,
+                                                     segmentation, metrics)
+            else:
+                period_outputs = get_period_outputs(json_response, periods,
+                                                    project_columns, data_transport,
+                                                    metrics)
+            method_metrics = json_response.get("metrics")
+
+        have_anomalies = save_outputs(period_outputs, data_df, project_columns,
+                                      data_transport, bucket_name, out_file_name,
+                                      segmentation, dispatcher, metrics, logger)
+
+        if result_cache:
+            cache_result(bucket_name, cache_key, period_outputs, out_file_name,
+                         environment_variables, metrics, logger)
+
+        # Send the SNS message, then the end of module status to BPM, once everything
+        # else has finished.
+        status = "DONE"
+        dispatcher.complete([
+            (aws_functions.send_sns_message_with_anomalies, have_anomalies,
+             sns_topic_arn, "Strata."),
+            (aws_functions.send_bpm_status, bpm_queue_url, current_module, status,
+             run_id, current_step_num, total_steps)
+        ])
 
-        if not json_response["success"]:
-            raise exception_classes.MethodFailure(json_response["error"])
+        logger.info("Successfully sent message to sns")
 
-        # Push current period data onwards
-        aws_functions.save_to_s3(bucket_name, out_file_name, json_response["data"])
-        logger.info("Successfully sent data to s3")
+    except Exception as e:
+        error_message = general_functions.handle_exception(e,
+                                                           current_module,
+                                                           run_id,
+                                                           context=context,
+                                                           bpm_queue_url=bpm_queue_url)
+    finally:
+        dispatcher.close()
+        if profiler is not None:
+            profiler.save(bucket_name, f"{PROFILE_PREFIX}{run_id}/wrangler", logger)
+        if (len(error_message)) > 0:
+            logger.error(log_message)
+            raise exception_classes.LambdaFailure(error_message)
 
-        anomalies = json_response["anomalies"]
+    logger.info("Successfully completed module: " + current_module)
 
-        if anomalies != "[]":
-            aws_functions.save_to_s3(bucket_name, "Strata_Anomalies", anomalies)
-            have_anomalies = True
-        else:
-            have_anomalies = False
-        logger.info("Successfully sent anomalies to s3")
+    run_metrics = metrics.summary()
+    run_metrics["method"] = method_metrics
+    return {"success": True, "metrics": run_metrics}
+
+
+def completion_handler(event, context):
+    """
+    Finishes an asynchronous run once the method's result lands in s3, doing the steps
+    the wrangler does after the method in a synchronous run.
+    - Read the method result from s3.
+    - Send the data and anomalies to s3.
+    - Send the SNS message and the end of module status to BPM.
+    - Report the end of the run to the Step Functions task waiting on it, if any.
+
+    :param event: S3 event object for the result file, or the method's on failure
+        destination record.
+    :param context: Context object.
+    :return: Dict with "success" and the run metrics.
+    """
+    current_module = "Strata - Wrangler"
+    error_message = ""
+    bpm_queue_url = None
+    current_step_num = 3
+
+    # Define run_id and task_token outside of try block
+    run_id = 0
+    task_token = None
+    handler_start = time.perf_counter()
+    try:
+        result = read_completion_result(event)
+        task_token = result["RuntimeVariables"].get("task_token")
 
-        aws_functions.send_sns_message_with_anomalies(have_anomalies, sns_topic_arn,
-                                                      "Strata.")
+        # Retrieve run_id before input validation
+        # Because it is used in exception handling
+        run_id = result["RuntimeVariables"]["run_id"]
+
+        environment_variables = strata_cache.load_environment(EnvironmentSchema,
+                                                              os.environ)
+        strata_io.set_json_codec(environment_variables.get("json_codec"))
+
+        runtime_variables = strata_cache.get_schema(RuntimeSchema).load(
+            result["RuntimeVariables"])
+
+        # Environment Variables
+        bucket_name = environment_variables["bucket_name"]
+        period_column = environment_variables["period_column"]
+        segmentation = environment_variables["segmentation"]
+        reference = environment_variables["reference"]
+
+        # Runtime Variables
+        bpm_queue_url = runtime_variables["bpm_queue_url"]
+        data_transport = runtime_variables.get("data_transport", "json")
+        environment = runtime_variables['environment']
+        in_file_name = runtime_variables["in_file_name"]
+        out_file_name = runtime_variables["out_file_name"]
+        output_format = runtime_variables.get("output_format", "json")
+        patch_output = runtime_variables.get("patch_output", False)
+        periods = runtime_variables.get("periods")
+        profile = runtime_variables.get("profile", False)
+        project_columns = runtime_variables.get("project_columns", False)
+        region_column = runtime_variables["distinct_values"][0]
+        result_cache = runtime_variables.get("result_cache", False)
+        sns_topic_arn = runtime_variables["sns_topic_arn"]
+        survey = runtime_variables["survey"]
+        total_steps = runtime_variables["total_steps"]
+
+    except Exception as e:
+        error_message = general_functions.handle_exception(e, current_module, run_id,
+                                                           context=context)
+        send_task_result(task_token, error_message=error_message)
+        raise exception_classes.LambdaFailure(error_message)
+
+    try:
+        logger = general_functions.get_logger(survey, current_module, environment,
+                                              run_id)
+    except Exception as e:
+        error_message = general_functions.handle_exception(e, current_module,
+                                                           run_id, context=context)
+        send_task_result(task_token, error_message=error_message)
+        raise exception_classes.LambdaFailure(error_message)
+
+    profiler = None
+    dispatcher = SideEffectDispatcher(output_format)
+    try:
+        logger.info("Started - retrieved method result.")
+        metrics = StageMetrics(logger, start=handler_start)
+        if profile:
+            profiler = RunProfiler()
+
+        json_response = result["result"]
+        if not json_response["success"]:
+            raise exception_classes.MethodFailure(json_response["error"])
+
+        # The full data is read again to join the projected strata back on to.
+        project_columns = uses_projection(project_columns, data_transport, 1,
+                                          patch_output)
+        data_df = None
+        if project_columns:
+            with metrics.stage("s3_read") as metric:
+                data_df = strata_io.compact_dataframe(
+                    aws_functions.read_dataframe_from_s3(bucket_name, in_file_name),
+                    [period_column, region_column], [reference])
+                data_df = strata_io.add_missing_columns(
+                    data_df, [reference, period_column, region_column])
+                metric["rows"] = len(data_df)
+            logger.info("Successfully retrieved data from s3")
+
+        if patch_output:
+            period_outputs = get_patched_outputs(json_response, data_df, reference,
+                                                 segmentation, metrics)
+        else:
+            period_outputs = get_period_outputs(json_response, periods, project_columns,
+                                                data_transport, metrics)
+
+        have_anomalies = save_outputs(period_outputs, data_df, project_columns,
+                                      data_transport, bucket_name, out_file_name,
+                                      segmentation, dispatcher, metrics, logger)
+
+        if result_cache:
+            cache_key = get_result_cache_key(
+                bucket_name, in_file_name, environment_variables, runtime_variables,
+                get_method_configuration(strata_cache.get_client("lambda", boto3.client),
+                                         environment_variables["method_name"]))
+            cache_result(bucket_name, cache_key, period_outputs, out_file_name,
+                         environment_variables, metrics, logger)
+
+        # Send the SNS message, then the end of module status to BPM.
+        status = "DONE"
+        dispatcher.complete([
+            (aws_functions.send_sns_message_with_anomalies, have_anomalies,
+             sns_topic_arn, "Strata."),
+            (aws_functions.send_bpm_status, bpm_queue_url, current_module, status,
+             run_id, current_step_num, total_steps)
+        ])
 
         logger.info("Successfully sent message to sns")
 
@@ -168,14 +574,422 @@ def lambda_handler(event, context):
                                                            context=context,
                                                            bpm_queue_url=bpm_queue_url)
     finally:
+        dispatcher.close()
+        if profiler is not None:
+            profiler.save(bucket_name, f"{PROFILE_PREFIX}{run_id}/completion", logger)
         if (len(error_message)) > 0:
-            logger.error(log_message)
+            logger.error(error_message)
+            send_task_result(task_token, error_message=error_message)
             raise exception_classes.LambdaFailure(error_message)
 
     logger.info("Successfully completed module: " + current_module)
 
-    # Send end of module status to BPM.
-    status = "DONE"
-    aws_functions.send_bpm_status(bpm_queue_url, current_module, status, run_id,
-                                  current_step_num, total_steps)
-    return {"success": True}
+    run_metrics = metrics.summary()
+    run_metrics["method"] = json_response.get("metrics")
+    final_output = {"success": True, "metrics": run_metrics}
+    send_task_result(task_token, final_output)
+    return final_output
+
+
+def read_completion_result(event):
+    """
+    Gets the result of an asynchronous run from the event which triggered the
+    completion stage. That is either the result file the method saved landing in s3,
+    or the method's on failure destination record, when it failed without saving one,
+    such as by timing out.
+    :param event: S3 event object, or on failure destination record.
+    :return: Dict of the wrangler's runtime variables and the method result.
+    """
+    if "requestPayload" in event:
+        method_runtime_variables = event["requestPayload"]["RuntimeVariables"]
+        response = event.get("responsePayload") or {}
+        error = response.get("errorMessage", event["requestContext"]["condition"])
+
+        return {"RuntimeVariables": method_runtime_variables["completion"],
+                "result": {"success": False, "error": error}}
+
+    s3_event = event["Records"][0]["s3"]
+
+    return strata_io.get_json_codec().loads(strata_io.read_s3_text(
+        s3_event["bucket"]["name"], unquote_plus(s3_event["object"]["key"])))
+
+
+def send_task_result(task_token, final_output=None, error_message=None):
+    """
+    Reports the end of an asynchronous run to the Step Functions task waiting on it,
+    whose task token was passed through the method.
+    :param task_token: Task token of the run, or None if nothing is waiting on it.
+    :param final_output: Dict of the completion output of a successful run.
+    :param error_message: Error message of a failed run.
+    """
+    if task_token is None:
+        return
+
+    step_functions = strata_cache.get_client("stepfunctions", boto3.client)
+    if error_message is None:
+        step_functions.send_task_success(
+            taskToken=task_token, output=strata_io.get_json_codec().dumps(final_output))
+    else:
+        step_functions.send_task_failure(taskToken=task_token, error="LambdaFailure",
+                                         cause=error_message[:TASK_CAUSE_MAX_LENGTH])
+
+
+def uses_projection(project_columns, data_transport, shard_count, patch_output=False):
+    """
+    Works out whether only the columns the method needs are sent to it, which the
+    binary encodings, sharding and patch output always do. The s3 transport never
+    sends the data.
+    :param project_columns: The project_columns runtime variable.
+    :param data_transport: How the data is passed to the method.
+    :param shard_count: Number of shards the data is split into.
+    :param patch_output: Whether the method returns patches rather than the data.
+    :return: True if the data is projected.
+    """
+    if data_transport == "s3":
+        return False
+
+    return project_columns or data_transport != "json" or shard_count > 1 or \
+        patch_output
+
+
+def get_period_outputs(json_response, periods, project_columns, data_transport,
+                       metrics):
+    """
+    Gets the data and anomalies of each period from the method response, decoding
+    projected data so it can be joined back on.
+    :param json_response: Dict of the method response.
+    :param periods: The periods of a multi-period run, or None.
+    :param project_columns: Whether the method was sent projected data.
+    :param data_transport: How the data was passed to the method.
+    :param metrics: StageMetrics of the run.
+    :return: List of dicts of the period (None for a single period run), data and
+        anomalies.
+    """
+    # A multi-period run gives the data and anomalies of each period.
+    if periods:
+        period_outputs = json_response["periods"]
+    else:
+        period_outputs = [{"period": None, "data": json_response.get("data"),
+                           "anomalies": json_response["anomalies"]}]
+
+    if project_columns:
+        with metrics.stage("decode") as metric:
+            for period_output in period_outputs:
+                period_output["data"] = strata_io.decode_dataframe(
+                    period_output["data"], data_transport)
+            metric["rows"] = sum(len(period_output["data"])
+                                 for period_output in period_outputs)
+
+    return period_outputs
+
+
+def get_patched_outputs(json_response, data_df, reference, segmentation, metrics):
+    """
+    Gets the data and anomalies from a method response of strata and patches, applying
+    them to the data held by the wrangler so the data can be joined back on as if it
+    had been returned by the method.
+    :param json_response: Dict of the method response.
+    :param data_df: DataFrame of the full input data, in the order it was sent.
+    :param reference: Column name of the reference.
+    :param segmentation: Column name of the strata.
+    :param metrics: StageMetrics of the run.
+    :return: List of a dict of the period (None), data and anomalies.
+    """
+    with metrics.stage("decode", rows=len(data_df)) as metric:
+        method_output = strata_io.apply_strata_patch(
+            data_df, json_response["strata_patch"], reference, segmentation)
+        metric["bytes"] = len(json_response["strata_patch"]["codes"])
+
+    return [{"period": None, "data": method_output,
+             "anomalies": json_response["anomalies"]}]
+
+
+def save_outputs(period_outputs, data_df, project_columns, data_transport, bucket_name,
+                 out_file_name, segmentation, dispatcher, metrics, logger):
+    """
+    Sends the data of each period to s3, unless the method has already done so, along
+    with any anomalies, in the dispatcher's output format. The files are uploaded at
+    the same time, and each period's upload overlaps encoding the next, but they have
+    all been saved on return.
+    :param period_outputs: List of dicts of the period, data and anomalies.
+    :param data_df: DataFrame of the full input data, needed if it was projected.
+    :param project_columns: Whether the method was sent projected data.
+    :param data_transport: How the data was passed to the method.
+    :param bucket_name: Name of the bucket to save to.
+    :param out_file_name: Name of the output file of a single period run.
+    :param segmentation: Column name of the strata.
+    :param dispatcher: SideEffectDispatcher of the run.
+    :param metrics: StageMetrics of the run.
+    :param logger: Logger of the run.
+    :return: True if there were any anomalies.
+    """
+    if data_transport != "s3":
+        for period_output in period_outputs:
+            if project_columns:
+                with metrics.stage("encode", rows=len(period_output["data"])) as metric:
+                    output_data = strata_io.join_projected_dataframe(
+                        data_df, period_output["data"], [segmentation])
+                    # Other formats are encoded as they are uploaded.
+                    if dispatcher.output_format == "json":
+                        output_data = strata_io.encode_dataframe(output_data)
+                        metric["bytes"] = len(output_data)
+            else:
+                output_data = period_output["data"]
+
+            output_file_name = get_output_file_name(out_file_name,
+                                                    period_output["period"])
+            dispatcher.upload(bucket_name, output_file_name, output_data)
+
+    have_anomalies = False
+    for period_output in period_outputs:
+        if period_output["anomalies"] != "[]":
+            anomalies_file_name = "Strata_Anomalies"
+            if period_output["period"] is not None:
+                anomalies_file_name += f"_{period_output['period']}"
+            dispatcher.upload(bucket_name, anomalies_file_name,
+                              period_output["anomalies"])
+            have_anomalies = True
+
+    if dispatcher.uploads:
+        with metrics.stage("s3_write") as metric:
+            metric["bytes"] = dispatcher.wait()
+    if data_transport != "s3":
+        logger.info("Successfully sent data to s3")
+    logger.info("Successfully sent anomalies to s3")
+
+    return have_anomalies
+
+
+def get_output_file_name(out_file_name, period):
+    """
+    Gets the name of the output file of a period.
+    :param out_file_name: Name of the output file of a single period run.
+    :param period: The period of a multi-period run, or None.
+    :return: Name of the output file.
+    """
+    if period is None:
+        return out_file_name
+
+    return strata_io.period_file_name(out_file_name, period)
+
+
+def get_method_configuration(var_lambda, method_name):
+    """
+    Gets what the method's outputs depend on from its configuration, without invoking
+    it: the hash of its code, its layers and its environment variables, which hold its
+    strata rules and the columns it reads and writes.
+    :param var_lambda: Boto3 lambda client.
+    :param method_name: Name of the method lambda.
+    :return: Dict of the code hash, environment variables and layer ARNs.
+    """
+    configuration = var_lambda.get_function_configuration(FunctionName=method_name)
+
+    return {
+        "code_sha256": configuration["CodeSha256"],
+        "environment": configuration.get("Environment", {}).get("Variables", {}),
+        "layers": [layer["Arn"] for layer in configuration.get("Layers", [])]
+    }
+
+
+def get_result_cache_key(bucket_name, in_file_name, environment_variables,
+                         runtime_variables, method_configuration):
+    """
+    Gets the result cache key of a run from its input file, the method's configuration
+    and everything else its outputs depend on. That includes the format the outputs
+    are saved in, and how the data is passed to the method and streamed through it,
+    which decide which lambda writes the output file and how. Sharding and projection
+    don't change the outputs, so they aren't part of the key.
+    :param bucket_name: Name of the bucket holding the input file.
+    :param in_file_name: Name of the input file.
+    :param environment_variables: Dict of the validated environment variables.
+    :param runtime_variables: Dict of the validated runtime variables.
+    :param method_configuration: Dict of the method's code hash, environment
+        variables and layers, from get_method_configuration.
+    :return: String of the key.
+    """
+    config = {
+        "method": method_configuration,
+        "method_name": environment_variables["method_name"],
+        "period_column": environment_variables["period_column"],
+        "reference": environment_variables["reference"],
+        "segmentation": environment_variables["segmentation"],
+        "value_column": environment_variables.get("value_column"),
+        "chunk_partitions": runtime_variables.get("chunk_partitions"),
+        "chunk_size": runtime_variables.get("chunk_size"),
+        "data_transport": runtime_variables.get("data_transport", "json"),
+        "output_format": runtime_variables.get("output_format", "json"),
+        "period": runtime_variables.get("period"),
+        "periods": runtime_variables.get("periods"),
+        "region_column": runtime_variables["distinct_values"][0],
+        "survey_column": runtime_variables["survey_column"]
+    }
+
+    return strata_io.result_cache_key(bucket_name, in_file_name, config)
+
+
+def cache_result(bucket_name, cache_key, period_outputs, out_file_name,
+                 environment_variables, metrics, logger):
+    """
+    Adds the outputs of a run, once saved, to the result cache, then evicts expired
+    entries and the oldest entries while the cache is over its size.
+    :param bucket_name: Name of the bucket holding the outputs and the cache.
+    :param cache_key: Key of the run, from get_result_cache_key.
+    :param period_outputs: List of dicts of the period, data and anomalies.
+    :param out_file_name: Name of the output file of a single period run.
+    :param environment_variables: Dict of the validated environment variables.
+    :param metrics: StageMetrics of the run.
+    :param logger: Logger of the run.
+    """
+    ttl = environment_variables.get("result_cache_ttl", RESULT_CACHE_TTL)
+    max_bytes = environment_variables.get("result_cache_max_bytes",
+                                          RESULT_CACHE_MAX_BYTES)
+
+    with metrics.stage("cache_write") as metric:
+        metric["bytes"] = strata_io.write_cached_result(
+            bucket_name, cache_key, period_outputs,
+            [get_output_file_name(out_file_name, period_output["period"])
+             for period_output in period_outputs])
+        evicted = strata_io.evict_cached_results(bucket_name, ttl, max_bytes)
+    logger.info(f"Successfully cached the result, evicting {evicted} old results.")
+
+
+def restore_result(bucket_name, cache_key, cached_result, out_file_name, segmentation,
+                   dispatcher, metrics, logger):
+    """
+    Saves the outputs of a run from the result cache. The data is copied within s3 and
+    the anomalies are saved from the cache entry's manifest.
+    :param bucket_name: Name of the bucket holding the cache.
+    :param cache_key: Key of the run, from get_result_cache_key.
+    :param cached_result: Dict of the cache entry's manifest.
+    :param out_file_name: Name of the output file of a single period run.
+    :param segmentation: Column name of the strata.
+    :param dispatcher: SideEffectDispatcher of the run.
+    :param metrics: StageMetrics of the run.
+    :param logger: Logger of the run.
+    :return: True if there were any anomalies.
+    """
+    period_outputs = cached_result["periods"]
+    with metrics.stage("cache_restore"):
+        strata_io.restore_cached_result(
+            bucket_name, cache_key, cached_result,
+            [get_output_file_name(out_file_name, period_output["period"])
+             for period_output in period_outputs])
+    logger.info("Successfully restored the data from the result cache.")
+
+    # The data is already in place, as with the s3 transport, so only the anomalies
+    # are saved.
+    return save_outputs(period_outputs, None, False, "s3", bucket_name, out_file_name,
+                        segmentation, dispatcher, metrics, logger)
+
+
+def invoke_method(var_lambda, method_name, json_payload):
+    """
+    Invokes the method and checks that it succeeded.
+    :param var_lambda: Boto3 lambda client.
+    :param method_name: Name of the method lambda.
+    :param json_payload: Dict of the method event.
+    :return: json_response - Dict of the method response.
+    """
+    returned_data = var_lambda.invoke(
+        FunctionName=method_name, Payload=strata_io.get_json_codec().dumps(json_payload))
+
+    json_response = strata_io.get_json_codec().loads(
+        returned_data.get("Payload").read().decode("UTF-8"))
+
+    if not json_response["success"]:
+        raise exception_classes.MethodFailure(json_response["error"])
+
+    return json_response
+
+
+def invoke_method_shards(var_lambda, method_name, json_payload, shards):
+    """
+    Invokes the method on each shard of the data, running up to MAX_CONCURRENT_SHARDS
+    invocations at once.
+    :param var_lambda: Boto3 lambda client.
+    :param method_name: Name of the method lambda.
+    :param json_payload: Dict of the method event, without the data.
+    :param shards: List of the encoded data of each shard.
+    :return: List of the method responses, in the same order as the shards.
+    """
+    def invoke_shard(shard):
+        shard_payload = {"RuntimeVariables": dict(json_payload["RuntimeVariables"],
+                                                  data=shard)}
+        return invoke_method(var_lambda, method_name, shard_payload)
+
+    with ThreadPoolExecutor(max_workers=min(len(shards),
+                                            MAX_CONCURRENT_SHARDS)) as executor:
+        return list(executor.map(invoke_shard, shards))
+
+
+class SideEffectDispatcher:
+    """
+    Runs the wrangler's uploads on a pool of threads, so uploads overlap each other and
+    the rest of the run, and complete() is the run's single completion point, where it
+    waits for every upload before sending its last notifications in order. Creating
+    boto3 clients isn't thread safe, so the s3 client the uploads share is made on the
+    thread dispatching them, and notifications, whose es_aws_functions senders make
+    their own clients, are sent on that thread too, by complete.
+    """
+
+    def __init__(self, output_format="json", max_workers=MAX_CONCURRENT_SIDE_EFFECTS):
+        self.output_format = output_format
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.client = None
+        self.uploads = []
+
+    def upload(self, bucket_name, file_name, data):
+        """
+        Starts saving a file to s3 in the output format.
+        :param bucket_name: Name of the bucket to save to.
+        :param file_name: Name of the file.
+        :param data: Records JSON string, or DataFrame, of the file contents. A
+            DataFrame can only be saved in formats other than json.
+        """
+        if self.client is None:
+            self.client = strata_cache.get_resource("s3").meta.client
+        self.uploads.append(self.executor.submit(self.save, bucket_name, file_name,
+                                                 data))
+
+    def save(self, bucket_name, file_name, data):
+        """
+        Saves a file to s3 in the output format, with the dispatcher's client.
+        :param bucket_name: Name of the bucket to save to.
+        :param file_name: Name of the file.
+        :param data: Records JSON string, or DataFrame, of the file contents.
+        :return: Number of bytes saved.
+        """
+        if self.output_format == "json":
+            # aws_functions.save_to_s3 would make its own s3 resource on this worker
+            # thread, so the object is put as it does, with the dispatcher's client.
+            self.client.put_object(Bucket=bucket_name, Key=file_name, Body=data)
+            return len(data)
+
+        return strata_io.write_output(data, bucket_name, file_name, self.output_format,
+                                      client=self.client)
+
+    def wait(self):
+        """
+        Waits for every upload started so far, raising the first error.
+        :return: Number of bytes uploaded since the last wait.
+        """
+        uploads, self.uploads = self.uploads, []
+
+        return sum(future.result() for future in uploads)
+
+    def complete(self, notifications):
+        """
+        Waits for every upload, then sends each notification in order.
+        :param notifications: List of tuples of a function which sends a notification
+            followed by its arguments.
+        """
+        self.wait()
+        for send_function, *args in notifications:
+            send_function(*args)
+
+    def close(self):
+        """
+        Waits for anything still running and stops the threads. Any errors have either
+        been raised by wait or complete, or come after the run has already failed.
+        """
+        self.executor.shutdown(wait=True)
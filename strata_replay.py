@@ -0,0 +1,144 @@
+"""
+Replays a lambda event through the wrangler, completion stage or method locally, using
+the real data in s3, optionally profiling the run with cProfile and tracemalloc.
+
+    python strata_replay.py --env-file env.json --local-method --profile-dir profile \
+        event.json
+"""
+import argparse
+import io
+import json
+import logging
+import os
+
+import strata_cache
+import strata_period_method
+import strata_period_wrangler
+from strata_metrics import RunProfiler
+
+logger = logging.getLogger("Strata - Replay")
+
+HANDLERS = {
+    "completion": strata_period_wrangler.completion_handler,
+    "method": strata_period_method.lambda_handler,
+    "wrangler": strata_period_wrangler.lambda_handler
+}
+
+# Stands in for the lambda context, which is only used for its request id.
+REPLAY_CONTEXT = {"aws_request_id": "strata-replay"}
+
+
+class LocalLambdaClient:
+    """
+    Stands in for the boto3 lambda client, running the method in this process so the
+    wrangler and method are replayed and profiled together.
+    """
+
+    def __init__(self, service_name="lambda", region_name=None):
+        self.service_name = service_name
+        self.region_name = region_name
+
+    def invoke(self, FunctionName, Payload, InvocationType="RequestResponse"):
+        output = strata_period_method.lambda_handler(json.loads(Payload),
+                                                     REPLAY_CONTEXT)
+        if InvocationType == "Event":
+            return {"StatusCode": 202, "Payload": io.BytesIO(b"")}
+
+        return {"StatusCode": 200,
+                "Payload": io.BytesIO(json.dumps(output).encode("UTF-8"))}
+
+
+def load_environment(env_file, env_values):
+    """
+    Builds the environment variables of the replay. The wrangler and method ignore
+    each other's variables, so one environment can serve both.
+    :param env_file: Name of a JSON file of the variables, or None.
+    :param env_values: List of KEY=VALUE strings, which override the file.
+    :return: Dict of the environment variables.
+    """
+    environment = {}
+    if env_file:
+        with open(env_file, "r") as file:
+            environment.update(json.load(file))
+
+    for env_value in env_values:
+        key, separator, value = env_value.partition("=")
+        if not separator:
+            raise ValueError(f"Environment variables must be KEY=VALUE: {env_value}")
+        environment[key] = value
+
+    return {key: str(value) for key, value in environment.items()}
+
+
+def replay(handler_name, event, local_method=False, profile_dir=None):
+    """
+    Runs a handler on an event, optionally profiling it locally.
+    :param handler_name: Name of the handler, one of HANDLERS.
+    :param event: Dict of the lambda event.
+    :param local_method: Whether the wrangler runs the method in process rather than
+        invoking the method lambda.
+    :param profile_dir: Directory to write the profile to, or None.
+    :return: Dict of the handler output.
+    """
+    strata_cache.clear()
+    if local_method:
+        strata_cache.get_client("lambda", LocalLambdaClient)
+
+    if profile_dir is None:
+        return HANDLERS[handler_name](event, REPLAY_CONTEXT)
+
+    # Any profiling the event asks for is covered by this profile instead.
+    profiler = RunProfiler()
+    try:
+        return HANDLERS[handler_name](event, REPLAY_CONTEXT)
+    finally:
+        os.makedirs(profile_dir, exist_ok=True)
+        profile_name = os.path.join(profile_dir, handler_name)
+        with open(profile_name + ".pstats", "wb") as file:
+            file.write(profiler.get_stats())
+        with open(profile_name + ".txt", "w") as file:
+            file.write(profiler.get_report())
+        logger.info(f"Wrote profile to {profile_name}.pstats and {profile_name}.txt")
+
+
+def parse_arguments(argv=None):
+    """
+    Parses the command line arguments.
+    :param argv: List of the arguments, defaults to sys.argv.
+    :return: Namespace of the parsed arguments.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("event_file", help="JSON file of the lambda event.")
+    parser.add_argument("--handler", choices=sorted(HANDLERS), default="wrangler")
+    parser.add_argument("--env", action="append", default=[],
+                        help="Environment variable as KEY=VALUE, can be given more "
+                             "than once.")
+    parser.add_argument("--env-file", help="JSON file of environment variables.")
+    parser.add_argument("--local-method", action="store_true",
+                        help="Run the method in process rather than invoking it.")
+    parser.add_argument("--profile-dir",
+                        help="Directory to write the cProfile and tracemalloc "
+                             "profile to.")
+
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    """
+    Replays the event, printing the handler output.
+    :param argv: List of the arguments, defaults to sys.argv.
+    """
+    arguments = parse_arguments(argv)
+    with open(arguments.event_file, "r") as file:
+        event = json.load(file)
+
+    os.environ.update(load_environment(arguments.env_file, arguments.env))
+    output = replay(arguments.handler, event, arguments.local_method,
+                    arguments.profile_dir)
+
+    print(json.dumps(output, indent=4, default=str))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    main()
@@ -1,14 +1,27 @@
+import io
 import json
+import pstats
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from unittest import mock
 
+import boto3
+import botocore.session
+import numpy as np
 import pandas as pd
 import pytest
 from es_aws_functions import exception_classes, test_generic_library
 from moto import mock_s3
 from pandas.testing import assert_frame_equal
 
+import strata_cache
+import strata_io
+import strata_local_runner
+import strata_metrics
+import strata_replay
 import strata_period_method as lambda_method_function
 import strata_period_wrangler as lambda_wrangler_function
+from benchmarks import differential_strata, synthetic_data
 
 method_environment_variables = {
     "strata_column": "strata",
@@ -57,6 +70,112 @@ wrangler_runtime_variables = {
 }
 
 
+@pytest.fixture(autouse=True)
+def clear_caches():
+    """
+    Starts every test in a new container, so clients and config cached by one test
+    aren't reused by the next.
+    """
+    strata_cache.clear()
+
+
+def replacement_method_invoke(FunctionName, Payload, InvocationType="RequestResponse"):
+    """
+    Replaces the lambda invoke by running the method in process, so the wrangler and
+    method can be tested together.
+    :param FunctionName: Name of the method being invoked.
+    :param Payload: JSON string of the method event.
+    :param InvocationType: Event for an asynchronous invoke, whose response is empty.
+    :return Dict with the method response as the Payload.
+    """
+    with mock.patch.dict(lambda_method_function.os.environ,
+                         method_environment_variables):
+        output = lambda_method_function.lambda_handler(
+            json.loads(Payload), test_generic_library.context_object)
+
+    if InvocationType == "Event":
+        return {"StatusCode": 202, "Payload": io.BytesIO(b"")}
+    return {"Payload": io.BytesIO(json.dumps(output).encode("UTF-8"))}
+
+
+def replacement_get_function_configuration(FunctionName):
+    """
+    Replaces the lambda get_function_configuration with the method's configuration,
+    its environment variables and a fixed code hash.
+    :param FunctionName: Name of the method.
+    :return Dict of the method's configuration.
+    """
+    return {"CodeSha256": "method_code_sha256", "Layers": [],
+            "Environment": {"Variables": dict(method_environment_variables)}}
+
+
+def record_dispatcher_saves(saved_files):
+    """
+    Patches the wrangler's dispatcher to record the files it saves in the json output
+    format, as well as saving them.
+    :param saved_files: Dict to record the file contents in.
+    :return Patch of SideEffectDispatcher.save.
+    """
+    save = lambda_wrangler_function.SideEffectDispatcher.save
+
+    def replacement_save(dispatcher, bucket_name, file_name, data):
+        if dispatcher.output_format == "json":
+            saved_files[file_name] = data
+        return save(dispatcher, bucket_name, file_name, data)
+
+    return mock.patch.object(lambda_wrangler_function.SideEffectDispatcher, "save",
+                             autospec=True, side_effect=replacement_save)
+
+
+def run_wrangler(runtime_variables, invoke=replacement_method_invoke, input_data=None):
+    """
+    Runs the wrangler in a mock bucket with the method run in process, returning the
+    wrangler output and the files it saved to s3.
+    :param runtime_variables: Dict of RuntimeVariables to update the defaults with.
+    :param invoke: Replacement for the lambda invoke.
+    :param input_data: DataFrame to use instead of the test input file.
+    :return Tuple of the wrangler output and a dict of the saved file contents.
+    """
+    event = {"RuntimeVariables": dict(wrangler_runtime_variables["RuntimeVariables"],
+                                      **runtime_variables)}
+
+    bucket_name = wrangler_environment_variables["bucket_name"]
+    client = boto3.client("s3", region_name="eu-west-2")
+    if bucket_name not in [bucket["Name"] for bucket in client.list_buckets()["Buckets"]]:
+        client = test_generic_library.create_bucket(bucket_name)
+    if input_data is None:
+        test_generic_library.upload_files(client, bucket_name,
+                                          ["test_wrangler_input.json"])
+    else:
+        client.put_object(Bucket=bucket_name,
+                          Key=event["RuntimeVariables"]["in_file_name"],
+                          Body=input_data.to_json(orient="records"))
+
+    saved_files = {}
+    strata_cache.clear()
+
+    def replacement_save_to_s3(bucket_name, file_name, data):
+        saved_files[file_name] = data
+        client.put_object(Bucket=bucket_name, Key=file_name, Body=data)
+
+    # The value column is set so the data can be projected.
+    with mock.patch.dict(lambda_wrangler_function.os.environ,
+                         dict(wrangler_environment_variables,
+                              value_column="Q608_total")):
+        with mock.patch("strata_period_wrangler.boto3.client") as mock_client:
+            mock_client.return_value.invoke.side_effect = invoke
+            mock_client.return_value.get_function_configuration.side_effect = \
+                replacement_get_function_configuration
+
+            with mock.patch("strata_period_wrangler.aws_functions.save_to_s3",
+                            side_effect=replacement_save_to_s3), \
+                    record_dispatcher_saves(saved_files):
+                output = lambda_wrangler_function.lambda_handler(
+                    event, test_generic_library.context_object)
+
+    return output, saved_files
+
+
 ##########################################################################################
 #                                     Generic                                            #
 ##########################################################################################
@@ -186,6 +305,96 @@ def test_calculate_strata():
     assert_frame_equal(produced_data, prepared_data)
 
 
+def test_assign_strata():
+    """
+    Runs the assign_strata function and compares it with calculate_strata, including
+    values on the boundaries, None values and unknown surveys.
+    :param None
+    :return Test Pass/Fail
+    """
+    with open("tests/fixtures/test_method_input.json", "r") as file_1:
+        file_data = file_1.read()
+    input_data = pd.DataFrame(json.loads(file_data))
+
+    boundary_data = pd.DataFrame({
+        "Q608_total": [29999, 30000, 79999, 80000, 129999, 130000, 130000,
+                       200000, 200001, None, None, 50000],
+        "region": [9, 9, 9, 9, 9, 9, 10, 10, 10, 9, 9, 9],
+        "survey": ["066", "066", "066", "066", "066", "066", "066",
+                   "066", "066", "066", "076", "999"]
+    })
+
+    for data in [input_data, boundary_data]:
+        expected_data = data.apply(
+            lambda_method_function.calculate_strata,
+            strata_column="strata",
+            value_column="Q608_total",
+            survey_column="survey",
+            region_column="region",
+            axis=1
+        )
+
+        produced_data = lambda_method_function.assign_strata(
+            data,
+            strata_column="strata",
+            value_column="Q608_total",
+            survey_column="survey",
+            region_column="region"
+        )
+
+        assert produced_data.to_json(orient="records") ==\
+            expected_data.to_json(orient="records")
+
+
+def test_assign_strata_custom_rules():
+    """
+    Runs the assign_strata function with a strata rule table from the environment.
+    :param None
+    :return Test Pass/Fail
+    """
+    strata_rules = lambda_method_function.get_strata_rules(json.dumps({
+        "066": {"breakpoints": [100], "strata": ["Y", "X"],
+                "regions": {"X": {"breakpoints": [5], "strata": ["X1", "X2"]}}},
+        "999": {"breakpoints": [], "strata": ["Z"]}
+    }))
+
+    data = pd.DataFrame({
+        "Q608_total": [100, 101, 101, 50, 50],
+        "region": [1, 4, 5, 1, 1],
+        "survey": ["066", "066", "066", "999", "076"]
+    })
+
+    produced_data = lambda_method_function.assign_strata(
+        data,
+        strata_column="strata",
+        value_column="Q608_total",
+        survey_column="survey",
+        region_column="region",
+        strata_rules=strata_rules
+    )
+
+    assert list(produced_data["strata"]) == ["Y", "X1", "X2", "Z", ""]
+
+
+@pytest.mark.parametrize(
+    "strata_rules",
+    ['["066"]',
+     '{"066": {"breakpoints": [1], "strata": ["A"]}}',
+     '{"066": {"breakpoints": [2, 1], "strata": ["A", "B", "C"]}}',
+     '{"066": {"breakpoints": [1], "strata": ["A", "B"],'
+     ' "regions": {"C": {"breakpoints": [1], "strata": ["C1", "C2"]}}}}'])
+def test_strata_rules_error(strata_rules):
+    """
+    Checks that invalid strata rule tables are rejected.
+    :param strata_rules - JSON string of the invalid rule table.
+    :return Test Pass/Fail
+    """
+    with pytest.raises(ValueError) as exc_info:
+        lambda_method_function.get_strata_rules(strata_rules)
+
+    assert "Error validating strata rules" in str(exc_info.value)
+
+
 @mock_s3
 def test_method_success():
     """
@@ -240,6 +449,152 @@ def test_strata_mismatch_detector():
     assert_frame_equal(produced_data, prepared_data)
 
 
+def test_strata_mismatch_detector_previous_period():
+    """
+    Runs the strata_mismatch_detector function over two periods, checking that the
+    previous period strata is corrected and the input DataFrame is left unchanged.
+    :param None
+    :return Test Pass/Fail
+    """
+    method_data = pd.DataFrame({
+        "responder_id": [1, 2, 1, 3, 2, 4],
+        "period": [201806, 201806, 201809, 201809, 201809, 201806],
+        "strata": ["E", "C", "D", "A", "C", "B1"]
+    })
+    input_data = method_data.copy()
+
+    produced_data, anomalies = lambda_method_function.strata_mismatch_detector(
+        method_data,
+        "201809", "period",
+        "responder_id", "strata",
+        "good_strata",
+        "current_period",
+        "previous_period",
+        "current_strata",
+        "previous_strata")
+
+    assert list(produced_data["strata"]) == ["D", "C", "D", "A", "C", "B1"]
+    assert anomalies.to_dict("records") == [{
+        "responder_id": 1,
+        "current_strata": "D",
+        "current_period": 201809,
+        "previous_strata": "E",
+        "previous_period": 201806
+    }]
+    assert_frame_equal(method_data, input_data)
+
+
+def test_strata_mismatch_detector_three_periods():
+    """
+    Runs the strata_mismatch_detector function over three periods, checking each
+    reference is only compared with its period before the current one.
+    :param None
+    :return Test Pass/Fail
+    """
+    method_data = pd.DataFrame({
+        "responder_id": [3, 1, 2, 1, 2, 3, 1, 2, 3],
+        "period": [201809, 201803, 201803, 201806, 201806, 201806, 201809, 201809,
+                   201803],
+        "strata": ["B", "A", "B", "A", "A", "B", "B", "B", "A"]
+    })
+
+    produced_data, anomalies = lambda_method_function.strata_mismatch_detector(
+        method_data,
+        "201809", "period",
+        "responder_id", "strata",
+        "good_strata",
+        "current_period",
+        "previous_period",
+        "current_strata",
+        "previous_strata")
+
+    assert list(produced_data["responder_id"]) == [3, 1, 2, 1, 2, 3, 1, 2, 3]
+    assert list(produced_data["strata"]) == ["B", "B", "B", "B", "B", "B", "B", "B",
+                                             "A"]
+    assert anomalies.to_dict("records") == [{
+        "responder_id": 1,
+        "current_strata": "B",
+        "current_period": 201809,
+        "previous_strata": "A",
+        "previous_period": 201806
+    }, {
+        "responder_id": 2,
+        "current_strata": "B",
+        "current_period": 201809,
+        "previous_strata": "A",
+        "previous_period": 201806
+    }]
+
+
+def test_reference_index():
+    """
+    Checks the reference index lookups against the joins and hashing they replace, and
+    that an index reused through take gives the same mismatches as a new one.
+    :param None
+    :return Test Pass/Fail
+    """
+    method_data = pd.DataFrame({
+        "responder_id": [3, 1, 2, 1, 2, 3, 1, 2, 3, 1, 2],
+        "period": [201809, 201803, 201803, 201806, 201806, 201806, 201809, 201809,
+                   201803, 201806, 201809],
+        "strata": ["B", "A", "B", "A", "A", "B", "B", "B", "A", "C", "C"]
+    })
+    index = strata_io.ReferenceIndex(method_data, "responder_id", "period")
+
+    current_rows = method_data.index[method_data["period"] == 201809].to_numpy()
+    previous_rows = method_data.index[method_data["period"] == 201806].to_numpy()
+    pair_current_rows, pair_previous_rows = index.pair_rows(current_rows,
+                                                            previous_rows)
+    pairs = pd.merge(method_data.iloc[current_rows].reset_index(),
+                     method_data.iloc[previous_rows].reset_index(), on="responder_id")
+    assert list(pair_current_rows) == list(pairs["index_x"])
+    assert list(pair_previous_rows) == list(pairs["index_y"])
+
+    assert list(index.first_rows(201809, [2, 4, 3])) == [7, 11, 0]
+    assert list(index.shard_ids(3)) == list(pd.util.hash_pandas_object(
+        method_data["responder_id"], index=False) % 3)
+
+    mismatch_arguments = ["201809", "period", "responder_id", "strata", "good_strata",
+                          "current_period", "previous_period", "current_strata",
+                          "previous_strata"]
+    period_rows = current_rows.tolist() + previous_rows.tolist()
+    period_rows.sort()
+    period_data = method_data.take(period_rows).reset_index(drop=True)
+    outputs = [lambda_method_function.strata_mismatch_detector(
+        period_data, *mismatch_arguments, period_index)
+        for period_index in [None, index.take(period_rows)]]
+
+    assert_frame_equal(outputs[1][0], outputs[0][0])
+    assert_frame_equal(outputs[1][1], outputs[0][1])
+    assert len(outputs[0][1]) == 4
+
+
+def test_strata_mismatch_detector_empty():
+    """
+    Runs the mismatch detection on data with no rows, with and without a reference
+    index, checking it returns the empty data and no anomalies.
+    :param None
+    :return Test Pass/Fail
+    """
+    data = pd.DataFrame({"responder_id": pd.Series([], dtype="int64"),
+                         "strata": pd.Series([], dtype=object),
+                         "period": pd.Series([], dtype="int64")})
+    index = strata_io.ReferenceIndex(data, "responder_id", "period")
+    assert len(index) == 0 and len(index.block_starts) == 0
+
+    mismatch_arguments = ["201809", "period", "responder_id", "strata", "good_strata",
+                          "current_period", "previous_period", "current_strata",
+                          "previous_strata"]
+    output, anomalies = lambda_method_function.strata_mismatch_detector(
+        data, *mismatch_arguments)
+    good_segmentation, found_anomalies = lambda_method_function.find_strata_mismatches(
+        data, *mismatch_arguments, index)
+
+    assert_frame_equal(output, data)
+    assert anomalies.empty and found_anomalies.empty
+    assert good_segmentation is None
+
+
 @mock_s3
 def test_wrangler_success_passed():
     """
@@ -291,9 +646,18 @@ def test_wrangler_success_passed():
     assert produced_dict == method_runtime_variables["RuntimeVariables"]
 
 
+def replacement_dispatcher_save(dispatcher, bucket_name, file_name, data):
+    """
+    Saves a file the wrangler's dispatcher uploads to the fixtures instead.
+    :return Number of characters saved.
+    """
+    test_generic_library.replacement_save_to_s3(bucket_name, file_name, data)
+    return len(data)
+
+
 @mock_s3
-@mock.patch('strata_period_wrangler.aws_functions.save_to_s3',
-            side_effect=test_generic_library.replacement_save_to_s3)
+@mock.patch('strata_period_wrangler.SideEffectDispatcher.save', autospec=True,
+            side_effect=replacement_dispatcher_save)
 def test_wrangler_success_returned(mock_s3_put):
     """
     Runs the wrangler function.
@@ -339,3 +703,1539 @@ def test_wrangler_success_returned(mock_s3_put):
 
     assert output
     assert_frame_equal(produced_data, prepared_data)
+
+
+@mock_s3
+@pytest.mark.parametrize(
+    "data_transport,project_columns",
+    [("json", False), ("json", True), ("parquet", False), ("s3", False)])
+def test_wrangler_data_transport(data_transport, project_columns):
+    """
+    Runs the wrangler and method together with each of the data transports, with and
+    without the columns being projected.
+    :param data_transport - Encoding used between the wrangler and method.
+    :param project_columns - Whether only the needed columns are sent to the method.
+    :return Test Pass/Fail
+    """
+    output, saved_files = run_wrangler({"data_transport": data_transport,
+                                        "project_columns": project_columns})
+    produced_data = pd.DataFrame(json.loads(saved_files["test_wrangler_output.json"]))
+
+    with open("tests/fixtures/test_wrangler_prepared_output.json", "r") as file_1:
+        test_data_prepared = file_1.read()
+    prepared_data = pd.DataFrame(json.loads(test_data_prepared)).sort_index(axis=1)
+
+    assert output["success"]
+    assert_frame_equal(produced_data.sort_index(axis=1), prepared_data)
+
+
+@mock_s3
+@pytest.mark.parametrize("data_transport", ["json", "parquet"])
+@pytest.mark.parametrize("previous_value", [150000, None])
+def test_wrangler_patch_output(data_transport, previous_value):
+    """
+    Runs the wrangler with the method returning only the strata and patches, checking
+    the same files are saved as when the method returns the data.
+    :param data_transport - Encoding used between the wrangler and method.
+    :param previous_value - Q608 total of the previous period, None giving no strata.
+    :return Test Pass/Fail
+    """
+    with open("tests/fixtures/test_wrangler_input.json", "r") as file_1:
+        current_data = pd.DataFrame(json.loads(file_1.read()))
+    previous_data = current_data.assign(period=201806, Q608_total=previous_value)
+    input_data = pd.concat([previous_data, current_data], ignore_index=True)
+
+    responses = []
+
+    def recording_invoke(**kwargs):
+        response = replacement_method_invoke(**kwargs)
+        responses.append(json.loads(response["Payload"].getvalue()))
+        return response
+
+    _, expected_files = run_wrangler({"data_transport": data_transport},
+                                     input_data=input_data)
+    output, saved_files = run_wrangler({"data_transport": data_transport,
+                                        "patch_output": True},
+                                       invoke=recording_invoke, input_data=input_data)
+
+    assert output["success"]
+    assert "data" not in responses[0] and responses[0]["strata_patch"]["patches"]
+    assert json.loads(saved_files["Strata_Anomalies"])
+    assert saved_files == expected_files
+
+
+def test_method_parquet_transport():
+    """
+    Runs the method with Parquet encoded data, returning only the requested columns.
+    :param None
+    :return Test Pass/Fail
+    """
+    with open("tests/fixtures/test_method_input.json", "r") as file_1:
+        input_data = pd.DataFrame(json.loads(file_1.read()))
+    projected_data = strata_io.project_dataframe(
+        input_data, ["responder_id", "period", "region", "survey", "Q608_total"])
+
+    runtime_variables = dict(method_runtime_variables["RuntimeVariables"],
+                             data=strata_io.encode_dataframe(projected_data, "parquet"),
+                             data_transport="parquet",
+                             output_columns=[strata_io.ROW_NUMBER_COLUMN, "strata"])
+
+    with mock.patch.dict(lambda_method_function.os.environ,
+                         method_environment_variables):
+        output = lambda_method_function.lambda_handler(
+            {"RuntimeVariables": runtime_variables},
+            test_generic_library.context_object)
+
+    produced_data = strata_io.join_projected_dataframe(
+        input_data, strata_io.decode_dataframe(output["data"], "parquet"), ["strata"])
+
+    with open("tests/fixtures/test_method_prepared_output.json", "r") as file_2:
+        prepared_data = pd.DataFrame(json.loads(file_2.read())).sort_index(axis=1)
+
+    assert output["success"]
+    assert list(strata_io.decode_dataframe(output["data"], "parquet").columns) == \
+        [strata_io.ROW_NUMBER_COLUMN, "strata"]
+    assert_frame_equal(produced_data.sort_index(axis=1), prepared_data)
+
+
+@mock_s3
+def test_method_s3_transport():
+    """
+    Runs the method with the data passed by reference, so it reads its input from and
+    writes its output to s3.
+    :param None
+    :return Test Pass/Fail
+    """
+    bucket_name = wrangler_environment_variables["bucket_name"]
+    client = test_generic_library.create_bucket(bucket_name)
+    test_generic_library.upload_files(client, bucket_name, ["test_method_input.json"])
+
+    runtime_variables = dict(method_runtime_variables["RuntimeVariables"],
+                             bucket_name=bucket_name,
+                             data_transport="s3",
+                             in_file_name="test_method_input",
+                             out_file_name="test_method_output.json")
+    runtime_variables.pop("data")
+
+    with mock.patch.dict(lambda_method_function.os.environ,
+                         method_environment_variables):
+        output = lambda_method_function.lambda_handler(
+            {"RuntimeVariables": runtime_variables},
+            test_generic_library.context_object)
+
+    produced_data = pd.DataFrame(json.loads(client.get_object(
+        Bucket=bucket_name, Key="test_method_output.json")["Body"].read()))
+
+    with open("tests/fixtures/test_method_prepared_output.json", "r") as file_1:
+        prepared_data = pd.DataFrame(json.loads(file_1.read()))
+
+    assert output["success"]
+    assert "data" not in output
+    assert_frame_equal(produced_data.sort_index(axis=1),
+                       prepared_data.sort_index(axis=1))
+
+
+@mock_s3
+@pytest.mark.parametrize("runtime_variables", [{"project_columns": True}, {}])
+def test_wrangler_project_columns(runtime_variables):
+    """
+    Runs the wrangler with projected columns, given or by default, checking that only
+    the columns used by the method are sent to it and returned from it.
+    :param runtime_variables - RuntimeVariables of a run which projects the data.
+    :return Test Pass/Fail
+    """
+    responses = []
+
+    def capture_invoke(FunctionName, Payload):
+        response = replacement_method_invoke(FunctionName, Payload)
+        responses.append((json.loads(Payload)["RuntimeVariables"],
+                          json.loads(response["Payload"].getvalue())))
+        return response
+
+    run_wrangler(runtime_variables, invoke=capture_invoke)
+
+    payload, response = responses[0]
+    sent_data = pd.read_json(payload["data"])
+    returned_data = pd.read_json(response["data"])
+
+    assert sorted(sent_data.columns) == sorted(
+        ["Q608_total", "period", "region", "responder_id", "survey",
+         strata_io.ROW_NUMBER_COLUMN])
+    assert list(returned_data.columns) == [
+        strata_io.ROW_NUMBER_COLUMN, "responder_id", "period", "strata"]
+
+
+@mock_s3
+@pytest.mark.parametrize("shard_count", [2, 5])
+def test_wrangler_shards(shard_count):
+    """
+    Runs the wrangler with the data sharded over several method invocations, checking
+    that the saved data and anomalies match a single invocation.
+    :param shard_count - Number of shards to split the data into.
+    :return Test Pass/Fail
+    """
+    with open("tests/fixtures/test_method_input.json", "r") as file_1:
+        current_data = pd.DataFrame(json.loads(file_1.read()))
+    previous_data = current_data.assign(period=201806, Q608_total=150000)
+    input_data = pd.concat([previous_data, current_data], ignore_index=True)
+
+    single_output, single_files = run_wrangler({}, input_data=input_data)
+    shard_output, shard_files = run_wrangler({"shard_count": shard_count},
+                                             input_data=input_data)
+
+    assert single_output["success"] and shard_output["success"]
+    assert json.loads(single_files["Strata_Anomalies"])
+    assert shard_files["Strata_Anomalies"] == single_files["Strata_Anomalies"]
+    assert_frame_equal(
+        pd.DataFrame(json.loads(shard_files["test_wrangler_output.json"])),
+        pd.DataFrame(json.loads(single_files["test_wrangler_output.json"])))
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_local_runner(tmp_path, workers):
+    """
+    Runs the local runner over the method input, comparing it to the method's output.
+    :param tmp_path - Directory to write the outputs to.
+    :param workers - Number of processes to run with.
+    :return Test Pass/Fail
+    """
+    strata_local_runner.main(["tests/fixtures/test_method_input.json",
+                              "--current-period", "201809",
+                              "--output-dir", str(tmp_path),
+                              "--workers", str(workers),
+                              "--compare-serial"])
+
+    with open(tmp_path / "test_method_input_201809.json", "r") as file_1:
+        produced_data = pd.DataFrame(json.loads(file_1.read()))
+
+    with open("tests/fixtures/test_method_prepared_output.json", "r") as file_2:
+        prepared_data = pd.DataFrame(json.loads(file_2.read()))
+
+    assert_frame_equal(produced_data.sort_index(axis=1),
+                       prepared_data.sort_index(axis=1))
+    assert (tmp_path / "test_method_input_201809_Strata_Anomalies.json").read_text() \
+        == "[]"
+
+
+# A reference whose first current period row isn't an anomaly, so the merged shards
+# can't be ordered by the reference's first row.
+unordered_shard_data = pd.DataFrame({
+    "responder_id": [49910000147, 49910000147, 49910000147, 49910000019, 49910000147,
+                     49910000019],
+    "period": [201806, 201809, 201806, 201809, 201809, 201806],
+    "survey": ["066", "066", None, "066", "066", "066"],
+    "region": [9.0, None, 9.0, 10.0, 9.0, None],
+    "Q608_total": [6, 29999, 29999, 200000, 200000, 200000]})
+
+
+@pytest.mark.parametrize("shard_count", [2, 3, 4, 5])
+def test_local_runner_shard_order(shard_count):
+    """
+    Runs the local runner over shards of data whose anomalies aren't in the order of
+    each reference's first row, checking they are merged back into the serial order.
+    :param shard_count - Number of shards to split the data into.
+    :return Test Pass/Fail
+    """
+    config = {"period_column": "period", "reference": "responder_id",
+              "region_column": "region", "segmentation": "strata",
+              "strata_column": "strata", "strata_rules": None,
+              "survey_column": "survey", "value_column": "Q608_total"}
+
+    with ThreadPoolExecutor(2) as executor:
+        _, shard_anomalies = strata_local_runner.run_strata_parallel(
+            unordered_shard_data, "201809", config, executor, shard_count)
+    _, serial_anomalies = strata_local_runner.run_strata(unordered_shard_data,
+                                                         "201809", config)
+
+    assert len(serial_anomalies) > 1
+    assert shard_anomalies.to_json(orient="records") == \
+        serial_anomalies.to_json(orient="records")
+
+
+def test_generate_strata_data():
+    """
+    Checks the benchmark data generator produces data shaped like the method input.
+    :param None
+    :return Test Pass/Fail
+    """
+    with open("tests/fixtures/test_method_input.json", "r") as file_1:
+        input_data = pd.DataFrame(json.loads(file_1.read()))
+
+    generated_data = synthetic_data.generate_strata_data(1000, period_count=3,
+                                                         anomaly_rate=0.5)
+
+    assert sorted(generated_data.columns) == sorted(input_data.columns)
+    assert len(generated_data) == 999
+    assert sorted(generated_data["period"].unique()) == [201803, 201806, 201809]
+    assert generated_data.groupby("responder_id")["Q608_total"].nunique().max() > 1
+
+
+def test_generate_edge_case_data():
+    """
+    Checks the differential test data covers each of the edge cases.
+    :param None
+    :return Test Pass/Fail
+    """
+    generated_data = synthetic_data.generate_edge_case_data(500)
+
+    assert set(synthetic_data.EDGE_VALUES) <= set(generated_data["Q608_total"])
+    assert set(synthetic_data.EDGE_REGIONS) <= set(generated_data["region"])
+    assert set(synthetic_data.EDGE_SURVEYS) <= set(generated_data["survey"])
+    assert generated_data["Q608_total"].isna().any()
+    assert generated_data["region"].isna().any()
+    assert set(generated_data.groupby("responder_id")["period"].nunique()) == {1, 2, 3}
+    assert generated_data.duplicated(["responder_id", "period"]).any()
+
+
+# Input with no rows, and with a single row, which every path has to handle.
+differential_empty_data = synthetic_data.generate_edge_case_data(0)
+differential_single_row_data = synthetic_data.generate_edge_case_data(
+    1, duplicate_rate=0, period_count=1)
+
+
+def test_differential_strata():
+    """
+    Checks every optimised path gives the same data and anomalies as the row-wise
+    calculate_strata and original mismatch detection, over random edge case data.
+    :param None
+    :return Test Pass/Fail
+    """
+    failures = differential_strata.run_cases(20, max_references=40)
+
+    assert [(failure["seed"], failure["path"], failure["difference"])
+            for failure in failures] == []
+
+
+@pytest.mark.parametrize("path,input_data", [
+    ("sharded", unordered_shard_data),
+    ("local_runner", unordered_shard_data),
+    # A chunk holding only None values, which has to read them as NaN like the whole
+    # file does.
+    ("chunked", pd.DataFrame({
+        "responder_id": [49910000001], "period": [201803], "survey": ["076"],
+        "region": [9.0], "Q608_total": pd.Series([None], dtype=object)}))
+])
+def test_differential_strata_cases(path, input_data):
+    """
+    Checks cases the differential tests have found.
+    :param path - Name of the optimised path.
+    :param input_data - DataFrame of the data of the case.
+    :return Test Pass/Fail
+    """
+    assert differential_strata.check_case(input_data, 0, [path]) == []
+
+
+@pytest.mark.parametrize("input_data", [differential_empty_data,
+                                        differential_single_row_data])
+def test_differential_strata_small(input_data):
+    """
+    Checks every optimised path over input with no rows and with a single row.
+    :param input_data - DataFrame of the input data.
+    :return Test Pass/Fail
+    """
+    assert differential_strata.check_case(input_data, 0) == []
+
+
+def test_differential_strata_exceptions():
+    """
+    Checks an exception is always a difference, even when both sides raise the same
+    one, as the generated data is all valid input.
+    :param None
+    :return Test Pass/Fail
+    """
+    def raise_key_error():
+        raise KeyError("strata")
+
+    raised = differential_strata.run_outputs(raise_key_error)
+
+    assert differential_strata.describe_difference(raised, raised) is not None
+    assert "KeyError raised" in differential_strata.describe_difference([], raised)
+    assert differential_strata.describe_difference([], []) is None
+
+
+@mock_s3
+@pytest.mark.parametrize("shard_count", [1, 2])
+def test_wrangler_metrics(shard_count):
+    """
+    Checks the wrangler returns the timing and memory of its stages and the method's.
+    :param shard_count - Number of shards to split the data into.
+    :return Test Pass/Fail
+    """
+    output, _ = run_wrangler({"shard_count": shard_count})
+
+    wrangler_stages = [stage["stage"] for stage in output["metrics"]["stages"]]
+    # The data is projected by default, so the method's output is always decoded and
+    # joined back on to the data.
+    assert wrangler_stages == ["s3_read", "serialisation", "invoke", "decode", "encode",
+                               "s3_write"]
+
+    method_metrics = output["metrics"]["method"]
+    if shard_count == 1:
+        method_metrics = [method_metrics]
+    for shard_metrics in method_metrics:
+        assert [stage["stage"] for stage in shard_metrics["stages"]] == \
+            ["parse", "strata", "mismatch_detection", "encode"]
+        for stage in shard_metrics["stages"]:
+            assert stage["seconds"] >= 0 and stage["peak_rss_mb"] > 0
+
+
+def test_assign_strata_from_store():
+    """
+    Checks the incremental strata match assign_strata, with only the current period
+    and the rows missing from the store calculated.
+    :param None
+    :return Test Pass/Fail
+    """
+    input_data = synthetic_data.generate_strata_data(300, period_count=3,
+                                                     anomaly_rate=0.5)
+    strata_arguments = {"strata_column": "strata", "value_column": "Q608_total",
+                        "survey_column": "survey", "region_column": "region"}
+    expected_data = lambda_method_function.assign_strata(input_data, **strata_arguments)
+
+    # Store the previous periods with every tenth row missing.
+    previous_rows = expected_data[expected_data["period"] != 201809]
+    store = previous_rows[["responder_id", "period", "strata"]].iloc[
+        [row for row in range(len(previous_rows)) if row % 10]]
+
+    produced_data, calculated = lambda_method_function.assign_strata_from_store(
+        input_data, store, "201809", "period", "responder_id", **strata_arguments)
+
+    assert_frame_equal(produced_data, expected_data)
+    assert calculated.sum() == 100 + len(previous_rows) - len(store)
+
+
+@mock_s3
+def test_wrangler_strata_store():
+    """
+    Runs the wrangler twice with a strata store, checking the store is built on the
+    first run and the output of both matches a run without it.
+    :param None
+    :return Test Pass/Fail
+    """
+    with open("tests/fixtures/test_method_input.json", "r") as file_1:
+        current_data = pd.DataFrame(json.loads(file_1.read()))
+    previous_data = current_data.assign(period=201806, Q608_total=150000)
+    input_data = pd.concat([previous_data, current_data], ignore_index=True)
+
+    expected_output, expected_files = run_wrangler({}, input_data=input_data)
+    for _ in range(2):
+        output, saved_files = run_wrangler({"strata_store": "strata_store.parquet"},
+                                           input_data=input_data)
+
+        assert output["success"]
+        assert saved_files == expected_files
+
+    store = strata_io.read_strata_store(wrangler_environment_variables["bucket_name"],
+                                        "strata_store.parquet",
+                                        ["responder_id", "period", "strata"])
+    assert sorted(store["period"].unique()) == [201806, 201809]
+    assert not store.duplicated(["responder_id", "period"]).any()
+    # The previous period is looked up, apart from the references which appear more
+    # than once in it.
+    repeated_rows = previous_data["responder_id"].duplicated(keep=False).sum()
+    assert [stage["rows"] for stage in output["metrics"]["method"]["stages"]
+            if stage["stage"] == "strata"] == [len(current_data) + repeated_rows]
+
+
+@pytest.mark.parametrize("lines", [False, True])
+def test_iter_json_records(lines):
+    """
+    Parses records JSON and line delimited JSON split into small blocks, including
+    blocks which split a record and a multi-byte character.
+    :param lines - Whether the records are line delimited.
+    :return Test Pass/Fail
+    """
+    with open("tests/fixtures/test_method_input.json", "r") as file_1:
+        records = json.loads(file_1.read())
+    records[0]["name"] = "Café [1], {2}"
+
+    if lines:
+        text = "\n".join(json.dumps(record) for record in records) + "\n"
+    else:
+        text = json.dumps(records)
+    data = text.encode("UTF-8")
+
+    blocks = [data[start:start + 7] for start in range(0, len(data), 7)]
+    assert list(strata_io.iter_json_records(blocks)) == records
+
+    with pytest.raises(ValueError):
+        list(strata_io.iter_json_records([data[:-20]]))
+
+
+def test_iter_json_chunks_nulls():
+    """
+    Parses records into chunks where a column is only nulls in one of them, checking
+    it is read as floats, as pd.read_json reads it from the whole file.
+    :param None
+    :return Test Pass/Fail
+    """
+    data = json.dumps([{"responder_id": 1, "Q608_total": 5},
+                       {"responder_id": 2, "Q608_total": None}]).encode("UTF-8")
+
+    chunks = list(strata_io.iter_json_chunks([data], 1))
+
+    assert [len(chunk) for chunk in chunks] == [1, 1]
+    assert chunks[1]["Q608_total"].dtype == float
+    assert chunks[1].to_json(orient="records") == \
+        pd.read_json(data.decode("UTF-8"), dtype=False).iloc[1:].to_json(
+            orient="records")
+
+
+@mock_s3
+@pytest.mark.parametrize("chunk_size", [1, 4, 1000])
+def test_method_streaming(chunk_size):
+    """
+    Runs the method streaming its input and output in chunks, checking the data and
+    anomalies match reading the data whole.
+    :param chunk_size - Most rows in each chunk.
+    :return Test Pass/Fail
+    """
+    with open("tests/fixtures/test_method_input.json", "r") as file_1:
+        current_data = pd.DataFrame(json.loads(file_1.read()))
+    previous_data = current_data.assign(period=201806, Q608_total=150000)
+    input_data = pd.concat([previous_data, current_data], ignore_index=True)
+
+    bucket_name = wrangler_environment_variables["bucket_name"]
+    client = test_generic_library.create_bucket(bucket_name)
+    client.put_object(Bucket=bucket_name, Key="test_method_input",
+                      Body=input_data.to_json(orient="records"))
+
+    runtime_variables = dict(method_runtime_variables["RuntimeVariables"],
+                             bucket_name=bucket_name,
+                             data_transport="s3",
+                             in_file_name="test_method_input")
+    runtime_variables.pop("data")
+
+    outputs = {}
+    for out_file_name, streaming in [("whole.json", {}),
+                                     ("streamed.json", {"chunk_size": chunk_size})]:
+        with mock.patch.dict(lambda_method_function.os.environ,
+                             method_environment_variables):
+            output = lambda_method_function.lambda_handler(
+                {"RuntimeVariables": dict(runtime_variables, out_file_name=out_file_name,
+                                          **streaming)},
+                test_generic_library.context_object)
+
+        assert output["success"]
+        outputs[out_file_name] = (
+            output["anomalies"],
+            pd.DataFrame(json.loads(client.get_object(
+                Bucket=bucket_name, Key=out_file_name)["Body"].read())))
+
+    assert json.loads(outputs["streamed.json"][0])
+    assert outputs["streamed.json"][0] == outputs["whole.json"][0]
+    assert_frame_equal(outputs["streamed.json"][1], outputs["whole.json"][1])
+
+
+@mock_s3
+@pytest.mark.parametrize("chunk_partitions", [1, 2])
+def test_method_streaming_dtypes(chunk_partitions):
+    """
+    Runs the method streaming input whose value and region columns are only floats in
+    their last chunk, checking every chunk writes them as floats, byte for byte as
+    reading the data whole does.
+    :param chunk_partitions - Number of partitions of the references.
+    :return Test Pass/Fail
+    """
+    input_data = [
+        {"responder_id": responder_id, "period": period, "survey": survey,
+         "region": region, "Q608_total": value}
+        for responder_id, period, survey, region, value in [
+            (1, 201806, "066", 9, 30000), (2, 201806, "066", 10, 200000),
+            (1, 201809, "066", 9, 30000), (2, 201809, "066", 10, 150000),
+            (3, 201809, "076", None, None)]]
+
+    bucket_name = wrangler_environment_variables["bucket_name"]
+    client = test_generic_library.create_bucket(bucket_name)
+    client.put_object(Bucket=bucket_name, Key="test_method_input",
+                      Body=json.dumps(input_data))
+
+    runtime_variables = dict(method_runtime_variables["RuntimeVariables"],
+                             bucket_name=bucket_name,
+                             data_transport="s3",
+                             in_file_name="test_method_input")
+    runtime_variables.pop("data")
+
+    outputs = {}
+    for out_file_name, streaming in [("whole.json", {}),
+                                     ("streamed.json",
+                                      {"chunk_size": 2,
+                                       "chunk_partitions": chunk_partitions})]:
+        with mock.patch.dict(lambda_method_function.os.environ,
+                             method_environment_variables):
+            output = lambda_method_function.lambda_handler(
+                {"RuntimeVariables": dict(runtime_variables, out_file_name=out_file_name,
+                                          **streaming)},
+                test_generic_library.context_object)
+
+        assert output["success"]
+        outputs[out_file_name] = (
+            output["anomalies"],
+            client.get_object(Bucket=bucket_name, Key=out_file_name)["Body"].read())
+
+    assert b'"Q608_total":30000.0' in outputs["whole.json"][1]
+    assert outputs["streamed.json"] == outputs["whole.json"]
+
+
+@mock_s3
+@pytest.mark.parametrize("chunk_partitions", [2, 3])
+def test_method_streaming_partitions(chunk_partitions):
+    """
+    Runs the method streaming its input with the mismatches found a partition of the
+    references at a time, checking the data and anomalies match a single partition and
+    each pass holds only the rows of its partition.
+    :param chunk_partitions - Number of partitions of the references.
+    :return Test Pass/Fail
+    """
+    with open("tests/fixtures/test_method_input.json", "r") as file_1:
+        current_data = pd.DataFrame(json.loads(file_1.read()))
+    previous_data = current_data.assign(period=201806, Q608_total=150000)
+    input_data = pd.concat([previous_data, current_data], ignore_index=True)
+
+    bucket_name = wrangler_environment_variables["bucket_name"]
+    client = test_generic_library.create_bucket(bucket_name)
+    client.put_object(Bucket=bucket_name, Key="test_method_input",
+                      Body=input_data.to_json(orient="records"))
+
+    runtime_variables = dict(method_runtime_variables["RuntimeVariables"],
+                             bucket_name=bucket_name,
+                             chunk_size=4,
+                             data_transport="s3",
+                             in_file_name="test_method_input")
+    runtime_variables.pop("data")
+
+    outputs = {}
+    for out_file_name, partitions in [("single.json", {}),
+                                      ("partitioned.json",
+                                       {"chunk_partitions": chunk_partitions})]:
+        with mock.patch.dict(lambda_method_function.os.environ,
+                             method_environment_variables):
+            output = lambda_method_function.lambda_handler(
+                {"RuntimeVariables": dict(runtime_variables, out_file_name=out_file_name,
+                                          **partitions)},
+                test_generic_library.context_object)
+
+        assert output["success"]
+        outputs[out_file_name] = (
+            output["anomalies"],
+            client.get_object(Bucket=bucket_name, Key=out_file_name)["Body"].read(),
+            [stage["rows"] for stage in output["metrics"]["stages"]
+             if stage["stage"] == "strata"])
+
+    assert json.loads(outputs["partitioned.json"][0])
+    assert outputs["partitioned.json"][:2] == outputs["single.json"][:2]
+    partition_rows = outputs["partitioned.json"][2]
+    assert len(partition_rows) == chunk_partitions
+    assert sum(partition_rows) == len(input_data)
+    assert max(partition_rows) < len(input_data)
+
+
+def test_partition_chunks():
+    """
+    Checks each value's rows are in the same partition whichever chunk they are in,
+    even when a chunk reads the column with another dtype, and are numbered by their
+    row in the whole data.
+    :param None
+    :return Test Pass/Fail
+    """
+    chunks = [pd.DataFrame({"responder_id": [1, 2, 3]}),
+              pd.DataFrame({"responder_id": [3.0, None, 1.0]}),
+              pd.DataFrame({"responder_id": ["x", 2, None]})]
+
+    partitions = [pd.concat(strata_io.partition_chunks(chunks, "responder_id",
+                                                       partition, 3))
+                  for partition in range(3)]
+
+    row_partitions = {}
+    for partition, partition_data in enumerate(partitions):
+        for row in partition_data[strata_io.ROW_NUMBER_COLUMN]:
+            row_partitions[row] = partition
+
+    assert sorted(row_partitions) == list(range(9))
+    assert row_partitions[0] == row_partitions[5]
+    assert row_partitions[1] == row_partitions[7]
+    assert row_partitions[2] == row_partitions[3]
+    assert row_partitions[4] == row_partitions[8] == 0
+    assert all(partition is chunk for partition, chunk in zip(
+        strata_io.partition_chunks(chunks, "responder_id", 0, 1), chunks))
+
+
+@mock_s3
+def test_method_streaming_empty():
+    """
+    Runs the method streaming input with no rows, checking it saves no data and finds
+    no anomalies.
+    :param None
+    :return Test Pass/Fail
+    """
+    bucket_name = wrangler_environment_variables["bucket_name"]
+    client = test_generic_library.create_bucket(bucket_name)
+    client.put_object(Bucket=bucket_name, Key="test_method_input", Body="[]")
+
+    runtime_variables = dict(method_runtime_variables["RuntimeVariables"],
+                             bucket_name=bucket_name,
+                             data_transport="s3",
+                             in_file_name="test_method_input",
+                             out_file_name="empty.json",
+                             chunk_size=4)
+    runtime_variables.pop("data")
+
+    with mock.patch.dict(lambda_method_function.os.environ,
+                         method_environment_variables):
+        output = lambda_method_function.lambda_handler(
+            {"RuntimeVariables": runtime_variables}, test_generic_library.context_object)
+
+    assert output["success"]
+    assert json.loads(output["anomalies"]) == []
+    assert json.loads(client.get_object(Bucket=bucket_name,
+                                        Key="empty.json")["Body"].read()) == []
+
+
+@mock_s3
+@pytest.mark.parametrize("runtime_variables", [
+    {},
+    {"project_columns": True},
+    {"data_transport": "parquet"},
+    {"data_transport": "s3"},
+    {"shard_count": 2},
+    {"patch_output": True}
+])
+def test_wrangler_empty(runtime_variables):
+    """
+    Runs the wrangler on input with no rows, whose records JSON has no columns, checking
+    each way of running the method saves no data.
+    :param runtime_variables - Dict of RuntimeVariables to run with.
+    :return Test Pass/Fail
+    """
+    output, saved_files = run_wrangler(runtime_variables, input_data=pd.DataFrame())
+
+    assert output["success"]
+    assert json.loads(saved_files["test_wrangler_output.json"]) == []
+
+
+def test_compact_dataframe():
+    """
+    Checks the compact dtypes are applied, and that the strata, anomalies and JSON
+    produced from them are unchanged.
+    :param None
+    :return Test Pass/Fail
+    """
+    input_data = pd.read_json(synthetic_data.generate_strata_data(
+        600, period_count=3, anomaly_rate=0.5).to_json(orient="records"), dtype=False)
+    input_data.loc[0, "county_name"] = None
+
+    compact_data = strata_io.compact_dataframe(input_data, ["period", "region"],
+                                               ["responder_id"])
+
+    assert compact_data["period"].dtype == "int32"
+    assert compact_data["region"].dtype == "int32"
+    assert compact_data["responder_id"].dtype == "int64"
+    assert compact_data["survey"].dtype == "category"
+    assert compact_data["gor_code"].dtype == "category"
+    assert compact_data["county_name"].dtype == object
+    assert compact_data.memory_usage(deep=True).sum() < \
+        input_data.memory_usage(deep=True).sum() / 2
+    assert compact_data.to_json(orient="records") == \
+        input_data.to_json(orient="records")
+
+    outputs = []
+    for data in [input_data, compact_data]:
+        post_strata = lambda_method_function.assign_strata(
+            data, "Q608_total", "region", "strata", "survey")
+        strata_check, anomalies = lambda_method_function.strata_mismatch_detector(
+            post_strata, "201809", "period", "responder_id", "strata", "good_strata",
+            "current_period", "previous_period", "current_strata", "previous_strata")
+        outputs.append((strata_check.to_json(orient="records"),
+                        anomalies.to_json(orient="records")))
+
+    assert json.loads(outputs[0][1])
+    assert outputs[1] == outputs[0]
+
+
+def test_apply_good_strata_categorical():
+    """
+    Patches good strata, including a None one, onto a categorical strata column,
+    checking they are patched on as they are onto an object column.
+    :param None
+    :return Test Pass/Fail
+    """
+    input_data = pd.DataFrame({"responder_id": [1, 1, 2, 3],
+                               "strata": ["A", "A", "B", "C"]})
+    good_segmentation = pd.Series(["D", None], index=[1, 2], name="good_strata")
+
+    outputs = [strata_io.apply_good_strata(
+        input_data.astype({"strata": dtype}), "responder_id", "strata",
+        good_segmentation) for dtype in [object, "category"]]
+
+    assert json.loads(outputs[1].to_json(orient="records"))[1:3] == [
+        {"responder_id": 1, "strata": "D"}, {"responder_id": 2, "strata": None}]
+    assert outputs[1].to_json(orient="records") == outputs[0].to_json(orient="records")
+
+
+@mock_s3
+@pytest.mark.parametrize("periods,data_transport", [
+    (["201806", "201809", "201812"], "json"),
+    ({"start": "201806", "end": "201901"}, "json"),
+    (["201812", "201806", "201809"], "parquet")
+])
+def test_wrangler_periods(periods, data_transport):
+    """
+    Runs the wrangler over several periods at once, checking each period's data and
+    anomalies match a run over that period and the one before it.
+    :param periods - List or range of the periods to run.
+    :param data_transport - How the data is passed to the method.
+    :return Test Pass/Fail
+    """
+    input_data = synthetic_data.generate_strata_data(
+        400, period_count=4, anomaly_rate=0.3, current_period="201812")
+
+    output, saved_files = run_wrangler({"periods": periods,
+                                        "data_transport": data_transport},
+                                       input_data=input_data)
+    assert output["success"]
+
+    for previous_period, period in [(201803, 201806), (201806, 201809),
+                                    (201809, 201812)]:
+        pair_data = input_data[input_data["period"].isin([previous_period, period])]
+        _, expected_files = run_wrangler({"period": str(period)}, input_data=pair_data)
+
+        assert json.loads(expected_files["Strata_Anomalies"])
+        assert saved_files[f"Strata_Anomalies_{period}"] == \
+            expected_files["Strata_Anomalies"]
+        assert saved_files[f"test_wrangler_output_{period}.json"] == \
+            expected_files["test_wrangler_output.json"]
+
+    assert sorted(saved_files) == sorted(
+        [f"{name}_{period}{extension}" for period in [201806, 201809, 201812]
+         for name, extension in [("Strata_Anomalies", ""),
+                                 ("test_wrangler_output", ".json")]])
+
+
+def test_select_periods():
+    """
+    Checks a list or range of periods is checked against the periods in the data.
+    :param None
+    :return Test Pass/Fail
+    """
+    period_values = [201809, 201803, 201806, 201809]
+
+    assert strata_io.select_periods(["201809", "201806"], period_values) == \
+        [201806, 201809]
+    assert strata_io.select_periods({"start": "201804", "end": "201812"},
+                                    period_values) == [201806, 201809]
+    with pytest.raises(ValueError):
+        strata_io.select_periods(["201812"], period_values)
+
+
+def test_warm_invocation():
+    """
+    Runs the method twice in one container, checking the second run reuses the
+    validated environment and reports a warm start.
+    :param None
+    :return Test Pass/Fail
+    """
+    with open("tests/fixtures/test_method_input.json", "r") as file_1:
+        runtime_variables = dict(method_runtime_variables["RuntimeVariables"],
+                                 data=file_1.read())
+
+    strata_metrics.container["invocations"] = 0
+    environment_schema = lambda_method_function.EnvironmentSchema
+    outputs = []
+    with mock.patch.dict(lambda_method_function.os.environ,
+                         method_environment_variables):
+        with mock.patch.object(environment_schema, "load",
+                               wraps=environment_schema().load) as mock_load:
+            for _ in range(2):
+                outputs.append(lambda_method_function.lambda_handler(
+                    {"RuntimeVariables": runtime_variables},
+                    test_generic_library.context_object))
+
+    assert mock_load.call_count == 1
+    assert outputs[0]["data"] == outputs[1]["data"]
+    assert outputs[0]["metrics"]["cold_start"]["cold"]
+    assert not outputs[1]["metrics"]["cold_start"]["cold"]
+    assert "init_seconds" not in outputs[1]["metrics"]["cold_start"]
+
+    with mock.patch("strata_cache.boto3.client") as mock_client:
+        assert strata_cache.get_client("lambda") is strata_cache.get_client("lambda")
+    mock_client.assert_called_once_with("lambda", region_name="eu-west-2")
+
+
+@mock_s3
+def test_wrangler_asynchronous():
+    """
+    Runs the wrangler asynchronously, then the completion stage on the method's result,
+    checking they save the same files as a synchronous run.
+    :param None
+    :return Test Pass/Fail
+    """
+    data_transport = "s3"
+    with open("tests/fixtures/test_method_input.json", "r") as file_1:
+        current_data = pd.DataFrame(json.loads(file_1.read()))
+    previous_data = current_data.assign(period=201806, Q608_total=150000)
+    input_data = pd.concat([previous_data, current_data], ignore_index=True)
+
+    _, expected_files = run_wrangler({"data_transport": data_transport},
+                                     input_data=input_data)
+    output, saved_files = run_wrangler({"asynchronous": True,
+                                        "data_transport": data_transport,
+                                        "task_token": "test_task_token"},
+                                       input_data=input_data)
+
+    result_file_name = "strata_results/bob_201809.json"
+    assert output["success"] and output["asynchronous"]
+    assert "Strata_Anomalies" not in saved_files
+
+    # The result landing in s3 triggers the completion stage.
+    bucket_name = wrangler_environment_variables["bucket_name"]
+    boto3.client("s3", region_name="eu-west-2").put_object(
+        Bucket=bucket_name, Key=result_file_name,
+        Body=saved_files.pop(result_file_name))
+
+    with mock.patch.dict(lambda_wrangler_function.os.environ,
+                         wrangler_environment_variables):
+        with mock.patch("strata_period_wrangler.boto3.client") as mock_client:
+            with record_dispatcher_saves(saved_files):
+                completion_output = lambda_wrangler_function.completion_handler(
+                    {"Records": [{"s3": {"bucket": {"name": bucket_name},
+                                         "object": {"key": result_file_name}}}]},
+                    test_generic_library.context_object)
+
+    assert completion_output["success"]
+    assert json.loads(saved_files["Strata_Anomalies"])
+    assert saved_files == expected_files
+    task_success = mock_client.return_value.send_task_success.call_args[1]
+    assert task_success["taskToken"] == "test_task_token"
+    assert json.loads(task_success["output"]) == completion_output
+
+
+@mock_s3
+@pytest.mark.parametrize("failure", ["validation", "timeout"])
+def test_wrangler_asynchronous_failure(failure):
+    """
+    Fails an asynchronous method run, either at validation, which still saves its
+    result, or by timing out, which reaches the completion stage through the method's
+    on failure destination, checking the completion stage fails the waiting task.
+    :param failure - How the method fails.
+    :return Test Pass/Fail
+    """
+    bucket_name = wrangler_environment_variables["bucket_name"]
+    client = test_generic_library.create_bucket(bucket_name)
+    result_file_name = "strata_results/bob_201809.json"
+    method_event = {"RuntimeVariables": {
+        "run_id": "bob", "bucket_name": bucket_name,
+        "result_file_name": result_file_name,
+        "completion": dict(wrangler_runtime_variables["RuntimeVariables"],
+                           asynchronous=True, data_transport="s3",
+                           task_token="test_task_token")}}
+
+    if failure == "validation":
+        with mock.patch.dict(lambda_method_function.os.environ,
+                             method_environment_variables):
+            method_output = lambda_method_function.lambda_handler(
+                method_event, test_generic_library.context_object)
+        assert not method_output["success"]
+
+        completion_event = {"Records": [{"s3": {"bucket": {"name": bucket_name},
+                                                "object": {"key": result_file_name}}}]}
+        assert json.loads(client.get_object(Bucket=bucket_name, Key=result_file_name)[
+            "Body"].read())["result"] == method_output
+    else:
+        completion_event = {
+            "requestContext": {"condition": "RetriesExhausted"},
+            "requestPayload": method_event,
+            "responsePayload": {"errorMessage": "Task timed out after 20.00 seconds"}}
+
+    with mock.patch.dict(lambda_wrangler_function.os.environ,
+                         wrangler_environment_variables):
+        with mock.patch("strata_period_wrangler.boto3.client") as mock_client, \
+                mock.patch("es_aws_functions.aws_functions.send_bpm_status"):
+            with pytest.raises(exception_classes.LambdaFailure) as exc_info:
+                lambda_wrangler_function.completion_handler(
+                    completion_event, test_generic_library.context_object)
+
+    task_failure = mock_client.return_value.send_task_failure.call_args[1]
+    assert task_failure["taskToken"] == "test_task_token"
+    assert task_failure["cause"] == exc_info.value.error_message
+    assert ("validating runtime params" if failure == "validation"
+            else "Task timed out") in task_failure["cause"]
+
+
+@mock_s3
+@pytest.mark.parametrize("data_transport", ["json", "s3"])
+def test_wrangler_result_cache(data_transport):
+    """
+    Runs the wrangler twice on the same input with the result cache, checking the
+    second run restores the same outputs without invoking the method, and that a
+    different period or an evicted result runs the method again.
+    :param data_transport - How the data is passed to the method.
+    :return Test Pass/Fail
+    """
+    with open("tests/fixtures/test_method_input.json", "r") as file_1:
+        current_data = pd.DataFrame(json.loads(file_1.read()))
+    previous_data = current_data.assign(period=201806, Q608_total=150000)
+    input_data = pd.concat([previous_data, current_data], ignore_index=True)
+
+    invocations = []
+
+    def counting_invoke(**kwargs):
+        invocations.append(kwargs["FunctionName"])
+        return replacement_method_invoke(**kwargs)
+
+    runtime_variables = {"data_transport": data_transport, "result_cache": True}
+    output, expected_files = run_wrangler(runtime_variables, invoke=counting_invoke,
+                                          input_data=input_data)
+    cached_output, saved_files = run_wrangler(runtime_variables, invoke=counting_invoke,
+                                              input_data=input_data)
+
+    bucket_name = wrangler_environment_variables["bucket_name"]
+    out_file_name = wrangler_runtime_variables["RuntimeVariables"]["out_file_name"]
+    output_data = boto3.resource("s3", region_name="eu-west-2").Object(
+        bucket_name, out_file_name).get()["Body"].read().decode("UTF-8")
+
+    assert len(invocations) == 1
+    assert "cached" not in output and cached_output["cached"]
+    assert "cache_restore" in [stage["stage"]
+                               for stage in cached_output["metrics"]["stages"]]
+    assert json.loads(saved_files["Strata_Anomalies"])
+    assert saved_files["Strata_Anomalies"] == expected_files["Strata_Anomalies"]
+    assert output_data == expected_files[out_file_name]
+
+    run_wrangler(dict(runtime_variables, period="201806"), invoke=counting_invoke,
+                 input_data=input_data)
+    assert len(invocations) == 2
+
+    assert strata_io.evict_cached_results(bucket_name, 3600, 0) == 2
+    run_wrangler(runtime_variables, invoke=counting_invoke, input_data=input_data)
+    assert len(invocations) == 3
+
+
+@mock_s3
+def test_wrangler_result_cache_strata_rules():
+    """
+    Runs the wrangler with the result cache, then again after the method's strata rules
+    change, checking the second run misses the cache and saves the new strata.
+    :param None
+    :return Test Pass/Fail
+    """
+    strata_rules = json.dumps({"066": {"breakpoints": [], "strata": ["Z"]},
+                               "076": {"breakpoints": [], "strata": ["M"]}})
+    invocations = []
+
+    def counting_invoke(**kwargs):
+        invocations.append(kwargs["FunctionName"])
+        return replacement_method_invoke(**kwargs)
+
+    _, saved_files = run_wrangler({"result_cache": True})
+    with mock.patch.dict(method_environment_variables, strata_rules=strata_rules):
+        output, changed_files = run_wrangler({"result_cache": True},
+                                             invoke=counting_invoke)
+        cached_output, _ = run_wrangler({"result_cache": True}, invoke=counting_invoke)
+    out_file_name = wrangler_runtime_variables["RuntimeVariables"]["out_file_name"]
+
+    assert "cached" not in output
+    assert "Z" not in set(pd.read_json(saved_files[out_file_name])["strata"])
+    assert "Z" in set(pd.read_json(changed_files[out_file_name])["strata"])
+    assert cached_output["cached"] and len(invocations) == 1
+
+
+@mock_s3
+def test_result_cache_key():
+    """
+    Checks the result cache key changes with the method's code and environment, the
+    data transport and the streaming, which change the output, but not with sharding.
+    :param None
+    :return Test Pass/Fail
+    """
+    bucket_name = wrangler_environment_variables["bucket_name"]
+    client = test_generic_library.create_bucket(bucket_name)
+    client.put_object(Bucket=bucket_name, Key="input", Body="[]")
+    environment_variables = dict(wrangler_environment_variables,
+                                 value_column="Q608_total")
+    configuration = {"code_sha256": "a", "environment": method_environment_variables,
+                     "layers": []}
+
+    def cache_key(runtime_variables, method_configuration=configuration):
+        return lambda_wrangler_function.get_result_cache_key(
+            bucket_name, "input", environment_variables,
+            dict(wrangler_runtime_variables["RuntimeVariables"], **runtime_variables),
+            method_configuration)
+
+    keys = [cache_key({}),
+            cache_key({}, dict(configuration, code_sha256="b")),
+            cache_key({}, dict(configuration, environment=dict(
+                method_environment_variables, value_column="Q609_total"))),
+            cache_key({"data_transport": "s3"}),
+            cache_key({"data_transport": "s3", "chunk_size": 4})]
+
+    assert len(set(keys)) == len(keys)
+    assert cache_key({"shard_count": 2}) == keys[0]
+    assert lambda_wrangler_function.get_method_configuration(
+        mock.Mock(get_function_configuration=replacement_get_function_configuration),
+        "strata_period_method") == {"code_sha256": "method_code_sha256",
+                                    "environment": method_environment_variables,
+                                    "layers": []}
+
+
+@mock_s3
+def test_profile():
+    """
+    Runs the wrangler and method with the profile runtime variable, checking each saves
+    its profile to s3 and the method run in process doesn't replace the wrangler's.
+    :param None
+    :return Test Pass/Fail
+    """
+    output, _ = run_wrangler({"profile": True})
+
+    bucket_name = wrangler_environment_variables["bucket_name"]
+    with open("tests/fixtures/test_method_input.json", "r") as file_1:
+        runtime_variables = dict(method_runtime_variables["RuntimeVariables"],
+                                 bucket_name=bucket_name, data=file_1.read(),
+                                 profile=True)
+    with mock.patch.dict(lambda_method_function.os.environ,
+                         method_environment_variables):
+        method_output = lambda_method_function.lambda_handler(
+            {"RuntimeVariables": runtime_variables},
+            test_generic_library.context_object)
+
+    s3 = boto3.resource("s3", region_name="eu-west-2")
+    profile_files = sorted(s3_object.key for s3_object in
+                           s3.Bucket(bucket_name).objects.filter(
+                               Prefix=strata_metrics.PROFILE_PREFIX))
+
+    assert output["success"] and method_output["success"]
+    assert len(profile_files) == 4
+    assert profile_files[2:] == ["strata_profiles/bob/wrangler.pstats",
+                                 "strata_profiles/bob/wrangler.txt"]
+    assert profile_files[0].startswith("strata_profiles/bob/method_")
+
+    report = s3.Object(bucket_name, "strata_profiles/bob/wrangler.txt").get()[
+        "Body"].read().decode("UTF-8")
+    assert "strata_mismatch_detector" in report
+    assert "Top allocation sites:" in report
+
+
+@mock_s3
+def test_replay(tmp_path):
+    """
+    Replays a wrangler event with the method run in process, checking the outputs are
+    saved and the profile is written locally.
+    :param tmp_path - Directory to write the event, environment and profile to.
+    :return Test Pass/Fail
+    """
+    bucket_name = wrangler_environment_variables["bucket_name"]
+    client = test_generic_library.create_bucket(bucket_name)
+    test_generic_library.upload_files(client, bucket_name, ["test_wrangler_input.json"])
+
+    (tmp_path / "event.json").write_text(json.dumps(wrangler_runtime_variables))
+    (tmp_path / "env.json").write_text(json.dumps(dict(wrangler_environment_variables,
+                                                       **method_environment_variables)))
+
+    with mock.patch.dict(lambda_wrangler_function.os.environ), \
+            mock.patch("strata_period_wrangler.aws_functions.send_bpm_status"), \
+            mock.patch("strata_period_wrangler.aws_functions."
+                       "send_sns_message_with_anomalies"):
+        strata_replay.main([str(tmp_path / "event.json"),
+                            "--env-file", str(tmp_path / "env.json"),
+                            "--env", "method_name=local",
+                            "--local-method",
+                            "--profile-dir", str(tmp_path / "profile")])
+
+    produced_data = pd.read_json(strata_io.read_s3_text(
+        bucket_name, "test_wrangler_output.json"), dtype=False)
+    with open("tests/fixtures/test_wrangler_prepared_output.json", "r") as file_1:
+        prepared_data = pd.DataFrame(json.loads(file_1.read()))
+
+    assert_frame_equal(produced_data.sort_index(axis=1),
+                       prepared_data.sort_index(axis=1))
+    stats = pstats.Stats(str(tmp_path / "profile" / "wrangler.pstats"))
+    assert any(function[2] == "strata_mismatch_detector" for function in stats.stats)
+    assert "Top allocation sites:" in (tmp_path / "profile" / "wrangler.txt").read_text()
+
+
+def test_side_effect_dispatcher():
+    """
+    Dispatches uploads which can only finish together and a series of notifications,
+    checking the uploads overlap and the notifications are sent in order after them.
+    :param None
+    :return Test Pass/Fail
+    """
+    calls = []
+    barrier = threading.Barrier(2, timeout=5)
+
+    def put_object(Bucket, Key, Body):
+        barrier.wait()
+        calls.append(Key)
+
+    def send(message):
+        calls.append(message)
+
+    dispatcher = lambda_wrangler_function.SideEffectDispatcher()
+    with mock.patch("strata_period_wrangler.strata_cache.get_resource") as mock_resource:
+        mock_resource.return_value.meta.client.put_object.side_effect = put_object
+        dispatcher.upload("test_bucket", "file_1", "data")
+        dispatcher.upload("test_bucket", "file_2", "data")
+        assert len(dispatcher.uploads) == 2
+        dispatcher.complete([(send, "third"), (send, "fourth")])
+    dispatcher.close()
+
+    assert sorted(calls[:2]) == ["file_1", "file_2"]
+    assert calls[2:] == ["third", "fourth"]
+    assert dispatcher.uploads == []
+
+
+@mock_s3
+@pytest.mark.parametrize("output_format", ["json", "gzip"])
+def test_side_effect_dispatcher_threads(output_format):
+    """
+    Runs several uploads at once, checking every boto3 client is created on the thread
+    dispatching them, as creating clients isn't thread safe, and the files are saved.
+    :param output_format - Format to save the files in.
+    :return Test Pass/Fail
+    """
+    bucket_name = wrangler_environment_variables["bucket_name"]
+    test_generic_library.create_bucket(bucket_name)
+    strata_cache.clear()
+    data = pd.DataFrame({"responder_id": range(100), "strata": "A"})
+
+    client_threads = []
+    create_client = botocore.session.Session.create_client
+
+    def replacement_create_client(session, *args, **kwargs):
+        client_threads.append(threading.current_thread())
+        return create_client(session, *args, **kwargs)
+
+    dispatcher = lambda_wrangler_function.SideEffectDispatcher(output_format)
+    with mock.patch.object(botocore.session.Session, "create_client", autospec=True,
+                           side_effect=replacement_create_client):
+        for file_number in range(8):
+            dispatcher.upload(bucket_name, f"file_{file_number}",
+                              data.to_json(orient="records")
+                              if output_format == "json" else data)
+        dispatcher.wait()
+    dispatcher.close()
+
+    assert client_threads
+    assert set(client_threads) == {threading.current_thread()}
+    for file_number in range(8):
+        assert_frame_equal(strata_io.read_output(bucket_name, f"file_{file_number}"),
+                           data)
+
+
+@mock_s3
+@pytest.mark.parametrize("fail", [False, True])
+def test_wrangler_side_effect_order(fail):
+    """
+    Runs the wrangler, checking BPM is sent the start of module status first, and the
+    SNS message and end of module status only after the outputs are saved.
+    :param fail - Whether the invoke fails, so BPM is sent the failure instead.
+    :return Test Pass/Fail
+    """
+    calls = []
+
+    def failing_invoke(FunctionName, Payload, InvocationType="RequestResponse"):
+        raise ValueError("Invoke failed")
+
+    with mock.patch("strata_period_wrangler.aws_functions.send_bpm_status",
+                    side_effect=lambda *args: calls.append(args[2])), \
+            mock.patch("strata_period_wrangler.aws_functions."
+                       "send_sns_message_with_anomalies",
+                       side_effect=lambda *args: calls.append("sns")):
+        if fail:
+            with pytest.raises(exception_classes.LambdaFailure):
+                run_wrangler({}, invoke=failing_invoke)
+        else:
+            _, saved_files = run_wrangler({})
+
+    if fail:
+        assert calls[0] == "IN PROGRESS"
+        assert "DONE" not in calls and "sns" not in calls
+    else:
+        assert calls == ["IN PROGRESS", "sns", "DONE"]
+        assert "test_wrangler_output.json" in saved_files
+
+
+@mock_s3
+@pytest.mark.parametrize("output_format", ["gzip", "zstd", "parquet"])
+@pytest.mark.parametrize("project_columns", [False, True])
+def test_wrangler_output_format(output_format, project_columns):
+    """
+    Runs the wrangler with each output format, checking the format is detected from
+    the saved files and they decode to the same data and anomalies as records JSON.
+    :param output_format - Format to save the outputs in.
+    :param project_columns - Whether the method is sent projected data.
+    :return Test Pass/Fail
+    """
+    with open("tests/fixtures/test_wrangler_input.json", "r") as file_1:
+        current_data = pd.DataFrame(json.loads(file_1.read()))
+    # The previous period has no values, so there are nulls and anomalies to save.
+    input_data = pd.concat([current_data.assign(period=201806, Q608_total=None),
+                            current_data], ignore_index=True)
+
+    _, json_files = run_wrangler({"project_columns": project_columns},
+                                 input_data=input_data)
+    output, saved_files = run_wrangler({"output_format": output_format,
+                                        "project_columns": project_columns},
+                                       input_data=input_data)
+
+    assert output["success"]
+    # Only the json format is recorded.
+    assert saved_files == {}
+
+    bucket_name = wrangler_environment_variables["bucket_name"]
+    s3 = boto3.resource("s3", region_name="eu-west-2")
+    assert sorted(json_files) == ["Strata_Anomalies", "test_wrangler_output.json"]
+    for file_name, json_output in json_files.items():
+        s3_object = s3.Object(bucket_name, file_name).get()
+        data = s3_object["Body"].read()
+        assert strata_io.detect_output_format(data) == output_format
+        assert s3_object["ContentType"] == strata_io.OUTPUT_CONTENT_TYPES[output_format]
+        assert s3_object["Metadata"] == {"strata-output-format": output_format}
+
+        if output_format == "parquet":
+            assert strata_io.read_output(bucket_name, file_name).to_json(
+                orient="records") == json_output
+        else:
+            assert strata_io.decompress_output(data, output_format) == json_output
+            assert_frame_equal(strata_io.read_output(bucket_name, file_name),
+                               pd.read_json(json_output, dtype=False))
+
+
+@mock_s3
+@pytest.mark.parametrize("output_format", ["json", "gzip", "zstd"])
+def test_write_output_chunks(output_format):
+    """
+    Checks write_output encodes a DataFrame as JSON a chunk of rows at a time, feeding
+    each chunk on to the compressor, and writes the same records JSON as encoding it
+    whole.
+    :param output_format - Format to write.
+    :return Test Pass/Fail
+    """
+    bucket_name = wrangler_environment_variables["bucket_name"]
+    client = test_generic_library.create_bucket(bucket_name)
+    data = pd.DataFrame({"responder_id": range(7),
+                         "Q608_total": [0.1, 2.5, None, 1e-7, 3.0, 12345.678, -0.3],
+                         "strata": ["A", "B1", None, "C", "A", "D", "E"]})
+    json_output = data.to_json(orient="records")
+
+    encoded_rows = []
+    to_json = pd.DataFrame.to_json
+
+    def recording_to_json(frame, *args, **kwargs):
+        encoded_rows.append(len(frame))
+        return to_json(frame, *args, **kwargs)
+
+    with mock.patch.object(strata_io, "OUTPUT_JSON_CHUNK_SIZE", 3), \
+            mock.patch.object(pd.DataFrame, "to_json", recording_to_json):
+        strata_io.write_output(data, bucket_name, "output", output_format)
+
+    assert encoded_rows == [3, 3, 1]
+    written = client.get_object(Bucket=bucket_name, Key="output")["Body"].read()
+    assert strata_io.decompress_output(written, output_format) == json_output
+
+
+@pytest.mark.parametrize("runtime_variables", [{"project_columns": True},
+                                               {"data_transport": "parquet"},
+                                               {"shard_count": 2}])
+def test_wrangler_value_column_validation(runtime_variables):
+    """
+    Checks the wrangler needs the value_column environment variable only when the data
+    is projected.
+    :param runtime_variables - RuntimeVariables of a run which projects the data.
+    :return Test Pass/Fail
+    """
+    assert "value_column" not in wrangler_environment_variables
+    event = {"RuntimeVariables": dict(wrangler_runtime_variables["RuntimeVariables"],
+                                      **runtime_variables)}
+
+    with mock.patch.dict(lambda_wrangler_function.os.environ,
+                         wrangler_environment_variables):
+        with pytest.raises(exception_classes.LambdaFailure) as exc_info:
+            lambda_wrangler_function.lambda_handler(event,
+                                                    test_generic_library.context_object)
+
+    assert "value_column is needed" in exc_info.value.error_message
+
+
+def test_output_format_validation():
+    """
+    Checks the output format can't be changed with the s3 data transport, where the
+    method saves the data.
+    :param None
+    :return Test Pass/Fail
+    """
+    runtime_variables = dict(wrangler_runtime_variables["RuntimeVariables"],
+                             data_transport="s3", output_format="gzip")
+    with pytest.raises(ValueError, match="output format"):
+        lambda_wrangler_function.RuntimeSchema().load(runtime_variables)
+
+
+@pytest.mark.parametrize("schema", [lambda_method_function.RuntimeSchema,
+                                    lambda_wrangler_function.RuntimeSchema])
+def test_chunk_partitions_validation(schema):
+    """
+    Checks chunk partitions can only be given with a chunk size.
+    :param schema - RuntimeSchema of the method or the wrangler.
+    :return Test Pass/Fail
+    """
+    runtime_variables = dict(
+        wrangler_runtime_variables["RuntimeVariables"]
+        if schema is lambda_wrangler_function.RuntimeSchema
+        else method_runtime_variables["RuntimeVariables"],
+        bucket_name="test_bucket", data_transport="s3", in_file_name="in",
+        out_file_name="out", chunk_partitions=2)
+    runtime_variables.pop("data", None)
+    with pytest.raises(ValueError, match="chunk size"):
+        schema().load(runtime_variables)
+
+    schema().load(dict(runtime_variables, chunk_size=4))
+
+
+@pytest.mark.parametrize("data_transport", [None, "json", "parquet"])
+def test_asynchronous_validation(data_transport):
+    """
+    Checks runs can only be asynchronous with the s3 data transport, as the payload of
+    an asynchronous invoke is too small to hold the data.
+    :param data_transport - Data transport of the run, or None for the default.
+    :return Test Pass/Fail
+    """
+    runtime_variables = dict(wrangler_runtime_variables["RuntimeVariables"],
+                             asynchronous=True)
+    if data_transport is not None:
+        runtime_variables["data_transport"] = data_transport
+    with pytest.raises(ValueError, match="asynchronous"):
+        lambda_wrangler_function.RuntimeSchema().load(runtime_variables)
+
+    lambda_wrangler_function.RuntimeSchema().load(dict(runtime_variables,
+                                                       data_transport="s3"))
+    with pytest.raises(ValueError, match="task token"):
+        lambda_wrangler_function.RuntimeSchema().load(
+            dict(wrangler_runtime_variables["RuntimeVariables"], task_token="token"))
+
+
+@pytest.mark.parametrize("schema,period_name", [
+    (lambda_method_function.RuntimeSchema, "current_period"),
+    (lambda_wrangler_function.RuntimeSchema, "period")
+])
+def test_periods_validation(schema, period_name):
+    """
+    Checks the period can only be left out when multiple periods are run.
+    :param schema - RuntimeSchema of the method or the wrangler.
+    :param period_name - Name of the schema's period field.
+    :return Test Pass/Fail
+    """
+    runtime_variables = dict(
+        wrangler_runtime_variables["RuntimeVariables"]
+        if schema is lambda_wrangler_function.RuntimeSchema
+        else dict(method_runtime_variables["RuntimeVariables"], data="[]"))
+    runtime_variables.pop(period_name)
+    with pytest.raises(ValueError, match="period is needed"):
+        schema().load(runtime_variables)
+
+    loaded = schema().load(dict(runtime_variables, periods=["201806", "201809"]))
+    assert period_name not in loaded
+
+
+@pytest.mark.parametrize("records", [
+    [{"responder_id": 1, "Q608_total": 150000, "strata": "B2", "region": 10}],
+    [{"a": 1, "b": None, "c": "x/y"}, {"a": 2, "b": 1.5, "c": None}],
+    [{"a": 1, "b": "é"}, {"a": 2.5, "b": "\u007f"}],
+    [{"a": True, "b": 9223372036854775808}, {"a": False, "b": 1.5}],
+    [{"a": 9223372036854775808}, {"a": -1}],
+    [{"a": None, "b": [1, 2]}, {"a": None, "b": {"c": 1}}],
+    [{"a": 1, "b": 2}, {"a": 3}],
+    [{"a": 1, "1": 2, "period_date": 1600000000000, "created_at": 1600000000000}],
+    []
+])
+def test_json_codecs(records):
+    """
+    Decodes records with the stdlib and orjson codecs, checking the orjson fast path,
+    or its fall back to pandas, gives the same DataFrame and encodes to the same JSON.
+    :param records - List of dicts of the records.
+    :return Test Pass/Fail
+    """
+    pytest.importorskip("orjson")
+    data = json.dumps(records)
+
+    stdlib_data = strata_io.JsonCodec().decode_records(data)
+    orjson_data = strata_io.OrjsonCodec().decode_records(data)
+
+    assert_frame_equal(orjson_data, stdlib_data)
+    assert strata_io.OrjsonCodec().encode_records(orjson_data) == \
+        strata_io.JsonCodec().encode_records(stdlib_data)
+
+
+def test_json_codecs_floats():
+    """
+    Decodes floats of every precision with the stdlib and orjson codecs, checking they
+    give exactly the same values and round trip through records JSON.
+    :param None
+    :return Test Pass/Fail
+    """
+    pytest.importorskip("orjson")
+    generator = np.random.default_rng(0)
+    values = generator.uniform(-1000000, 1000000, 2000) * \
+        10.0 ** generator.integers(-8, 4, 2000)
+    data = json.dumps([{"responder_id": row, "Q608_total": value}
+                       for row, value in enumerate(values)])
+
+    stdlib_data = strata_io.JsonCodec().decode_records(data)
+    orjson_data = strata_io.OrjsonCodec().decode_records(data)
+
+    assert_frame_equal(orjson_data, stdlib_data, check_exact=True)
+    assert list(orjson_data["Q608_total"]) == list(values)
+    assert_frame_equal(strata_io.OrjsonCodec().decode_records(
+        strata_io.OrjsonCodec().encode_records(orjson_data)),
+        strata_io.JsonCodec().decode_records(
+            strata_io.JsonCodec().encode_records(stdlib_data)), check_exact=True)
+
+
+def test_json_codecs_column_names():
+    """
+    Decodes records with the same columns twice with one orjson codec, checking pandas
+    is only asked once whether it keeps the column names.
+    :param None
+    :return Test Pass/Fail
+    """
+    pytest.importorskip("orjson")
+    codec = strata_io.OrjsonCodec()
+    data = [json.dumps([{"1": row, "2": row * 1.5}]) for row in range(2)]
+    data.append(json.dumps([{"responder_id": 2, "Q608_total": 3}]))
+
+    with mock.patch.object(strata_io.JsonCodec, "decode_records",
+                           autospec=True,
+                           side_effect=strata_io.JsonCodec.decode_records) as decode:
+        decoded = [codec.decode_records(records) for records in data]
+
+    assert [frame.columns.tolist() for frame in decoded] == [
+        [1, 2], [1, 2], ["responder_id", "Q608_total"]]
+    assert decode.call_count == 4
+    assert codec.column_names_kept == {("1", "2"): False,
+                                       ("responder_id", "Q608_total"): True}
+
+
+@mock_s3
+def test_wrangler_json_codec():
+    """
+    Runs the wrangler and method with each JSON codec, checking they save the same
+    files and decode generated data the same, and that an unknown codec is rejected.
+    :param None
+    :return Test Pass/Fail
+    """
+    pytest.importorskip("orjson")
+    saved = {}
+    for name in strata_io.JSON_CODECS:
+        with mock.patch.dict(method_environment_variables, json_codec=name), \
+                mock.patch.dict(wrangler_environment_variables, json_codec=name):
+            output, saved[name] = run_wrangler({})
+        assert output["success"]
+        assert isinstance(strata_io.get_json_codec(), strata_io.JSON_CODECS[name])
+
+    assert saved["orjson"] == saved["stdlib"]
+
+    generated_data = synthetic_data.generate_strata_data(1000).to_json(orient="records")
+    assert_frame_equal(strata_io.OrjsonCodec().decode_records(generated_data),
+                       strata_io.JsonCodec().decode_records(generated_data))
+
+    with pytest.raises(ValueError, match="Unknown JSON codec"):
+        strata_io.set_json_codec("ujson")